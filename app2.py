@@ -1,18 +1,62 @@
+# ==============================
+# MODO DE SERVIDOR
+# ==============================
+# ROKA_ASYNC_MODE=threading (por defecto): un hilo del sistema por request y por conexión
+# Socket.IO. ROKA_ASYNC_MODE=eventlet: green threads, para que un worker sostenga todas las
+# tablets y pantallas de cocina conectadas. El monkey patch tiene que ir antes de cualquier import.
+import os
+ROKA_ASYNC_MODE = os.environ.get("ROKA_ASYNC_MODE", "threading")
+if ROKA_ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ROKA_ASYNC_MODE != 'threading':
+    raise RuntimeError(f"ROKA_ASYNC_MODE desconocido: {ROKA_ASYNC_MODE}")
+
 # ==============================
 # IMPORTS CORRECTOS
 # ==============================
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash, g, has_app_context, has_request_context, stream_with_context
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from psycopg2.pool import PoolError
 from datetime import datetime, date, timedelta
+from decimal import Decimal
 import json
+import csv
+import io
 import hashlib
+import hmac
+import re
+import unicodedata
+from collections import OrderedDict
 from functools import wraps
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import socket
-import os
 import locale
+import threading
+import time
+import select
+import uuid
+import zlib
+import bisect
+import heapq
+import math
+import inspect
+import random
+import logging
+import logging.handlers
+import queue
+import atexit
+import sys
+import traceback
+from collections import deque
+import click
+from flask.cli import AppGroup
 from urllib.parse import urlparse
 
+_inicio_arranque = time.perf_counter()
+
 # Configurar locale para español
 try:
     locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
@@ -24,7 +68,93 @@ except:
 
 app = Flask(__name__)
 app.secret_key = 'clave_secreta_pos_2024_sistema_login'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ROKA_ASYNC_MODE)
+
+# ==============================
+# REGISTRO (LOGGING) ESTRUCTURADO
+# ==============================
+# Los hilos que atienden requests solo encolan el registro; un hilo aparte lo escribe en stdout.
+# ROKA_LOG_FORMATO=json (por defecto, una línea JSON por evento) o texto; nivel con ROKA_LOG_NIVEL.
+# Cada línea lleva request_id (o el sid de Socket.IO) y la ruta para correlacionar.
+class ColaSinBloqueo(logging.handlers.QueueHandler):
+    """QueueHandler que nunca bloquea: con la cola llena descarta y cuenta"""
+
+    def __init__(self, cola):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def prepare(self, record):
+        # Se resuelve el mensaje y la traza en el hilo que registra: el resto se serializa después
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.excepcion = ''.join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+            record.exc_text = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+class ContextoLog(logging.Filter):
+    """Agrega request_id, sid y ruta del request o evento de Socket.IO en curso"""
+
+    def filter(self, record):
+        record.request_id = record.sid = record.origen = None
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.sid = getattr(request, 'sid', None)
+            record.origen = _origen_actual()
+        return True
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        datos = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'mensaje': record.getMessage()
+        }
+        for campo in ('request_id', 'sid', 'origen'):
+            valor = getattr(record, campo, None)
+            if valor:
+                datos[campo] = valor
+        datos.update(getattr(record, 'campos', None) or {})
+        excepcion = getattr(record, 'excepcion', None)
+        if excepcion:
+            datos['excepcion'] = excepcion
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+class FormatoTexto(logging.Formatter):
+    def format(self, record):
+        linea = f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S')} {record.levelname:<7} {record.getMessage()}"
+        correlacion = getattr(record, 'request_id', None) or getattr(record, 'sid', None)
+        if correlacion:
+            linea += f" [{correlacion} {record.origen}]"
+        campos = getattr(record, 'campos', None)
+        if campos:
+            linea += ' ' + ' '.join(f"{clave}={valor}" for clave, valor in campos.items())
+        excepcion = getattr(record, 'excepcion', None)
+        return linea + ('\n' + excepcion.rstrip() if excepcion else '')
+
+def configurar_log():
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoTexto() if os.environ.get("ROKA_LOG_FORMATO") == "texto" else FormatoJSON())
+    cola = ColaSinBloqueo(queue.Queue(maxsize=int(os.environ.get("ROKA_LOG_COLA", 10000))))
+    cola.addFilter(ContextoLog())
+    logger = logging.getLogger('roka')
+    logger.setLevel(os.environ.get("ROKA_LOG_NIVEL", "INFO").upper())
+    logger.addHandler(cola)
+    logger.propagate = False
+    escucha = logging.handlers.QueueListener(cola.queue, salida)
+    escucha.start()
+    atexit.register(escucha.stop)
+    return logger, cola
+
+log, _cola_log = configurar_log()
 
 # ==============================
 # FILTROS PERSONALIZADOS
@@ -71,14 +201,324 @@ app.jinja_env.filters['format_currency'] = format_currency
 app.jinja_env.filters['format_number'] = format_number
 
 # ==============================
-# CONEXIÓN A BASE DE DATOS - SOLUCIÓN DEFINITIVA
+# MÉTRICAS E INSTRUMENTACIÓN
 # ==============================
-def get_db_connection():
+# Latencia por ruta HTTP y por evento de Socket.IO, más conexiones, consultas y tiempo en la
+# base de cada uno. Se exportan en formato de texto de Prometheus en /metrics. Son por proceso:
+# con varios workers, cada uno expone las suyas.
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _etiquetas_texto(etiquetas):
+    if not etiquetas:
+        return ''
+    partes = []
+    for clave, valor in etiquetas:
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append(f'{clave}="{valor}"')
+    return '{' + ','.join(partes) + '}'
+
+class Metricas:
+    """Contadores e histogramas en memoria del proceso"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tipos = {}        # nombre -> (tipo, ayuda)
+        self._contadores = {}   # (nombre, etiquetas) -> valor
+        self._histogramas = {}  # (nombre, etiquetas) -> [cuenta por bucket..., suma, cuenta]
+
+    def definir(self, nombre, tipo, ayuda):
+        self._tipos[nombre] = (tipo, ayuda)
+
+    def sumar(self, nombre, valor=1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            datos = self._histogramas.get(clave)
+            if datos is None:
+                datos = self._histogramas[clave] = [0] * (len(BUCKETS_SEGUNDOS) + 2)
+            for i, limite in enumerate(BUCKETS_SEGUNDOS):
+                if valor <= limite:
+                    datos[i] += 1
+                    break
+            datos[-2] += valor
+            datos[-1] += 1
+
+    def exportar(self, medidores=()):
+        """Texto de Prometheus. medidores: [(nombre, tipo, ayuda, [(etiquetas, valor)])] calculados al vuelo"""
+        with self._lock:
+            contadores = dict(self._contadores)
+            histogramas = {clave: list(datos) for clave, datos in self._histogramas.items()}
+
+        familias = {}
+        for (nombre, etiquetas), valor in contadores.items():
+            familias.setdefault(nombre, []).append(f"{nombre}{_etiquetas_texto(etiquetas)} {valor}")
+        for (nombre, etiquetas), datos in histogramas.items():
+            lineas = familias.setdefault(nombre, [])
+            acumulado = 0
+            for limite, cuenta in zip(BUCKETS_SEGUNDOS, datos):
+                acumulado += cuenta
+                lineas.append(f"{nombre}_bucket{_etiquetas_texto(etiquetas + (('le', limite),))} {acumulado}")
+            lineas.append(f"{nombre}_bucket{_etiquetas_texto(etiquetas + (('le', '+Inf'),))} {datos[-1]}")
+            lineas.append(f"{nombre}_sum{_etiquetas_texto(etiquetas)} {datos[-2]}")
+            lineas.append(f"{nombre}_count{_etiquetas_texto(etiquetas)} {datos[-1]}")
+
+        salida = []
+        for nombre in sorted(familias):
+            tipo, ayuda = self._tipos.get(nombre, ('untyped', nombre))
+            salida.append(f"# HELP {nombre} {ayuda}")
+            salida.append(f"# TYPE {nombre} {tipo}")
+            salida.extend(familias[nombre])
+        for nombre, tipo, ayuda, valores in medidores:
+            salida.append(f"# HELP {nombre} {ayuda}")
+            salida.append(f"# TYPE {nombre} {tipo}")
+            for etiquetas, valor in valores:
+                salida.append(f"{nombre}{_etiquetas_texto(tuple(etiquetas.items()))} {valor}")
+        return '\n'.join(salida) + '\n'
+
+metricas = Metricas()
+metricas.definir('roka_http_requests_total', 'counter', 'Requests HTTP por ruta, método y estado')
+metricas.definir('roka_http_duracion_segundos', 'histogram', 'Latencia de los requests HTTP por ruta')
+metricas.definir('roka_socketio_eventos_total', 'counter', 'Eventos de Socket.IO atendidos')
+metricas.definir('roka_socketio_duracion_segundos', 'histogram', 'Duración de los handlers de Socket.IO')
+metricas.definir('roka_db_conexiones_prestadas_total', 'counter', 'Conexiones del pool tomadas por ruta o evento')
+metricas.definir('roka_db_consultas_total', 'counter', 'Consultas ejecutadas por ruta o evento')
+metricas.definir('roka_db_segundos_total', 'counter', 'Tiempo en la base por ruta o evento')
+metricas.definir('roka_db_conexiones_abiertas_total', 'counter', 'Conexiones físicas abiertas a la base')
+
+def _registrar_uso_db(origen):
+    """Vuelca a las métricas lo que el request o evento actual hizo en la base"""
+    metricas.sumar('roka_db_conexiones_prestadas_total', g.get('_db_conexiones', 0), origen=origen)
+    metricas.sumar('roka_db_consultas_total', g.get('_db_consultas', 0), origen=origen)
+    metricas.sumar('roka_db_segundos_total', g.get('_db_segundos', 0.0), origen=origen)
+
+@app.before_request
+def iniciar_medicion_request():
+    g._inicio_request = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+
+@app.after_request
+def registrar_medicion_request(response):
+    # Ruta como patrón (/api/cancelar_orden/<int:orden_id>) para no crear una serie por id
+    ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+    inicio = g.get('_inicio_request')
+    if inicio is not None:
+        metricas.observar('roka_http_duracion_segundos', time.perf_counter() - inicio, ruta=ruta, metodo=request.method)
+    metricas.sumar('roka_http_requests_total', ruta=ruta, metodo=request.method, estado=response.status_code)
+    _registrar_uso_db(ruta)
+    if CONTAR_CONSULTAS:
+        response.headers['X-DB-Consultas'] = str(g.get('_db_consultas', 0))
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+def instrumentar_socket(f):
+    """Decorador para handlers de Socket.IO (debajo de @socketio.on): mide duración y uso de la base"""
+    recibe_argumentos = bool(inspect.signature(f).parameters)
+
+    @wraps(f)
+    def envoltura(*args):
+        inicio = time.perf_counter()
+        try:
+            return f(*args) if recibe_argumentos else f()
+        finally:
+            evento = request.event['message'] if getattr(request, 'event', None) else f.__name__
+            namespace = getattr(request, 'namespace', None) or '/'
+            metricas.observar('roka_socketio_duracion_segundos', time.perf_counter() - inicio,
+                              namespace=namespace, evento=evento)
+            metricas.sumar('roka_socketio_eventos_total', namespace=namespace, evento=evento)
+            _registrar_uso_db(f"socketio {namespace} {evento}")
+    return envoltura
+
+def _origen_actual():
+    """Ruta HTTP o evento de Socket.IO que está ejecutando este hilo ('fondo' si ninguno)"""
+    if not has_request_context():
+        return 'fondo'
+    evento = getattr(request, 'event', None)
+    if evento:
+        return f"socketio {getattr(request, 'namespace', None) or '/'} {evento['message']}"
+    return request.url_rule.rule if request.url_rule else 'sin_ruta'
+
+# ==============================
+# PERFIL DE CONSULTAS SQL
+# ==============================
+# Con ROKA_PERFILAR_SQL=1 cada consulta se agrupa por su forma (huella: el SQL sin literales)
+# con llamadas, tiempo, filas y rutas que la ejecutan. Las que superan ROKA_SQL_LENTA_MS quedan
+# en el registro de lentas y, para una muestra (ROKA_SQL_MUESTRA_EXPLAIN), se guarda su
+# EXPLAIN (ANALYZE, BUFFERS). El resumen está en /admin/consultas.
+PERFILAR_SQL = os.environ.get("ROKA_PERFILAR_SQL") == "1"
+
+_RE_SQL_CADENAS = re.compile(r"'(?:[^']|'')*'")
+_RE_SQL_NUMEROS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_SQL_PARAMETROS = re.compile(r"%(?:\(\w+\))?s")
+_RE_SQL_LISTAS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_RE_SQL_TUPLAS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_RE_SQL_ESPACIOS = re.compile(r"\s+")
+# EXPLAIN ANALYZE vuelve a ejecutar la sentencia: solo lecturas sin efectos secundarios
+_RE_SQL_CON_EFECTOS = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|COPY|nextval|setval|pg_notify|pg_advisory\w*)\b",
+                                 re.IGNORECASE)
+
+def huella_sql(query):
+    """Forma de la consulta: sin literales ni parámetros y con las listas colapsadas"""
+    huella = _RE_SQL_CADENAS.sub('?', query)
+    huella = _RE_SQL_PARAMETROS.sub('?', huella)
+    huella = _RE_SQL_NUMEROS.sub('?', huella)
+    huella = _RE_SQL_ESPACIOS.sub(' ', huella).strip()
+    huella = _RE_SQL_LISTAS.sub('(...)', huella)
+    return _RE_SQL_TUPLAS.sub('(...), ...', huella)
+
+class PerfilConsultas:
+    """Estadísticas por huella de consulta y registro de las consultas lentas"""
+
+    def __init__(self, umbral_segundos, muestra_explain, max_huellas=500, max_lentas=200):
+        self.umbral_segundos = umbral_segundos
+        self.muestra_explain = muestra_explain
+        self.max_huellas = max_huellas
+        self._lock = threading.Lock()
+        self._huellas = {}
+        self._lentas = deque(maxlen=max_lentas)
+        self._azar = random.Random()
+
+    def registrar(self, cursor, query, vars, segundos):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        elif not isinstance(query, str):
+            return  # psycopg2.sql.Composed y similares
+        if query.lstrip()[:7].upper() == 'EXPLAIN':
+            return
+
+        huella = huella_sql(query)
+        origen = _origen_actual()
+        filas = max(cursor.rowcount, 0)
+        lenta = segundos >= self.umbral_segundos
+        with self._lock:
+            datos = self._huellas.get(huella)
+            if datos is None:
+                if len(self._huellas) >= self.max_huellas:
+                    huella = '(otras)'
+                    datos = self._huellas.get(huella)
+                if datos is None:
+                    datos = self._huellas[huella] = {
+                        'huella': huella, 'ejemplo': query.strip()[:2000], 'llamadas': 0, 'segundos_total': 0.0,
+                        'segundos_max': 0.0, 'filas_total': 0, 'lentas': 0, 'origenes': {}, 'explain': None
+                    }
+            datos['llamadas'] += 1
+            datos['segundos_total'] += segundos
+            datos['segundos_max'] = max(datos['segundos_max'], segundos)
+            datos['filas_total'] += filas
+            datos['origenes'][origen] = datos['origenes'].get(origen, 0) + 1
+            if lenta:
+                datos['lentas'] += 1
+                self._lentas.append({'fecha': datetime.now().isoformat(timespec='seconds'), 'huella': huella,
+                                     'ms': round(segundos * 1000, 2), 'filas': filas, 'origen': origen})
+            explicar = lenta and cursor.name is None and self._azar.random() < self.muestra_explain \
+                and not _RE_SQL_CON_EFECTOS.search(query)
+
+        if lenta:
+            log.warning('Consulta lenta', extra={'campos': {'ms': round(segundos * 1000, 2), 'filas': filas, 'huella': huella[:500]}})
+        if explicar:
+            plan = self._explicar(cursor.connection, query, vars)
+            if plan:
+                with self._lock:
+                    datos['explain'] = {'fecha': datetime.now().isoformat(timespec='seconds'), 'plan': plan}
+
+    @staticmethod
+    def _explicar(conn, query, vars):
+        """EXPLAIN (ANALYZE, BUFFERS) en la misma transacción, dentro de un savepoint para que un
+        error no aborte el request. Usa un cursor común para no contarse ni perfilarse a sí mismo."""
+        en_transaccion = not conn.autocommit and \
+            conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        try:
+            if en_transaccion:
+                cur.execute('SAVEPOINT roka_explain')
+            cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, vars)
+            plan = '\n'.join(f[0] for f in cur.fetchall())
+            if en_transaccion:
+                cur.execute('RELEASE SAVEPOINT roka_explain')
+            return plan
+        except psycopg2.Error as e:
+            if en_transaccion:
+                try:
+                    cur.execute('ROLLBACK TO SAVEPOINT roka_explain')
+                except psycopg2.Error:
+                    pass
+            log.warning('No se pudo obtener el EXPLAIN', extra={'campos': {'error': str(e)}})
+            return None
+        finally:
+            cur.close()
+
+    def resumen(self, orden='segundos_total', limite=100):
+        with self._lock:
+            filas = []
+            for datos in self._huellas.values():
+                fila = dict(datos, origenes=sorted(datos['origenes'].items(), key=lambda o: -o[1])[:5])
+                fila['ms_promedio'] = round(datos['segundos_total'] * 1000 / datos['llamadas'], 2)
+                fila['ms_total'] = round(datos['segundos_total'] * 1000, 2)
+                fila['ms_max'] = round(datos['segundos_max'] * 1000, 2)
+                fila['filas_promedio'] = round(datos['filas_total'] / datos['llamadas'], 1)
+                filas.append(fila)
+        filas.sort(key=lambda f: f.get(orden, 0), reverse=True)
+        return filas[:limite]
+
+    def lentas(self):
+        with self._lock:
+            return list(reversed(self._lentas))
+
+    def reiniciar(self):
+        with self._lock:
+            self._huellas.clear()
+            self._lentas.clear()
+
+perfil_consultas = PerfilConsultas(float(os.environ.get("ROKA_SQL_LENTA_MS", 100)) / 1000,
+                                   float(os.environ.get("ROKA_SQL_MUESTRA_EXPLAIN", 0.1)))
+
+# ==============================
+# CONEXIÓN A BASE DE DATOS - POOL DE CONEXIONES
+# ==============================
+# Cada cursor anota en flask.g cuántas consultas hizo el request y cuánto tardaron. De ahí salen
+# las métricas de /metrics y, con ROKA_CONTAR_CONSULTAS=1, el encabezado X-DB-Consultas
+# (lo usa bench_servicio.py).
+CONTAR_CONSULTAS = os.environ.get("ROKA_CONTAR_CONSULTAS") == "1"
+
+def _registrar_consulta(segundos):
+    if has_app_context():
+        g._db_consultas = g.get('_db_consultas', 0) + 1
+        g._db_segundos = g.get('_db_segundos', 0.0) + segundos
+
+class CursorContado(psycopg2.extensions.cursor):
+    """Cursor que cuenta y cronometra las consultas hechas durante el request (y las perfila
+    con ROKA_PERFILAR_SQL=1)"""
+
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        try:
+            resultado = super().execute(query, vars)
+        finally:
+            segundos = time.perf_counter() - inicio
+            _registrar_consulta(segundos)
+        if PERFILAR_SQL:
+            perfil_consultas.registrar(self, query, vars, segundos)
+        return resultado
+
+    def executemany(self, query, vars_list):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _registrar_consulta(time.perf_counter() - inicio)
+
+def abrir_conexion_nueva():
+    """Abre una conexión física nueva (solo la usa el pool)"""
     database_url = os.environ.get("DATABASE_URL")
+    metricas.sumar('roka_db_conexiones_abiertas_total')
 
     if database_url:
         # Render / Producción
-        print("🌐 Conectando a base de datos de Render...")
+        log.info('Conectando a base de datos de Render')
         result = urlparse(database_url)
         return psycopg2.connect(
             host=result.hostname,
@@ -86,19 +526,248 @@ def get_db_connection():
             user=result.username,
             password=result.password,
             port=result.port,
-            sslmode="require"
+            sslmode="require",
+            cursor_factory=CursorContado
         )
     else:
         # Local (tu PC) - SOLO PARA DESARROLLO
-        print("💻 Conectando a base de datos local...")
+        log.info('Conectando a base de datos local')
         return psycopg2.connect(
             host="localhost",
             database="roka",
             user="postgres",
             password="pm",
-            port=5432
+            port=5432,
+            cursor_factory=CursorContado
         )
 
+def _esperar_psycopg2_eventlet(conn, timeout=-1):
+    """Wait callback de psycopg2 (al estilo psycogreen): mientras la base responde, cede el
+    control al hub de eventlet en lugar de bloquear todo el proceso"""
+    from eventlet.hubs import trampoline
+    while True:
+        estado = conn.poll()
+        if estado == psycopg2.extensions.POLL_OK:
+            break
+        elif estado == psycopg2.extensions.POLL_READ:
+            trampoline(conn.fileno(), read=True)
+        elif estado == psycopg2.extensions.POLL_WRITE:
+            trampoline(conn.fileno(), write=True)
+        else:
+            raise psycopg2.OperationalError(f"Estado de poll inesperado: {estado}")
+
+if ROKA_ASYNC_MODE == 'eventlet':
+    psycopg2.extensions.set_wait_callback(_esperar_psycopg2_eventlet)
+
+class PoolConexiones:
+    """Pool thread-safe de conexiones: reutiliza sockets TLS, espera con timeout si está lleno
+    y reemplaza conexiones rotas al prestarlas o devolverlas"""
+
+    def __init__(self, conectar, minimo=1, maximo=10, timeout=10.0, ping_segundos=30.0):
+        self.conectar = conectar
+        self.minimo = minimo
+        self.maximo = maximo
+        self.timeout = timeout
+        self.ping_segundos = ping_segundos
+        self._cond = threading.Condition()
+        self._libres = []  # [(conexion, momento_devolucion)]
+        self._total = 0
+        self._en_uso = 0
+        self._esperas = 0
+        self._tiempo_espera = 0.0
+        self._creadas = 0
+        self._reemplazadas = 0
+
+    def calentar(self):
+        """Abre las conexiones mínimas por adelantado"""
+        while True:
+            with self._cond:
+                if self._total >= self.minimo:
+                    return
+                self._total += 1
+            try:
+                conn = self.conectar()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                raise
+            with self._cond:
+                self._creadas += 1
+                self._libres.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def obtener(self):
+        inicio = time.monotonic()
+        espero = False
+        with self._cond:
+            while True:
+                if self._libres:
+                    conn, devuelta = self._libres.pop()
+                    break
+                if self._total < self.maximo:
+                    self._total += 1
+                    conn, devuelta = None, None
+                    break
+                if not espero:
+                    espero = True
+                    self._esperas += 1
+                restante = self.timeout - (time.monotonic() - inicio)
+                if restante <= 0:
+                    self._tiempo_espera += time.monotonic() - inicio
+                    raise PoolError(f"Pool agotado: {self.maximo} conexiones en uso tras {self.timeout}s de espera")
+                self._cond.wait(restante)
+            if espero:
+                self._tiempo_espera += time.monotonic() - inicio
+            self._en_uso += 1
+
+        try:
+            if conn is not None and not self._esta_sana(conn, devuelta):
+                self._cerrar_silencioso(conn)
+                conn = None
+                with self._cond:
+                    self._reemplazadas += 1
+            if conn is None:
+                conn = self.conectar()
+                with self._cond:
+                    self._creadas += 1
+            return conn
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._en_uso -= 1
+                self._cond.notify()
+            raise
+
+    def devolver(self, conn):
+        sana = not conn.closed
+        if sana and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                sana = False
+        if not sana:
+            self._cerrar_silencioso(conn)
+        with self._cond:
+            self._en_uso -= 1
+            if sana:
+                self._libres.append((conn, time.monotonic()))
+            else:
+                self._total -= 1
+            self._cond.notify()
+
+    def _esta_sana(self, conn, devuelta):
+        if conn.closed:
+            return False
+        # Solo se hace ping a conexiones que estuvieron ociosas un rato (Render corta las inactivas)
+        if time.monotonic() - devuelta < self.ping_segundos:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _cerrar_silencioso(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def estadisticas(self):
+        with self._cond:
+            return {
+                'minimo': self.minimo,
+                'maximo': self.maximo,
+                'abiertas': self._total,
+                'en_uso': self._en_uso,
+                'libres': len(self._libres),
+                'esperas': self._esperas,
+                'tiempo_espera_total': round(self._tiempo_espera, 4),
+                'creadas': self._creadas,
+                'reemplazadas': self._reemplazadas
+            }
+
+class ConexionPrestada:
+    """Envoltura de una conexión del pool: close() no cierra el socket.
+
+    Dentro de un request solo descarta la transacción pendiente (la conexión sigue en flask.g
+    hasta el teardown); fuera de un request devuelve la conexión al pool."""
+
+    def __init__(self, conn, al_cerrar):
+        self._conn = conn
+        self._al_cerrar = al_cerrar
+
+    def __getattr__(self, nombre):
+        return getattr(self._conn, nombre)
+
+    def close(self):
+        if self._al_cerrar is not None:
+            al_cerrar, self._al_cerrar = self._al_cerrar, None
+            al_cerrar(self._conn)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Pool del proceso; un pool heredado por fork no se usa (sus sockets son del padre)"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                pool = PoolConexiones(
+                    abrir_conexion_nueva,
+                    minimo=int(os.environ.get("DB_POOL_MIN", 1)),
+                    maximo=int(os.environ.get("DB_POOL_MAX", 10)),
+                    timeout=float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+                    ping_segundos=float(os.environ.get("DB_POOL_PING", 30))
+                )
+                try:
+                    pool.calentar()
+                except Exception as e:
+                    log.warning('No se pudo precalentar el pool', extra={'campos': {'error': str(e)}})
+                _pool, _pool_pid = pool, os.getpid()
+    return _pool
+
+def _descartar_transaccion(conn):
+    if not conn.closed:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+
+def get_db_connection():
+    """Conexión del pool. Dentro de un request se presta una sola conexión (en flask.g)
+    para todos los helpers y se devuelve en el teardown."""
+    if not has_app_context():
+        return ConexionPrestada(get_pool().obtener(), get_pool().devolver)
+
+    conn = g.get('_db_conn')
+    if conn is not None and not conn.closed and \
+       conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        # Un helper anterior falló sin cerrar: no contagiar el error al siguiente
+        _descartar_transaccion(conn)
+    if conn is not None and conn.closed:
+        # Se rompió durante el request: devolverla (el pool la descarta) y pedir otra
+        get_pool().devolver(conn)
+        g.pop('_db_conn')
+        conn = None
+    if conn is None:
+        conn = get_pool().obtener()
+        g._db_conn = conn
+        g._db_conexiones = g.get('_db_conexiones', 0) + 1
+    return ConexionPrestada(conn, _descartar_transaccion)
+
+@app.teardown_appcontext
+def devolver_conexion_request(exc):
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        get_pool().devolver(conn)
+
 # ==============================
 # CREACIÓN DE TABLAS (SI NO EXISTEN)
 # ==============================
@@ -107,7 +776,7 @@ def create_tables():
         conn = get_db_connection()
         cur = conn.cursor()
         
-        print("📝 Creando tablas si no existen...")
+        log.info('Creando tablas si no existen')
         
         # Tablas existentes (solo si no existen)
         cur.execute('''
@@ -239,7 +908,7 @@ def create_tables():
         # Insertar usuarios por defecto si no existen
         cur.execute("SELECT COUNT(*) FROM usuarios WHERE username = 'admin'")
         if cur.fetchone()[0] == 0:
-            print("👤 Creando usuarios por defecto...")
+            log.info('Creando usuarios por defecto')
             password_hash = hashlib.sha256('admin123'.encode()).hexdigest()
             cur.execute('INSERT INTO usuarios (username, password_hash, nombre, email, rol) VALUES (%s, %s, %s, %s, %s)', 
                        ('admin', password_hash, 'Administrador', 'admin@sistema.com', 'admin'))
@@ -260,11 +929,15 @@ def create_tables():
                 cur.execute('INSERT INTO categorias (nombre) VALUES (%s) ON CONFLICT (nombre) DO NOTHING', (categoria,))
         
         conn.commit()
-        print("✅ Tablas creadas/verificadas exitosamente")
+        
+        # Índices y cambios posteriores al esquema base
+        aplicar_migraciones(conn)
+        
+        log.info('Tablas creadas/verificadas')
         return True
         
-    except Exception as e:
-        print(f"❌ Error al crear tablas: {e}")
+    except Exception:
+        log.exception('Error al crear tablas')
         return False
     finally:
         try:
@@ -274,103 +947,1373 @@ def create_tables():
             pass
 
 # ==============================
-# CREAR TABLAS AL INICIAR (PARA RENDER/GUNICORN)
+# MIGRACIONES DE ESQUEMA (VERSIONADAS)
 # ==============================
-print("🚀 Inicializando aplicación ROKA...")
-try:
-    success = create_tables()
-    if success:
-        print("✅ Sistema listo para usar")
-    else:
-        print("⚠️  Las tablas pueden necesitar ser creadas manualmente")
-        print("ℹ️  Visita /crear-tablas para crear las tablas")
-except Exception as e:
-    print(f"⚠️  Error durante inicialización: {e}")
+SQL_NORMALIZAR_NOMBRE = "translate(lower(nombre), 'áéíóúüñÁÉÍÓÚÜÑ', 'aeiouunaeiouun')"
+
+# Cada paso se aplica una sola vez, en orden y en su propia transacción, y queda registrado en
+# schema_version. Para cambiar el esquema se agrega un paso nuevo al final; nunca se edita uno aplicado.
+MIGRACIONES = [
+    (1, 'Turno de caja abierto único', [
+        # Si quedaron turnos abiertos duplicados de antes, se cierran todos menos el último
+        '''
+        UPDATE caja_turnos
+        SET estado = 'cerrada',
+            fecha_cierre = COALESCE(fecha_cierre, NOW()),
+            observaciones = COALESCE(observaciones || ' | ', '') || 'Cerrada al unificar turnos abiertos duplicados'
+        WHERE estado = 'abierta'
+          AND id < (SELECT MAX(id) FROM caja_turnos WHERE estado = 'abierta')
+        ''',
+        # El índice único parcial hace atómica la apertura de caja (ver EstadoTurno.abrir)
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS caja_turnos_una_abierta
+        ON caja_turnos ((estado)) WHERE estado = 'abierta'
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_caja_turnos_fecha_apertura ON caja_turnos (fecha_apertura DESC)',
+    ]),
+    (2, 'Índices de órdenes e items', [
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_estado ON ordenes (estado)',
+        # Órdenes abiertas de la caja y de los mozos, ya ordenadas por apertura
+        '''
+        CREATE INDEX IF NOT EXISTS idx_ordenes_abiertas
+        ON ordenes (fecha_apertura DESC) WHERE estado = 'abierta'
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_fecha_cierre ON ordenes (fecha_cierre)',
+        'CREATE INDEX IF NOT EXISTS idx_orden_items_orden ON orden_items (orden_id)',
+        # Items que la cocina todavía tiene que preparar
+        '''
+        CREATE INDEX IF NOT EXISTS idx_orden_items_pendientes
+        ON orden_items (orden_id, estado_item) WHERE estado_item IN ('pendiente', 'proceso')
+        ''',
+    ]),
+    (3, 'Índices de productos', [
+        'CREATE INDEX IF NOT EXISTS idx_productos_nombre ON productos (nombre, id)',
+        'CREATE INDEX IF NOT EXISTS idx_productos_categoria ON productos (categoria_id)',
+    ]),
+    (4, 'Secuencia de modificación de órdenes', [
+        # Número de una secuencia (sin fila contador que serialice las escrituras de órdenes) y id
+        # de la transacción que escribió: el cursor de /api/ordenes_activas?since=N es el horizonte
+        # xmin del snapshot de quien lee, seguro aunque los commits lleguen en otro orden
+        'CREATE SEQUENCE IF NOT EXISTS ordenes_modificado_seq',
+        'ALTER TABLE ordenes ADD COLUMN IF NOT EXISTS modificado_seq BIGINT NOT NULL DEFAULT 0',
+        "ALTER TABLE ordenes ADD COLUMN IF NOT EXISTS modificado_xid xid8 NOT NULL DEFAULT '0'",
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_modificado_xid ON ordenes (modificado_xid)',
+        '''
+        CREATE TABLE IF NOT EXISTS ordenes_eliminadas (
+            orden_id INTEGER PRIMARY KEY,
+            modificado_xid xid8 NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_eliminadas_xid ON ordenes_eliminadas (modificado_xid)',
+        # Al cerrar caja se podan las bajas anteriores a este horizonte; un cursor menor ya no
+        # puede recibir sus bajas y recarga la lista completa
+        'ALTER TABLE caja_turnos ADD COLUMN IF NOT EXISTS horizonte_ordenes BIGINT',
+        '''
+        CREATE OR REPLACE FUNCTION siguiente_seq_ordenes() RETURNS BIGINT AS $$
+            SELECT nextval('ordenes_modificado_seq')
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION marcar_orden_modificada() RETURNS trigger AS $$
+        BEGIN
+            NEW.modificado_seq := siguiente_seq_ordenes();
+            NEW.modificado_xid := pg_current_xact_id();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS ordenes_modificada ON ordenes',
+        '''
+        CREATE TRIGGER ordenes_modificada BEFORE INSERT OR UPDATE ON ordenes
+        FOR EACH ROW EXECUTE FUNCTION marcar_orden_modificada()
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION registrar_orden_eliminada() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO ordenes_eliminadas (orden_id, modificado_xid)
+            VALUES (OLD.id, pg_current_xact_id())
+            ON CONFLICT (orden_id) DO UPDATE SET modificado_xid = EXCLUDED.modificado_xid;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS ordenes_eliminada ON ordenes',
+        '''
+        CREATE TRIGGER ordenes_eliminada AFTER DELETE ON ordenes
+        FOR EACH ROW EXECUTE FUNCTION registrar_orden_eliminada()
+        ''',
+        # Un cambio en los items cambia la orden (total, cantidad de items): una vez por sentencia
+        '''
+        CREATE OR REPLACE FUNCTION marcar_ordenes_de_items() RETURNS trigger AS $$
+        BEGIN
+            UPDATE ordenes SET modificado_seq = modificado_seq
+            WHERE id IN (SELECT DISTINCT orden_id FROM filas);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS orden_items_insert ON orden_items',
+        '''
+        CREATE TRIGGER orden_items_insert AFTER INSERT ON orden_items
+        REFERENCING NEW TABLE AS filas
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_ordenes_de_items()
+        ''',
+        'DROP TRIGGER IF EXISTS orden_items_update ON orden_items',
+        '''
+        CREATE TRIGGER orden_items_update AFTER UPDATE ON orden_items
+        REFERENCING NEW TABLE AS filas
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_ordenes_de_items()
+        ''',
+        'DROP TRIGGER IF EXISTS orden_items_delete ON orden_items',
+        '''
+        CREATE TRIGGER orden_items_delete AFTER DELETE ON orden_items
+        REFERENCING OLD TABLE AS filas
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_ordenes_de_items()
+        ''',
+    ]),
+    (5, 'Búsqueda de productos por prefijo de palabra', [
+        # Nombre sin mayúsculas ni acentos, en minúsculas y mayúsculas por si la base usa locale C
+        f'''
+        ALTER TABLE productos ADD COLUMN IF NOT EXISTS busqueda tsvector
+        GENERATED ALWAYS AS (to_tsvector('spanish', {SQL_NORMALIZAR_NOMBRE})) STORED
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_productos_busqueda ON productos USING GIN (busqueda)',
+    ]),
+    (6, 'Paginación de productos por categoría', [
+        # Keyset (nombre, id) dentro de una categoría; reemplaza al índice solo por categoría
+        'CREATE INDEX IF NOT EXISTS idx_productos_categoria_nombre ON productos (categoria_id, nombre, id)',
+        'DROP INDEX IF EXISTS idx_productos_categoria',
+    ]),
+    (7, 'Bus de eventos entre workers', [
+        # Numeración global de los eventos de cocina (la comparten todos los workers)
+        'CREATE SEQUENCE IF NOT EXISTS bus_eventos_seq',
+        # Mensajes que no entran en un NOTIFY (límite de 8000 bytes)
+        '''
+        CREATE TABLE IF NOT EXISTS bus_mensajes (
+            id BIGSERIAL PRIMARY KEY,
+            payload TEXT NOT NULL,
+            creado_en TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        ''',
+    ]),
+    (8, 'Índice de órdenes activas', [
+        # Mismo predicado que usan cocina y /api/ordenes_activas: sin esto recorren toda la historia
+        "CREATE INDEX IF NOT EXISTS idx_ordenes_activas ON ordenes (fecha_apertura) WHERE estado NOT IN ('cerrada', 'cancelada')",
+    ]),
+    (9, 'Totales de órdenes mantenidos por trigger', [
+        'ALTER TABLE ordenes ADD COLUMN IF NOT EXISTS cantidad_items INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE ordenes ADD COLUMN IF NOT EXISTS items_pendientes INTEGER NOT NULL DEFAULT 0',
+        # Cada sentencia sobre orden_items suma a su orden la diferencia (nuevas - viejas) de total,
+        # items e items pendientes de cocina. Al ser sumas, dos sentencias concurrentes sobre la
+        # misma orden no se pisan. El UPDATE también marca la orden como modificada
+        # (reemplaza a marcar_ordenes_de_items). Los items 'cancelado' no suman al total.
+        '''
+        CREATE OR REPLACE FUNCTION aplicar_delta_items() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE ordenes o
+                SET total = COALESCE(o.total, 0) + d.total,
+                    cantidad_items = o.cantidad_items + d.items,
+                    items_pendientes = o.items_pendientes + d.pendientes
+                FROM (
+                    SELECT orden_id,
+                           SUM(CASE WHEN estado_item = 'cancelado' THEN 0 ELSE cantidad * precio_unitario END) AS total,
+                           COUNT(*) FILTER (WHERE estado_item IS DISTINCT FROM 'cancelado') AS items,
+                           COUNT(*) FILTER (WHERE COALESCE(estado_item, 'pendiente') IN ('pendiente', 'proceso')) AS pendientes
+                    FROM nuevas GROUP BY orden_id
+                ) d
+                WHERE o.id = d.orden_id;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE ordenes o
+                SET total = COALESCE(o.total, 0) - d.total,
+                    cantidad_items = o.cantidad_items - d.items,
+                    items_pendientes = o.items_pendientes - d.pendientes
+                FROM (
+                    SELECT orden_id,
+                           SUM(CASE WHEN estado_item = 'cancelado' THEN 0 ELSE cantidad * precio_unitario END) AS total,
+                           COUNT(*) FILTER (WHERE estado_item IS DISTINCT FROM 'cancelado') AS items,
+                           COUNT(*) FILTER (WHERE COALESCE(estado_item, 'pendiente') IN ('pendiente', 'proceso')) AS pendientes
+                    FROM viejas GROUP BY orden_id
+                ) d
+                WHERE o.id = d.orden_id;
+            ELSE
+                UPDATE ordenes o
+                SET total = COALESCE(o.total, 0) + d.total,
+                    cantidad_items = o.cantidad_items + d.items,
+                    items_pendientes = o.items_pendientes + d.pendientes
+                FROM (
+                    SELECT orden_id, SUM(total) AS total, SUM(items) AS items, SUM(pendientes) AS pendientes
+                    FROM (
+                        SELECT orden_id,
+                               CASE WHEN estado_item = 'cancelado' THEN 0 ELSE cantidad * precio_unitario END AS total,
+                               (estado_item IS DISTINCT FROM 'cancelado')::int AS items,
+                               (COALESCE(estado_item, 'pendiente') IN ('pendiente', 'proceso'))::int AS pendientes
+                        FROM nuevas
+                        UNION ALL
+                        SELECT orden_id,
+                               -(CASE WHEN estado_item = 'cancelado' THEN 0 ELSE cantidad * precio_unitario END),
+                               -(estado_item IS DISTINCT FROM 'cancelado')::int,
+                               -(COALESCE(estado_item, 'pendiente') IN ('pendiente', 'proceso'))::int
+                        FROM viejas
+                    ) cambios
+                    GROUP BY orden_id
+                ) d
+                WHERE o.id = d.orden_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS orden_items_insert ON orden_items',
+        '''
+        CREATE TRIGGER orden_items_insert AFTER INSERT ON orden_items
+        REFERENCING NEW TABLE AS nuevas
+        FOR EACH STATEMENT EXECUTE FUNCTION aplicar_delta_items()
+        ''',
+        'DROP TRIGGER IF EXISTS orden_items_update ON orden_items',
+        '''
+        CREATE TRIGGER orden_items_update AFTER UPDATE ON orden_items
+        REFERENCING OLD TABLE AS viejas NEW TABLE AS nuevas
+        FOR EACH STATEMENT EXECUTE FUNCTION aplicar_delta_items()
+        ''',
+        'DROP TRIGGER IF EXISTS orden_items_delete ON orden_items',
+        '''
+        CREATE TRIGGER orden_items_delete AFTER DELETE ON orden_items
+        REFERENCING OLD TABLE AS viejas
+        FOR EACH STATEMENT EXECUTE FUNCTION aplicar_delta_items()
+        ''',
+        'DROP FUNCTION IF EXISTS marcar_ordenes_de_items()',
+        # Punto de partida: recalcular una vez desde los items
+        '''
+        UPDATE ordenes o
+        SET total = d.total, cantidad_items = d.items, items_pendientes = d.pendientes
+        FROM (
+            SELECT orden_id,
+                   SUM(CASE WHEN estado_item = 'cancelado' THEN 0 ELSE cantidad * precio_unitario END) AS total,
+                   COUNT(*) FILTER (WHERE estado_item IS DISTINCT FROM 'cancelado') AS items,
+                   COUNT(*) FILTER (WHERE COALESCE(estado_item, 'pendiente') IN ('pendiente', 'proceso')) AS pendientes
+            FROM orden_items GROUP BY orden_id
+        ) d
+        WHERE o.id = d.orden_id
+          AND (o.total IS DISTINCT FROM d.total OR o.cantidad_items <> d.items OR o.items_pendientes <> d.pendientes)
+        ''',
+    ]),
+    (10, 'Acumulados del turno de caja', [
+        'ALTER TABLE ordenes ADD COLUMN IF NOT EXISTS turno_id INTEGER REFERENCES caja_turnos(id) ON DELETE SET NULL',
+        'ALTER TABLE ordenes ADD COLUMN IF NOT EXISTS metodo_pago VARCHAR(20)',
+        'ALTER TABLE ordenes ADD COLUMN IF NOT EXISTS propina DECIMAL(10,2) NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_turno ON ordenes (turno_id)',
+        # Se actualizan en la misma transacción que cada cobro o cancelación (ver cobrar_orden)
+        '''
+        ALTER TABLE caja_turnos
+            ADD COLUMN IF NOT EXISTS cantidad_ventas INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS ventas_efectivo DECIMAL(12,2) NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS ventas_tarjeta DECIMAL(12,2) NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS ventas_transferencia DECIMAL(12,2) NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS ventas_mercadopago DECIMAL(12,2) NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS propinas DECIMAL(12,2) NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS propinas_efectivo DECIMAL(12,2) NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS cantidad_cancelaciones INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS monto_cancelado DECIMAL(12,2) NOT NULL DEFAULT 0
+        ''',
+        '''
+        ALTER TABLE cierres_caja
+            ADD COLUMN IF NOT EXISTS monto_mercadopago DECIMAL(10,2),
+            ADD COLUMN IF NOT EXISTS propinas DECIMAL(10,2),
+            ADD COLUMN IF NOT EXISTS cantidad_ventas INTEGER
+        ''',
+        # El turno abierto arranca con las órdenes ya cerradas desde su apertura (sin medio de pago)
+        '''
+        UPDATE ordenes o SET turno_id = t.id
+        FROM caja_turnos t
+        WHERE t.estado = 'abierta' AND o.turno_id IS NULL
+          AND o.estado = 'cerrada' AND o.fecha_cierre >= t.fecha_apertura
+        ''',
+        '''
+        UPDATE caja_turnos t
+        SET cantidad_ventas = v.cantidad, total_ventas = v.total
+        FROM (
+            SELECT turno_id, COUNT(*) AS cantidad, COALESCE(SUM(total), 0) AS total
+            FROM ordenes WHERE estado = 'cerrada' AND turno_id IS NOT NULL
+            GROUP BY turno_id
+        ) v
+        WHERE t.id = v.turno_id AND t.estado = 'abierta'
+        ''',
+    ]),
+    (11, 'Resúmenes de ventas por día, hora, producto y mozo', [
+        'CREATE INDEX IF NOT EXISTS idx_ordenes_cerradas_fecha ON ordenes (fecha_cierre) WHERE estado = \'cerrada\'',
+        '''
+        CREATE TABLE IF NOT EXISTS ventas_diarias (
+            fecha DATE PRIMARY KEY,
+            ordenes INTEGER NOT NULL DEFAULT 0,
+            total DECIMAL(14,2) NOT NULL DEFAULT 0,
+            propinas DECIMAL(14,2) NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ventas_por_hora (
+            fecha DATE NOT NULL,
+            hora SMALLINT NOT NULL,
+            ordenes INTEGER NOT NULL DEFAULT 0,
+            total DECIMAL(14,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, hora)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ventas_por_producto (
+            fecha DATE NOT NULL,
+            producto_id INTEGER NOT NULL,
+            producto_nombre VARCHAR(200) NOT NULL,
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            total DECIMAL(14,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, producto_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ventas_por_mozo (
+            fecha DATE NOT NULL,
+            mozo_nombre VARCHAR(100) NOT NULL,
+            ordenes INTEGER NOT NULL DEFAULT 0,
+            total DECIMAL(14,2) NOT NULL DEFAULT 0,
+            propinas DECIMAL(14,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, mozo_nombre)
+        )
+        ''',
+        # Suma (signo 1) o resta (signo -1) una orden cobrada en los resúmenes por día, hora y mozo.
+        # La fecha y la hora son las del cobro (fecha_cierre).
+        '''
+        CREATE OR REPLACE FUNCTION acumular_venta(p_orden INTEGER, p_cierre TIMESTAMP, p_total NUMERIC,
+                                                  p_propina NUMERIC, p_mozo VARCHAR, p_signo INTEGER)
+        RETURNS void AS $$
+        BEGIN
+            IF p_cierre IS NULL THEN
+                RETURN;
+            END IF;
+            INSERT INTO ventas_diarias AS v (fecha, ordenes, total, propinas)
+            VALUES (p_cierre::date, p_signo, p_signo * COALESCE(p_total, 0), p_signo * COALESCE(p_propina, 0))
+            ON CONFLICT (fecha) DO UPDATE
+            SET ordenes = v.ordenes + EXCLUDED.ordenes, total = v.total + EXCLUDED.total,
+                propinas = v.propinas + EXCLUDED.propinas;
+
+            INSERT INTO ventas_por_hora AS v (fecha, hora, ordenes, total)
+            VALUES (p_cierre::date, EXTRACT(HOUR FROM p_cierre), p_signo, p_signo * COALESCE(p_total, 0))
+            ON CONFLICT (fecha, hora) DO UPDATE
+            SET ordenes = v.ordenes + EXCLUDED.ordenes, total = v.total + EXCLUDED.total;
+
+            INSERT INTO ventas_por_mozo AS v (fecha, mozo_nombre, ordenes, total, propinas)
+            VALUES (p_cierre::date, COALESCE(p_mozo, ''), p_signo, p_signo * COALESCE(p_total, 0),
+                    p_signo * COALESCE(p_propina, 0))
+            ON CONFLICT (fecha, mozo_nombre) DO UPDATE
+            SET ordenes = v.ordenes + EXCLUDED.ordenes, total = v.total + EXCLUDED.total,
+                propinas = v.propinas + EXCLUDED.propinas;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        # Los productos de una orden se mueven solo cuando entra o sale de 'cerrada' (o cambia su
+        # fecha de cobro); las correcciones de items de una orden cobrada las lleva ventas_de_items
+        '''
+        CREATE OR REPLACE FUNCTION acumular_productos(p_orden INTEGER, p_cierre TIMESTAMP, p_signo INTEGER)
+        RETURNS void AS $$
+        BEGIN
+            IF p_cierre IS NULL THEN
+                RETURN;
+            END IF;
+            INSERT INTO ventas_por_producto AS v (fecha, producto_id, producto_nombre, cantidad, total)
+            SELECT p_cierre::date, COALESCE(producto_id, 0), MAX(producto_nombre),
+                   p_signo * SUM(cantidad), p_signo * SUM(cantidad * precio_unitario)
+            FROM orden_items
+            WHERE orden_id = p_orden AND estado_item IS DISTINCT FROM 'cancelado'
+            GROUP BY COALESCE(producto_id, 0)
+            ON CONFLICT (fecha, producto_id) DO UPDATE
+            SET producto_nombre = EXCLUDED.producto_nombre, cantidad = v.cantidad + EXCLUDED.cantidad,
+                total = v.total + EXCLUDED.total;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION ventas_de_orden() RETURNS trigger AS $$
+        DECLARE
+            v_productos BOOLEAN := TG_OP <> 'UPDATE'
+                OR OLD.estado IS DISTINCT FROM NEW.estado OR OLD.fecha_cierre IS DISTINCT FROM NEW.fecha_cierre;
+        BEGIN
+            IF TG_OP <> 'INSERT' AND OLD.estado = 'cerrada' THEN
+                PERFORM acumular_venta(OLD.id, OLD.fecha_cierre, OLD.total, OLD.propina, OLD.mozo_nombre, -1);
+                IF v_productos THEN
+                    PERFORM acumular_productos(OLD.id, OLD.fecha_cierre, -1);
+                END IF;
+            END IF;
+            IF TG_OP <> 'DELETE' AND NEW.estado = 'cerrada' THEN
+                PERFORM acumular_venta(NEW.id, NEW.fecha_cierre, NEW.total, NEW.propina, NEW.mozo_nombre, 1);
+                IF v_productos THEN
+                    PERFORM acumular_productos(NEW.id, NEW.fecha_cierre, 1);
+                END IF;
+                RETURN NEW;
+            END IF;
+            RETURN CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        # Al cobrar (o corregir una orden cobrada) se suma en la misma transacción. Los triggers de
+        # items hacen UPDATE de total en cada sentencia: si no cambió nada, no llega a los resúmenes
+        '''
+        CREATE TRIGGER ordenes_ventas_update
+        AFTER UPDATE OF estado, total, propina, fecha_cierre, mozo_nombre ON ordenes
+        FOR EACH ROW WHEN ((OLD.estado = 'cerrada' OR NEW.estado = 'cerrada')
+            AND (OLD.estado, OLD.total, OLD.propina, OLD.fecha_cierre, OLD.mozo_nombre)
+                IS DISTINCT FROM (NEW.estado, NEW.total, NEW.propina, NEW.fecha_cierre, NEW.mozo_nombre))
+        EXECUTE FUNCTION ventas_de_orden()
+        ''',
+        '''
+        CREATE TRIGGER ordenes_ventas_insert
+        AFTER INSERT ON ordenes
+        FOR EACH ROW WHEN (NEW.estado = 'cerrada')
+        EXECUTE FUNCTION ventas_de_orden()
+        ''',
+        # BEFORE para que los items todavía existan (el ON DELETE CASCADE corre después)
+        '''
+        CREATE TRIGGER ordenes_ventas_delete
+        BEFORE DELETE ON ordenes
+        FOR EACH ROW WHEN (OLD.estado = 'cerrada')
+        EXECUTE FUNCTION ventas_de_orden()
+        ''',
+        # Items de órdenes cobradas: por sentencia, resta los valores viejos (tabla de transición)
+        # y suma los nuevos. Con la orden ya borrada (cascada) el JOIN no encuentra nada
+        '''
+        CREATE OR REPLACE FUNCTION ventas_de_items() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                INSERT INTO ventas_por_producto AS v (fecha, producto_id, producto_nombre, cantidad, total)
+                SELECT o.fecha_cierre::date, COALESCE(i.producto_id, 0), MAX(i.producto_nombre),
+                       -SUM(i.cantidad), -SUM(i.cantidad * i.precio_unitario)
+                FROM viejas i
+                JOIN ordenes o ON o.id = i.orden_id
+                WHERE o.estado = 'cerrada' AND o.fecha_cierre IS NOT NULL
+                  AND i.estado_item IS DISTINCT FROM 'cancelado'
+                GROUP BY 1, 2
+                ON CONFLICT (fecha, producto_id) DO UPDATE
+                SET cantidad = v.cantidad + EXCLUDED.cantidad, total = v.total + EXCLUDED.total;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO ventas_por_producto AS v (fecha, producto_id, producto_nombre, cantidad, total)
+                SELECT o.fecha_cierre::date, COALESCE(i.producto_id, 0), MAX(i.producto_nombre),
+                       SUM(i.cantidad), SUM(i.cantidad * i.precio_unitario)
+                FROM nuevas i
+                JOIN ordenes o ON o.id = i.orden_id
+                WHERE o.estado = 'cerrada' AND o.fecha_cierre IS NOT NULL
+                  AND i.estado_item IS DISTINCT FROM 'cancelado'
+                GROUP BY 1, 2
+                ON CONFLICT (fecha, producto_id) DO UPDATE
+                SET producto_nombre = EXCLUDED.producto_nombre, cantidad = v.cantidad + EXCLUDED.cantidad,
+                    total = v.total + EXCLUDED.total;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER orden_items_ventas_insert AFTER INSERT ON orden_items
+        REFERENCING NEW TABLE AS nuevas
+        FOR EACH STATEMENT EXECUTE FUNCTION ventas_de_items()
+        ''',
+        '''
+        CREATE TRIGGER orden_items_ventas_update AFTER UPDATE ON orden_items
+        REFERENCING OLD TABLE AS viejas NEW TABLE AS nuevas
+        FOR EACH STATEMENT EXECUTE FUNCTION ventas_de_items()
+        ''',
+        '''
+        CREATE TRIGGER orden_items_ventas_delete AFTER DELETE ON orden_items
+        REFERENCING OLD TABLE AS viejas
+        FOR EACH STATEMENT EXECUTE FUNCTION ventas_de_items()
+        ''',
+        # Reconstrucción de un rango de días desde las órdenes (NULL = sin límite): para cargas que
+        # no pasan por los triggers y como job de control (flask --app app2 roka resumir-ventas)
+        '''
+        CREATE OR REPLACE FUNCTION resumir_ventas(p_desde DATE, p_hasta DATE) RETURNS INTEGER AS $$
+        DECLARE
+            v_desde TIMESTAMP := COALESCE(p_desde, '-infinity'::date);
+            v_hasta TIMESTAMP := COALESCE(p_hasta + 1, 'infinity'::date);
+            v_dias INTEGER;
+        BEGIN
+            DELETE FROM ventas_diarias WHERE fecha >= v_desde AND fecha < v_hasta;
+            DELETE FROM ventas_por_hora WHERE fecha >= v_desde AND fecha < v_hasta;
+            DELETE FROM ventas_por_mozo WHERE fecha >= v_desde AND fecha < v_hasta;
+            DELETE FROM ventas_por_producto WHERE fecha >= v_desde AND fecha < v_hasta;
+
+            INSERT INTO ventas_diarias (fecha, ordenes, total, propinas)
+            SELECT fecha_cierre::date, COUNT(*), COALESCE(SUM(total), 0), COALESCE(SUM(propina), 0)
+            FROM ordenes
+            WHERE estado = 'cerrada' AND fecha_cierre >= v_desde AND fecha_cierre < v_hasta
+            GROUP BY 1;
+            GET DIAGNOSTICS v_dias = ROW_COUNT;
+
+            INSERT INTO ventas_por_hora (fecha, hora, ordenes, total)
+            SELECT fecha_cierre::date, EXTRACT(HOUR FROM fecha_cierre), COUNT(*), COALESCE(SUM(total), 0)
+            FROM ordenes
+            WHERE estado = 'cerrada' AND fecha_cierre >= v_desde AND fecha_cierre < v_hasta
+            GROUP BY 1, 2;
+
+            INSERT INTO ventas_por_mozo (fecha, mozo_nombre, ordenes, total, propinas)
+            SELECT fecha_cierre::date, COALESCE(mozo_nombre, ''), COUNT(*), COALESCE(SUM(total), 0),
+                   COALESCE(SUM(propina), 0)
+            FROM ordenes
+            WHERE estado = 'cerrada' AND fecha_cierre >= v_desde AND fecha_cierre < v_hasta
+            GROUP BY 1, 2;
+
+            INSERT INTO ventas_por_producto (fecha, producto_id, producto_nombre, cantidad, total)
+            SELECT o.fecha_cierre::date, COALESCE(i.producto_id, 0), MAX(i.producto_nombre),
+                   SUM(i.cantidad), SUM(i.cantidad * i.precio_unitario)
+            FROM ordenes o
+            JOIN orden_items i ON i.orden_id = o.id
+            WHERE o.estado = 'cerrada' AND o.fecha_cierre >= v_desde AND o.fecha_cierre < v_hasta
+              AND i.estado_item IS DISTINCT FROM 'cancelado'
+            GROUP BY 1, 2;
+            RETURN v_dias;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'SELECT resumir_ventas(NULL, NULL)',
+    ]),
+    (12, 'Reservas de stock', [
+        # Disponible = stock - stock_reservado. Los items no cancelados de las órdenes activas
+        # reservan; el cobro descuenta el stock y la reserva juntos; cancelar o eliminar la orden
+        # libera la reserva.
+        'ALTER TABLE productos ADD COLUMN IF NOT EXISTS stock_reservado INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE productos ADD COLUMN IF NOT EXISTS stock_minimo INTEGER',
+        '''
+        UPDATE productos p SET stock_reservado = r.cantidad
+        FROM (
+            SELECT i.producto_id, SUM(i.cantidad) AS cantidad
+            FROM orden_items i JOIN ordenes o ON o.id = i.orden_id
+            WHERE o.estado NOT IN ('cerrada', 'cancelada') AND i.estado_item IS DISTINCT FROM 'cancelado'
+            GROUP BY i.producto_id
+        ) r
+        WHERE p.id = r.producto_id AND p.stock IS NOT NULL AND COALESCE(p.tipo, 'producto') <> 'comida'
+        ''',
+    ]),
+]
+
+# Clave del advisory lock que serializa a los workers que migran al mismo tiempo
+MIGRACIONES_LOCK = 7261001
+
+def version_esquema(cur):
+    """Versión aplicada del esquema (0 si todavía no hay tabla schema_version)"""
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    return cur.fetchone()[0]
+
+def aplicar_migraciones(conn):
+    """Aplica las migraciones pendientes. Devuelve [(version, descripcion, segundos)]"""
+    cur = conn.cursor()
+    aplicadas = []
+    try:
+        cur.execute('SELECT pg_advisory_lock(%s)', (MIGRACIONES_LOCK,))
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                descripcion VARCHAR(200) NOT NULL,
+                duracion_ms DECIMAL(10,2),
+                aplicada_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+        
+        actual = version_esquema(cur)
+        for version, descripcion, sentencias in MIGRACIONES:
+            if version <= actual:
+                continue
+            inicio = time.perf_counter()
+            try:
+                for sentencia in sentencias:
+                    cur.execute(sentencia)
+                duracion = time.perf_counter() - inicio
+                cur.execute('INSERT INTO schema_version (version, descripcion, duracion_ms) VALUES (%s, %s, %s)',
+                           (version, descripcion, round(duracion * 1000, 2)))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                log.error('Falló la migración', extra={'campos': {'version': version, 'descripcion': descripcion}})
+                raise
+            log.info('Migración aplicada', extra={'campos': {'version': version, 'descripcion': descripcion, 'ms': round(duracion * 1000, 1)}})
+            aplicadas.append((version, descripcion, duracion))
+    finally:
+        try:
+            cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRACIONES_LOCK,))
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+        cur.close()
+    return aplicadas
+
+# ==============================
+# INICIALIZACIÓN DE BASE DE DATOS (CLI) Y ARRANQUE RÁPIDO
+# ==============================
+# El DDL y la carga inicial se ejecutan una vez por deploy con `flask --app app2 roka init-db`
+# (o un admin desde /crear-tablas). Cada worker solo compara la versión del esquema al arrancar.
+roka_cli = AppGroup('roka', help='Comandos de administración de ROKA')
+app.cli.add_command(roka_cli)
+
+@roka_cli.command('init-db')
+def init_db_command():
+    """Crea las tablas, aplica las migraciones pendientes y carga los datos iniciales"""
+    inicio = time.perf_counter()
+    if not create_tables():
+        raise click.ClickException('No se pudo inicializar la base de datos')
+    click.echo(f"✅ Base de datos inicializada en {(time.perf_counter() - inicio) * 1000:.1f} ms")
+
+@roka_cli.command('resumir-ventas')
+@click.option('--desde', type=click.DateTime(formats=['%Y-%m-%d']), help='primer día (por defecto, toda la historia)')
+@click.option('--hasta', type=click.DateTime(formats=['%Y-%m-%d']), help='último día inclusive')
+def resumir_ventas_command(desde, hasta):
+    """Reconstruye los resúmenes de ventas de un rango de días desde las órdenes cobradas"""
+    inicio = time.perf_counter()
+    conn = abrir_conexion_nueva()
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT resumir_ventas(%s, %s)', (desde.date() if desde else None, hasta.date() if hasta else None))
+        dias = cur.fetchone()[0]
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+    click.echo(f"✅ {dias} días resumidos en {(time.perf_counter() - inicio) * 1000:.1f} ms")
+
+def verificar_esquema():
+    """Devuelve (version_aplicada, ultima_version) con una sola consulta barata"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        return version_esquema(cur), MIGRACIONES[-1][0]
+    finally:
+        cur.close()
+        conn.close()
+
+ESTADO_ARRANQUE = {'segundos': None, 'verificacion_esquema_segundos': None, 'version_esquema': None}
+
+# Importar el módulo no abre conexiones ni hilos: con gunicorn --preload el import corre en el
+# proceso maestro y lo abierto ahí lo heredarían todos los workers después del fork. Cada proceso
+# arranca en su primer request o conexión de Socket.IO, y el pid detecta un fork posterior.
+_arranque_pid = None
+_arranque_lock = threading.Lock()
+
+def arrancar_worker():
+    """Verifica el esquema, precalienta el pool y el catálogo y arranca el bus, una vez por proceso"""
+    global _arranque_pid
+    if _arranque_pid == os.getpid():
+        return
+    with _arranque_lock:
+        if _arranque_pid == os.getpid():
+            return
+        inicio = time.perf_counter()
+        try:
+            version, ultima = verificar_esquema()
+            ESTADO_ARRANQUE['verificacion_esquema_segundos'] = time.perf_counter() - inicio
+            if version < ultima and os.environ.get("ROKA_AUTO_MIGRAR") == "1":
+                log.info('Migrando esquema', extra={'campos': {'version': version, 'ultima': ultima}})
+                if create_tables():
+                    version = ultima
+            ESTADO_ARRANQUE['version_esquema'] = version
+            if version >= ultima:
+                # Precalentar el catálogo (y el mapa de códigos de barras) para que el primer
+                # escaneo no espere
+                catalogo.foto()
+            else:
+                log.warning("Esquema desactualizado: ejecutar 'flask --app app2 roka init-db'",
+                            extra={'campos': {'version': version, 'ultima': ultima}})
+        except Exception:
+            log.exception('Error durante inicialización')
+        bus.iniciar()
+        _arranque_pid = os.getpid()
+        log.info('Worker listo', extra={'campos': {'pid': _arranque_pid,
+                                                   'ms': round((time.perf_counter() - inicio) * 1000, 1)}})
+
+@app.before_request
+def arrancar_en_primer_request():
+    arrancar_worker()
 
 # ==============================
 # WEBSOCKETS GENERALES
 # ==============================
 @socketio.on('connect')
+@instrumentar_socket
 def handle_connect():
-    print(f'✅ Cliente conectado: {request.sid}')
+    arrancar_worker()
+    log.debug('Cliente conectado')
     emit('connection_response', {'status': 'connected', 'sid': request.sid})
 
 @socketio.on('disconnect')
+@instrumentar_socket
 def handle_disconnect():
-    print(f'❌ Cliente desconectado: {request.sid}')
+    log.debug('Cliente desconectado')
 
 # ==============================
 # WEBSOCKETS ESPECÍFICOS PARA CHEF
 # ==============================
 @socketio.on('connect', namespace='/chef')
+@instrumentar_socket
 def handle_connect_chef():
-    print(f'👨‍🍳 Chef conectado: {request.sid}')
+    arrancar_worker()
+    log.debug('Chef conectado')
     emit('connection_response', {'status': 'connected', 'rol': 'chef', 'message': 'Conexión establecida con cocina'}, namespace='/chef')
 
 @socketio.on('disconnect', namespace='/chef')
+@instrumentar_socket
 def handle_disconnect_chef():
-    print(f'👨‍🍳 Chef desconectado: {request.sid}')
+    log.debug('Chef desconectado')
 
 @socketio.on('join_chef', namespace='/chef')
+@instrumentar_socket
 def handle_join_chef(data):
     usuario_id = data.get('usuario_id', 'invitado')
-    print(f'👨‍🍳 Chef se unió al namespace cocina (Usuario: {usuario_id})')
+    log.info('Chef se unió a cocina', extra={'campos': {'usuario_id': usuario_id}})
     emit('join_response', {'status': 'joined', 'rol': 'chef', 'message': 'Bienvenido a la cocina'}, namespace='/chef')
 
+@socketio.on('sincronizar_cocina', namespace='/chef')
+@instrumentar_socket
+def handle_sincronizar_cocina(data):
+    """Pantalla que se reconecta: devuelve los eventos posteriores a su último seq"""
+    data = data or {}
+    eventos = None
+    if data.get('epoca') == eventos_cocina.epoca:
+        eventos = eventos_cocina.desde(int(data.get('desde_seq') or 0))
+    if eventos is None:
+        # Otro arranque del servidor o el buffer ya no tiene esos eventos: recargar todo
+        emit('sincronizacion_cocina', {'reiniciar': True, 'epoca': eventos_cocina.epoca}, namespace='/chef')
+    else:
+        emit('sincronizacion_cocina', {'reiniciar': False, 'epoca': eventos_cocina.epoca, 'eventos': eventos}, namespace='/chef')
+
 # ==============================
-# FUNCIONES DE AUTENTICACIÓN
+# BUS DE EVENTOS ENTRE WORKERS
 # ==============================
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+# Con un solo proceso (ROKA_BUS=local, por defecto) los mensajes se entregan en el momento.
+# Con varios workers, ROKA_BUS=postgres los reparte con LISTEN/NOTIFY sin servicios extra:
+# cada worker escucha el canal y emite por Socket.IO a los clientes conectados a él.
+BUS_CANAL = 'roka_bus'
+BUS_LOCK_SEQ = 7261002
+BUS_MAX_PAYLOAD = 7900  # NOTIFY admite hasta 8000 bytes; lo que no entra va por bus_mensajes
 
-def verify_password(password, password_hash):
-    return hash_password(password) == password_hash
+class BusEventos:
+    """Reparte mensajes a todos los procesos de la aplicación, incluido el que publica.
 
-def login_user(username, password):
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT id, username, password_hash, nombre, rol FROM usuarios WHERE username = %s AND activo = true', (username,))
-        usuario = cur.fetchone()
-        if usuario and verify_password(password, usuario[2]):
-            return {'id': usuario[0], 'username': usuario[1], 'nombre': usuario[3], 'rol': usuario[4]}
-        return None
-    except Exception as e:
-        print(f"❌ Error específico en login: {e}")
-        if "relation" in str(e) and "usuarios" in str(e):
-            print("ℹ️  La tabla 'usuarios' no existe. Necesitas crear las tablas primero.")
-        return None
-    finally:
-        try:
-            cur.close()
-            conn.close()
-        except:
-            pass
+    Los manejadores reciben (datos, seq, propio): seq solo viene en los mensajes numerados y
+    propio indica si el mensaje lo publicó este mismo proceso."""
 
-def get_usuario_actual():
-    if 'user_id' in session:
-        try:
+    def __init__(self, modo='local'):
+        if modo not in ('local', 'postgres'):
+            raise ValueError(f"ROKA_BUS desconocido: {modo}")
+        self.modo = modo
+        self.origen = uuid.uuid4().hex
+        self._manejadores = {}
+        self._hilo = None
+        self._conexion = None  # para publicar fuera de un request; no sale del pool
+        self._conexion_lock = threading.Lock()
+
+    @property
+    def distribuido(self):
+        return self.modo == 'postgres'
+
+    def suscribir(self, tipo):
+        def registrar(funcion):
+            self._manejadores[tipo] = funcion
+            return funcion
+        return registrar
+
+    def publicar(self, tipo, datos, numerar=False):
+        """Entrega el mensaje en todos los workers. Con numerar=True lleva un seq global
+        creciente y todos los workers lo reciben en ese orden. Llamar después del commit.
+
+        Dentro de un request el NOTIFY sale por la misma conexión del request, en una transacción
+        corta propia: nunca se pide una segunda conexión al pool en medio de un request. Si esa
+        conexión tiene una transacción abierta se rechaza la publicación, porque el commit del
+        NOTIFY confirmaría (o su rollback descartaría) el trabajo de quien llama. Fuera de un
+        request se usa una conexión dedicada del publicador."""
+        mensaje = {'tipo': tipo, 'datos': datos, 'origen': self.origen}
+        if not self.distribuido:
+            self._entregar(mensaje)
+            return
+
+        if has_app_context():
             conn = get_db_connection()
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                raise RuntimeError(f"Bus de eventos: '{tipo}' publicado con una transacción abierta")
+            self._notificar(conn, mensaje, numerar)
+            return
+        with self._conexion_lock:
+            try:
+                if self._conexion is None or self._conexion.closed:
+                    self._conexion = abrir_conexion_nueva()
+            except Exception as e:
+                log.error('Bus de eventos: no se pudo publicar', extra={'campos': {'tipo': tipo, 'error': str(e)}})
+                return
+            self._notificar(self._conexion, mensaje, numerar)
+
+    def _notificar(self, conn, mensaje, numerar):
+        try:
             cur = conn.cursor()
-            cur.execute('SELECT id, username, nombre, rol FROM usuarios WHERE id = %s', (session['user_id'],))
-            usuario = cur.fetchone()
-            if usuario:
-                return {'id': usuario[0], 'username': usuario[1], 'nombre': usuario[2], 'rol': usuario[3]}
+            if numerar:
+                # El lock se mantiene hasta el commit: el orden de los NOTIFY es el orden del seq
+                cur.execute("SELECT nextval('bus_eventos_seq') FROM (SELECT pg_advisory_xact_lock(%s)) AS bloqueo",
+                            (BUS_LOCK_SEQ,))
+                mensaje['seq'] = cur.fetchone()[0]
+            payload = json.dumps(mensaje, default=str)
+            if len(payload.encode()) > BUS_MAX_PAYLOAD:
+                cur.execute("DELETE FROM bus_mensajes WHERE creado_en < NOW() - INTERVAL '10 minutes'")
+                cur.execute("INSERT INTO bus_mensajes (payload) VALUES (%s) RETURNING id", (payload,))
+                payload = json.dumps({'ref': cur.fetchone()[0]})
+            cur.execute("SELECT pg_notify(%s, %s)", (BUS_CANAL, payload))
+            conn.commit()
+            cur.close()
         except Exception as e:
-            print(f"❌ Error obteniendo usuario: {e}")
-        finally:
+            log.error('Bus de eventos: no se pudo publicar', extra={'campos': {'tipo': mensaje['tipo'], 'error': str(e)}})
             try:
-                cur.close()
-                conn.close()
-            except:
+                conn.rollback()
+            except Exception:
                 pass
+
+    def _entregar(self, mensaje):
+        manejador = self._manejadores.get(mensaje['tipo'])
+        if manejador is None:
+            return
+        try:
+            manejador(mensaje['datos'], mensaje.get('seq'), mensaje['origen'] == self.origen)
+        except Exception:
+            log.exception('Bus de eventos: error procesando mensaje', extra={'campos': {'tipo': mensaje['tipo']}})
+
+    def iniciar(self):
+        """Arranca el hilo que escucha el canal (solo en modo distribuido)"""
+        if self.distribuido and self._hilo is None:
+            self._hilo = socketio.start_background_task(self._escuchar)
+
+    def _escuchar(self):
+        reconexion = False
+        while True:
+            conn = None
+            try:
+                conn = abrir_conexion_nueva()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {BUS_CANAL}")
+                cur.execute("SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM bus_eventos_seq")
+                self._entregar({'tipo': 'bus_conectado', 'origen': self.origen,
+                                'datos': {'seq': cur.fetchone()[0], 'reconexion': reconexion}})
+                log.info('Bus de eventos escuchando', extra={'campos': {'canal': BUS_CANAL}})
+                while True:
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        cur.execute("SELECT 1")  # detecta una conexión caída mientras no hay tráfico
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        mensaje = json.loads(conn.notifies.pop(0).payload)
+                        if 'ref' in mensaje:
+                            cur.execute("SELECT payload FROM bus_mensajes WHERE id = %s", (mensaje['ref'],))
+                            fila = cur.fetchone()
+                            if fila is None:
+                                continue
+                            mensaje = json.loads(fila[0])
+                        self._entregar(mensaje)
+            except Exception as e:
+                log.error('Bus de eventos desconectado', extra={'campos': {'error': str(e)}})
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            reconexion = True
+            socketio.sleep(2)
+
+bus = BusEventos(os.environ.get("ROKA_BUS", "local"))
+
+def avisar_invalidacion(cache, clave=None):
+    """Pide a los demás workers que olviden un caché ('usuario', 'turno' o 'catalogo').
+    Este proceso ya tiene que haberlo invalidado."""
+    bus.publicar('invalidar', {'cache': cache, 'clave': clave})
+
+def _invalidar_cache(cache, clave=None):
+    if cache == 'usuario':
+        invalidar_usuario(clave)
+    elif cache == 'turno':
+        estado_turno.invalidar()
+    elif cache == 'catalogo':
+        catalogo.invalidar()
+
+@bus.suscribir('invalidar')
+def _invalidar_desde_bus(datos, seq, propio):
+    if not propio:
+        _invalidar_cache(datos['cache'], datos.get('clave'))
+
+@bus.suscribir('bus_conectado')
+def _bus_conectado(datos, seq, propio):
+    cola_cocina.reanudar(datos['seq'])
+    if datos['reconexion']:
+        # Mientras estuvimos desconectados pudo cambiar cualquier cosa
+        for cache in ('usuario', 'turno', 'catalogo'):
+            _invalidar_cache(cache)
+
+# ==============================
+# COCINA: EVENTOS DELTA EN TIEMPO REAL
+# ==============================
+class EventosCocina:
+    """Registro en memoria de los cambios de items de cocina con número de secuencia creciente.
+
+    Las pantallas aplican cada evento sobre su estado local y, al reconectarse, piden solo lo
+    que pasó después de su último seq. Con un solo proceso la época cambia en cada arranque;
+    con el bus distribuido el seq es global (secuencia en la base) y la época es fija, así una
+    pantalla puede cargar por HTTP desde un worker y recibir los eventos por otro."""
+
+    def __init__(self, capacidad=1000, epoca=None):
+        self.epoca = epoca or str(int(time.time() * 1000))
+        self._lock = threading.Lock()
+        self._eventos = deque(maxlen=capacidad)
+        self._seq = 0
+
+    @property
+    def seq(self):
+        with self._lock:
+            return self._seq
+
+    def publicar(self, tipo, datos, seq=None):
+        with self._lock:
+            self._seq = seq if seq is not None else self._seq + 1
+            evento = dict(datos, seq=self._seq, tipo=tipo)
+            self._eventos.append(evento)
+        return evento
+
+    def reanudar(self, seq):
+        """Continúa desde el seq global del bus. Descarta el buffer: pudo haber eventos que
+        este proceso no recibió, y las pantallas que los pidan recargarán todo."""
+        with self._lock:
+            self._eventos.clear()
+            self._seq = max(self._seq, seq)
+
+    def desde(self, seq):
+        """Eventos con seq mayor al indicado, o None si el buffer ya los descartó"""
+        with self._lock:
+            if seq > self._seq:
+                return None
+            if seq == self._seq:
+                return []
+            primero = self._eventos[0]['seq'] if self._eventos else self._seq + 1
+            if seq + 1 < primero:
+                return None
+            return [e for e in self._eventos if e['seq'] > seq]
+
+eventos_cocina = EventosCocina(int(os.environ.get("COCINA_EVENTOS_BUFFER", 1000)),
+                               epoca='bus' if bus.distribuido else None)
+
+ESTADOS_ITEM = ('pendiente', 'proceso', 'listo')
+
+# Columnas de una fila orden + item de cocina, en el orden que espera _orden_item_cocina()
+COLUMNAS_ITEM_COCINA = '''
+    o.id, m.numero, o.mozo_nombre, o.total, o.fecha_apertura,
+    i.id, i.producto_id, i.producto_nombre, i.cantidad, i.precio_unitario, i.observaciones,
+    i.estado_item, i.tiempo_inicio, i.tiempo_fin, i.tiempo_estimado,
+    COALESCE((SELECT p.tipo FROM productos p WHERE p.id = i.producto_id), 'producto')
+'''
+
+def _iso(valor):
+    return valor.isoformat(timespec='seconds') if valor else None
+
+def _orden_item_cocina(f):
+    orden = {
+        'id': f[0],
+        'mesa_numero': f[1],
+        'mozo_nombre': f[2],
+        'total': float(f[3]) if f[3] else 0,
+        'fecha_apertura': _iso(f[4])
+    }
+    item = {
+        'id': f[5],
+        'producto_id': f[6],
+        'producto_nombre': f[7],
+        'cantidad': f[8],
+        'precio_unitario': float(f[9]) if f[9] else 0,
+        'observaciones': f[10] or '',
+        'estado_item': f[11] or 'pendiente',
+        'tiempo_inicio': _iso(f[12]),
+        'tiempo_fin': _iso(f[13]),
+        'tiempo_estimado': f[14],
+        'tipo': f[15]
+    }
+    return orden, item
+
+def publicar_item_cocina(tipo, orden, item):
+    """Publica un evento de item ('item_nuevo', 'item_actualizado', 'item_estado' o 'item_eliminado').
+    Llamar después del commit."""
+    avisos = []
+    if tipo == 'item_estado':
+        aviso = {
+            'item_id': item['id'],
+            'pedido_id': orden['id'],
+            'mesa_numero': orden['mesa_numero'],
+            'producto_nombre': item['producto_nombre'],
+            'nuevo_estado': item['estado_item']
+        }
+        avisos = [('cambiar_estado_item_chef', aviso, '/chef'), ('cambiar_estado_item_ws', aviso, None)]
+    bus.publicar('cocina', {'tipo': tipo, 'datos': {'orden': orden, 'item': item}, 'avisos': avisos}, numerar=True)
+
+def publicar_orden_nueva(orden, items):
+    """Una orden nueva viaja como un solo evento 'orden_nueva' con todos sus items (un seq,
+    un NOTIFY), junto con los avisos de pedido nuevo"""
+    aviso = {'pedido_id': orden['id'], 'mesa_numero': orden['mesa_numero'], 'items': len(items)}
+    avisos = [('nuevo_pedido_chef', aviso, '/chef'), ('nuevo_pedido_ws', aviso, None)]
+    bus.publicar('cocina', {'tipo': 'orden_nueva', 'datos': {'orden': orden, 'items': items}, 'avisos': avisos},
+                 numerar=True)
+
+def publicar_orden_retirada(orden_id):
+    """La orden salió de cocina (cerrada, cancelada o eliminada)"""
+    bus.publicar('cocina', {'tipo': 'orden_retirada', 'datos': {'orden': {'id': orden_id}}, 'avisos': []}, numerar=True)
+
+@bus.suscribir('cocina')
+def _evento_cocina_desde_bus(datos, seq, propio):
+    """Cada worker registra el evento en su buffer y su cola, y lo emite a sus pantallas"""
+    evento = cola_cocina.registrar(datos['tipo'], datos['datos'], seq)
+    socketio.emit('evento_cocina', evento, namespace='/chef')
+    for nombre, aviso, namespace in datos['avisos']:
+        socketio.emit(nombre, aviso, namespace=namespace)
+
+# ==============================
+# COCINA: COLA EN MEMORIA POR ESTACIÓN
+# ==============================
+# Las pantallas de cocina se sirven desde memoria: cada worker arma la cola una vez desde la base
+# y después la mantiene con los mismos eventos que recibe por el bus. Hay dos estaciones, 'cocina'
+# (productos de tipo comida) y 'barra' (bebidas y el resto). En cada estación los items en proceso
+# ocupan los puestos y los pendientes esperan por antigüedad de la orden; con eso se proyecta a qué
+# hora queda lista cada orden. COCINA_COLA_TTL acota cuánto puede vivir la cola sin releer la base.
+PUESTOS_ESTACION = {
+    'cocina': int(os.environ.get("COCINA_PUESTOS", 3)),
+    'barra': int(os.environ.get("BARRA_PUESTOS", 2))
+}
+MINUTOS_ITEM_DEFECTO = 15
+
+def estacion_item(item):
+    return 'cocina' if item.get('tipo') == 'comida' else 'barra'
+
+def _fecha_iso(valor):
+    return datetime.fromisoformat(valor) if valor else None
+
+def _filas_cocina():
+    """(orden, item) de todas las órdenes activas, como los arma _orden_item_cocina()"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(f'''
+            SELECT {COLUMNAS_ITEM_COCINA}
+            FROM ordenes o
+            JOIN mesas m ON m.id = o.mesa_id
+            JOIN orden_items i ON i.orden_id = o.id
+            WHERE o.estado NOT IN ('cerrada', 'cancelada')
+        ''')
+        return [_orden_item_cocina(f) for f in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+
+class ColaCocina:
+    """Órdenes activas de cocina con sus items, ordenadas por antigüedad y actualizadas evento a evento.
+
+    Registrar el evento en eventos_cocina y aplicarlo a la cola ocurre bajo el mismo lock, así la
+    cola siempre refleja exactamente hasta el seq que anuncia. La carga desde la base consulta sin
+    lock y después reaplica los eventos que llegaron mientras tanto (todos son idempotentes: traen
+    el item completo). Las respuestas JSON se memorizan por estación hasta el próximo cambio o
+    hasta refresco_eta segundos, para que los minutos restantes no queden viejos."""
+
+    def __init__(self, eventos, ttl=300, refresco_eta=5):
+        self.eventos = eventos
+        self.ttl = ttl
+        self.refresco_eta = refresco_eta
+        self._lock = threading.Lock()
+        self._carga_lock = threading.Lock()
+        self._ordenes = {}  # orden_id -> {'orden': dict, 'items': {item_id: item}}
+        self._claves = []   # (fecha_apertura, orden_id) en orden: la prioridad es la antigüedad
+        self._seq = 0
+        self._version = 0
+        self._cargada_en = None
+        self._vistas = {}   # estacion -> (version, expira_en, cuerpo, seq)
+
+    def registrar(self, tipo, datos, seq=None):
+        """Publica el evento en el buffer de eventos y lo aplica a la cola si está cargada"""
+        with self._lock:
+            evento = self.eventos.publicar(tipo, datos, seq)
+            if self._cargada_en is not None:
+                self._aplicar(evento)
+            return evento
+
+    def reanudar(self, seq):
+        """El bus (re)conectó: pudo haber eventos perdidos, se vuelve a leer la base en el próximo uso"""
+        with self._lock:
+            self.eventos.reanudar(seq)
+            self._cargada_en = None
+
+    def invalidar(self):
+        with self._lock:
+            self._cargada_en = None
+
+    @property
+    def tamano(self):
+        with self._lock:
+            return sum(len(e['items']) for e in self._ordenes.values())
+
+    def _aplicar(self, evento):
+        orden = evento['orden']
+        if evento['tipo'] == 'orden_retirada':
+            self._quitar_orden(orden['id'])
+        elif evento['tipo'] == 'item_eliminado':
+            entrada = self._ordenes.get(orden['id'])
+            if entrada is not None:
+                entrada['items'].pop(evento['item']['id'], None)
+                if not entrada['items']:
+                    self._quitar_orden(orden['id'])
+        elif evento['tipo'] == 'orden_nueva':
+            for item in evento['items']:
+                self._poner_item(orden, item)
+        else:
+            self._poner_item(orden, evento['item'])
+        self._seq = evento['seq']
+        self._version += 1
+
+    def _poner_item(self, orden, item):
+        entrada = self._ordenes.get(orden['id'])
+        if entrada is None:
+            entrada = self._ordenes[orden['id']] = {'orden': dict(orden), 'items': {}}
+            bisect.insort(self._claves, (orden['fecha_apertura'] or '', orden['id']))
+        else:
+            entrada['orden'] = dict(entrada['orden'], **orden)
+        entrada['items'][item['id']] = item
+
+    def _quitar_orden(self, orden_id):
+        entrada = self._ordenes.pop(orden_id, None)
+        if entrada is None:
+            return
+        clave = (entrada['orden']['fecha_apertura'] or '', orden_id)
+        posicion = bisect.bisect_left(self._claves, clave)
+        if posicion < len(self._claves) and self._claves[posicion] == clave:
+            del self._claves[posicion]
+
+    def _cargar(self):
+        with self._carga_lock:
+            if self._vigente():
+                return
+            with self._lock:
+                seq = self.eventos.seq
+            filas = _filas_cocina()
+            with self._lock:
+                self._ordenes, self._claves = {}, []
+                for orden, item in filas:
+                    self._poner_item(orden, item)
+                self._seq = seq
+                self._version += 1
+                posteriores = self.eventos.desde(seq)
+                if posteriores is None:
+                    # reanudar() descartó el buffer durante la consulta: el TTL corregirá lo que falte
+                    log.warning('Cola de cocina cargada sin poder reaplicar eventos', extra={'campos': {'seq': seq}})
+                    self._seq = self.eventos.seq
+                for evento in posteriores or []:
+                    self._aplicar(evento)
+                self._cargada_en = time.monotonic()
+
+    def _vigente(self):
+        return self._cargada_en is not None and time.monotonic() - self._cargada_en < self.ttl
+
+    def _proyectar(self, ahora):
+        """Hora estimada de fin de cada item. Cada estación tiene PUESTOS_ESTACION puestos: los items
+        en proceso que terminan antes los ocupan hasta su inicio + tiempo estimado; los que no
+        entran (marcados en proceso de más) esperan primero con lo que les falta, y detrás los
+        pendientes, por antigüedad de la orden, toman el primer puesto libre"""
+        fines = {}
+        en_proceso = {estacion: [] for estacion in PUESTOS_ESTACION}
+        pendientes = {estacion: [] for estacion in PUESTOS_ESTACION}
+        for _, orden_id in self._claves:
+            items = self._ordenes[orden_id]['items']
+            for item_id in sorted(items):
+                item = items[item_id]
+                duracion = timedelta(minutes=item['tiempo_estimado'] or MINUTOS_ITEM_DEFECTO)
+                if item['estado_item'] == 'listo':
+                    fines[item_id] = _fecha_iso(item['tiempo_fin']) or ahora
+                elif item['estado_item'] == 'proceso':
+                    fin = max((_fecha_iso(item['tiempo_inicio']) or ahora) + duracion, ahora)
+                    en_proceso[estacion_item(item)].append((fin, item_id))
+                else:
+                    pendientes[estacion_item(item)].append((item_id, duracion))
+        for estacion, cola in pendientes.items():
+            puestos = max(1, PUESTOS_ESTACION[estacion])
+            proceso = sorted(en_proceso[estacion])
+            libres = []
+            for fin, item_id in proceso[:puestos]:
+                fines[item_id] = fin
+                libres.append(fin)
+            libres.extend([ahora] * (puestos - len(libres)))
+            heapq.heapify(libres)
+            espera = [(item_id, fin - ahora) for fin, item_id in proceso[puestos:]] + cola
+            for item_id, duracion in espera:
+                fines[item_id] = libres[0] + duracion
+                heapq.heapreplace(libres, fines[item_id])
+        return fines
+
+    def _armar(self, estacion, ahora):
+        """Pedidos con items y estadísticas como los esperan las pantallas; primero los que
+        tienen algo por hacer, por antigüedad, y al final los que ya están listos"""
+        fines = self._proyectar(ahora)
+        en_curso, listos = [], []
+        for _, orden_id in self._claves:
+            entrada = self._ordenes[orden_id]
+            items = [dict(entrada['items'][i], listo_estimado=_iso(fines[i]))
+                     for i in sorted(entrada['items'])
+                     if estacion is None or estacion_item(entrada['items'][i]) == estacion]
+            if not items:
+                continue
+            estados = [i['estado_item'] for i in items]
+            fin = max(fines[i['id']] for i in items)
+            pedido = dict(entrada['orden'], items=items,
+                          listo_estimado=_iso(fin),
+                          minutos_restantes=max(0, math.ceil((fin - ahora).total_seconds() / 60)))
+            pedido['estadisticas'] = {
+                'total': len(estados),
+                'pendientes': estados.count('pendiente'),
+                'proceso': estados.count('proceso'),
+                'listos': estados.count('listo')
+            }
+            (listos if pedido['estadisticas']['listos'] == len(estados) else en_curso).append(pedido)
+        return en_curso + listos
+
+    def vista(self, estacion=None):
+        """(cuerpo JSON, seq) de la estación indicada, o de toda la cocina con None"""
+        if not self._vigente():
+            self._cargar()
+        with self._lock:
+            ahora = time.monotonic()
+            memorizada = self._vistas.get(estacion)
+            if memorizada and memorizada[0] == self._version and memorizada[1] > ahora:
+                return memorizada[2], memorizada[3]
+            version, seq = self._version, self._seq
+            pedidos = self._armar(estacion, datetime.now())
+        # Los pedidos armados son copias: se serializan fuera del lock
+        cuerpo = app.json.dumps(pedidos)
+        with self._lock:
+            if self._version == version:
+                self._vistas[estacion] = (version, ahora + self.refresco_eta, cuerpo, seq)
+        return cuerpo, seq
+
+cola_cocina = ColaCocina(eventos_cocina, float(os.environ.get("COCINA_COLA_TTL", 300)))
+
+# ==============================
+# FUNCIONES DE AUTENTICACIÓN
+# ==============================
+def hash_password(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def verify_password(password, password_hash):
+    return hash_password(password) == password_hash
+
+def login_user(username, password):
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute('SELECT id, username, password_hash, nombre, rol FROM usuarios WHERE username = %s AND activo = true', (username,))
+        usuario = cur.fetchone()
+        if usuario and verify_password(password, usuario[2]):
+            return {'id': usuario[0], 'username': usuario[1], 'nombre': usuario[3], 'rol': usuario[4],
+                    'activo': True}
+        return None
+    except Exception as e:
+        log.exception('Error en login')
+        if "relation" in str(e) and "usuarios" in str(e):
+            log.error("La tabla 'usuarios' no existe: hay que crear las tablas primero")
+        return None
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
+
+# ==============================
+# CACHÉ DEL USUARIO ACTUAL
+# ==============================
+# El usuario (con rol y activo) se memoriza en flask.g durante el request y en un caché de
+# proceso con TTL corto entre requests. La app no modifica usuarios (los crea init-db), así que
+# un cambio hecho directo en la base, como desactivar a alguien o cambiarle el rol, se ve en
+# como mucho USUARIO_CACHE_TTL segundos. Código que escriba usuarios debe llamar a
+# invalidar_usuario(id) y avisar_invalidacion('usuario', id) después del commit.
+USUARIO_CACHE_TTL = float(os.environ.get("USUARIO_CACHE_TTL", 30))
+_usuarios_cache = {}  # id -> (expira_en, usuario)
+_usuarios_cache_lock = threading.Lock()
+
+def invalidar_usuario(usuario_id=None):
+    """Olvida el usuario cacheado (o todos si no se indica id)"""
+    with _usuarios_cache_lock:
+        if usuario_id is None:
+            _usuarios_cache.clear()
+        else:
+            _usuarios_cache.pop(usuario_id, None)
+    if has_app_context():
+        memo = g.get('_usuario_actual')
+        if memo is not None and (usuario_id is None or memo[0] == usuario_id):
+            g.pop('_usuario_actual')
+
+def cachear_usuario(usuario):
+    with _usuarios_cache_lock:
+        _usuarios_cache[usuario['id']] = (time.monotonic() + USUARIO_CACHE_TTL, usuario)
+
+def _usuario_cacheado(usuario_id):
+    with _usuarios_cache_lock:
+        entrada = _usuarios_cache.get(usuario_id)
+        if entrada is None:
+            return None
+        if entrada[0] < time.monotonic():
+            del _usuarios_cache[usuario_id]
+            return None
+        return entrada[1]
+
+def _cargar_usuario(usuario_id):
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute('SELECT id, username, nombre, rol, activo FROM usuarios WHERE id = %s', (usuario_id,))
+        usuario = cur.fetchone()
+        if usuario:
+            return {'id': usuario[0], 'username': usuario[1], 'nombre': usuario[2], 'rol': usuario[3],
+                    'activo': bool(usuario[4])}
+    except Exception:
+        log.exception('Error obteniendo usuario')
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except:
+            pass
     return None
 
+def get_usuario_actual():
+    """Usuario de la sesión, o None si no hay sesión o el usuario no existe o está inactivo"""
+    if 'user_id' not in session:
+        return None
+    usuario_id = session['user_id']
+
+    memo = g.get('_usuario_actual')
+    if memo is not None and memo[0] == usuario_id:
+        return memo[1]
+
+    usuario = _usuario_cacheado(usuario_id)
+    if usuario is None:
+        usuario = _cargar_usuario(usuario_id)
+        if usuario:
+            cachear_usuario(usuario)
+    # Copia por request: las vistas no deben poder modificar el caché compartido
+    usuario = dict(usuario) if usuario and usuario['activo'] else None
+    g._usuario_actual = (usuario_id, usuario)
+    return usuario
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return redirect(url_for('login'))
+        if get_usuario_actual() is None:
+            # Usuario borrado o desactivado con la sesión abierta
+            session.clear()
+            return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -380,43 +2323,129 @@ def admin_required(f):
         if 'user_id' not in session:
             return redirect(url_for('login'))
         usuario_actual = get_usuario_actual()
-        if usuario_actual and usuario_actual['rol'] != 'admin':
+        if usuario_actual is None:
+            session.clear()
+            return redirect(url_for('login'))
+        if usuario_actual['rol'] != 'admin':
             flash('Acceso restringido. Se requiere rol de administrador.', 'danger')
             return redirect(url_for('index'))
         return f(*args, **kwargs)
     return decorated_function
 
-def abrir_caja_automaticamente():
-    """Función para abrir caja automáticamente si no hay una abierta"""
-    try:
+# ==============================
+# ESTADO DEL TURNO DE CAJA (FUENTE ÚNICA)
+# ==============================
+class EstadoTurno:
+    """Turno de caja abierto cacheado en memoria.
+
+    Es la única fuente para saber si hay caja abierta: se invalida al abrir o cerrar un turno y
+    el TTL acota cuánto tarda en verse un cambio hecho por otro worker si no hay bus distribuido."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._turno = None
+        self._valido_hasta = 0.0
+
+    def invalidar(self):
+        with self._lock:
+            self._turno = None
+            self._valido_hasta = 0.0
+
+    def _guardar(self, turno):
+        with self._lock:
+            self._turno = turno
+            self._valido_hasta = time.monotonic() + self.ttl
+
+    def _cacheado(self):
+        with self._lock:
+            if time.monotonic() < self._valido_hasta:
+                return True, (dict(self._turno) if self._turno else None)
+        return False, None
+
+    @staticmethod
+    def _a_dict(fila):
+        return {
+            'id': fila[0],
+            'fecha_apertura': fila[1],
+            'monto_inicial': float(fila[2]) if fila[2] else 0
+        }
+
+    def obtener(self):
+        """Turno abierto como dict, o None si la caja está cerrada"""
+        vigente, turno = self._cacheado()
+        if vigente:
+            return turno
+
         conn = get_db_connection()
         cur = conn.cursor()
-        
-        # Verificar si ya hay caja abierta
-        cur.execute("SELECT id FROM caja_turnos WHERE estado = 'abierta'")
-        if cur.fetchone():
-            print("✅ Ya hay una caja abierta")
+        try:
+            cur.execute("SELECT id, fecha_apertura, monto_inicial FROM caja_turnos WHERE estado = 'abierta' ORDER BY id DESC LIMIT 1")
+            fila = cur.fetchone()
+        finally:
             cur.close()
             conn.close()
-            return True
-        
-        # Abrir nueva caja automáticamente
-        print("🔓 Abriendo caja automáticamente...")
-        cur.execute('''
-            INSERT INTO caja_turnos (fecha_apertura, monto_inicial, observaciones, estado)
-            VALUES (NOW(), 0, 'Caja abierta automáticamente al iniciar sesión', 'abierta')
-            RETURNING id
-        ''')
-        caja_id = cur.fetchone()[0]
-        conn.commit()
-        print(f"✅ Caja #{caja_id} abierta automáticamente")
-        
-        cur.close()
-        conn.close()
+        turno = self._a_dict(fila) if fila else None
+        self._guardar(turno)
+        return dict(turno) if turno else None
+
+    def abrir(self, monto_inicial=0, observaciones=None):
+        """Abre un turno si no hay ninguno. Devuelve (turno, creado).
+
+        El INSERT ... ON CONFLICT contra el índice único parcial hace que dos aperturas
+        simultáneas terminen en una sola fila, en un solo viaje a la base."""
+        vigente, turno = self._cacheado()
+        if vigente and turno:
+            return turno, False
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute('''
+                WITH nuevo AS (
+                    INSERT INTO caja_turnos (fecha_apertura, monto_inicial, observaciones, estado)
+                    VALUES (NOW(), %s, %s, 'abierta')
+                    ON CONFLICT ((estado)) WHERE estado = 'abierta' DO NOTHING
+                    RETURNING id, fecha_apertura, monto_inicial
+                )
+                SELECT id, fecha_apertura, monto_inicial, true FROM nuevo
+                UNION ALL
+                SELECT id, fecha_apertura, monto_inicial, false FROM caja_turnos
+                WHERE estado = 'abierta' AND NOT EXISTS (SELECT 1 FROM nuevo)
+            ''', (monto_inicial, observaciones))
+            fila = cur.fetchone()
+            conn.commit()
+            if fila is None:
+                # Otro proceso abrió el turno después de nuestro snapshot: leerlo ya confirmado
+                cur.execute("SELECT id, fecha_apertura, monto_inicial, false FROM caja_turnos WHERE estado = 'abierta'")
+                fila = cur.fetchone()
+        finally:
+            cur.close()
+            conn.close()
+
+        if fila is None:
+            self.invalidar()
+            return None, False
+        turno = self._a_dict(fila)
+        self._guardar(turno)
+        if fila[3]:
+            avisar_invalidacion('turno')
+        return dict(turno), fila[3]
+
+estado_turno = EstadoTurno(float(os.environ.get("TURNO_CACHE_TTL", 5)))
+
+def abrir_caja_automaticamente():
+    """Función para abrir caja automáticamente si no hay una abierta"""
+    try:
+        turno, creado = estado_turno.abrir(0, 'Caja abierta automáticamente al iniciar sesión')
+        if turno is None:
+            return False
+        if creado:
+            log.info('Caja abierta automáticamente', extra={'campos': {'turno_id': turno['id']}})
         return True
         
-    except Exception as e:
-        print(f"❌ Error al abrir caja automáticamente: {e}")
+    except Exception:
+        log.exception('Error al abrir caja automáticamente')
         return False
 
 # ==============================
@@ -449,6 +2478,7 @@ def login():
         usuario = login_user(username, password)
         
         if usuario:
+            cachear_usuario(usuario)
             session['user_id'] = usuario['id']
             session['username'] = usuario['username']
             session['nombre'] = usuario['nombre']
@@ -481,8 +2511,10 @@ def login():
 # RUTA PARA CREAR TABLAS MANUALMENTE
 # ==============================
 @app.route("/crear-tablas")
+@admin_required
 def crear_tablas_manual():
-    """Ruta para crear tablas manualmente"""
+    """Aplica las migraciones pendientes desde el navegador (solo admin). Una base vacía se
+    inicializa con `flask --app app2 roka init-db`."""
     try:
         success = create_tables()
         if success:
@@ -545,185 +2577,1476 @@ def crear_tablas_manual():
         '''
 
 # ==============================
-# PANEL DE CAJA (VERSIÓN DEFINITIVA - SIN MENSAJES DE CAJA CERRADA)
+# PANEL DE CAJA (VERSIÓN DEFINITIVA - SIN MENSAJES DE CAJA CERRADA)
+# ==============================
+@app.route("/caja")
+@login_required
+def caja():
+    """Panel de caja - Versión definitiva con apertura automática silenciosa"""
+    usuario_actual = get_usuario_actual()
+    
+    # Si el usuario no es cajero o admin, redirigir
+    if usuario_actual['rol'] not in ['cajero', 'admin']:
+        flash('Acceso restringido. Solo cajeros y administradores pueden acceder a la caja.', 'warning')
+        return redirect(url_for('productos'))
+    
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        # Verificar si hay caja abierta (desde memoria)
+        caja_info = estado_turno.obtener()
+        
+        # ✅ NUNCA MOSTRAR MENSAJE DE CAJA CERRADA - SIEMPRE ABRIRLA
+        if not caja_info:
+            log.info('Abriendo caja automáticamente', extra={'campos': {'usuario': usuario_actual['nombre']}})
+            caja_info, creado = estado_turno.abrir(0, 'Caja abierta automáticamente')
+            if creado:
+                log.info('Caja abierta automáticamente', extra={'campos': {'turno_id': caja_info['id']}})
+
+        # Acumulados del turno: una fila, sin recorrer las ventas
+        if caja_info:
+            resumen = resumen_turno(caja_info['id']) or {}
+            resumen.pop('fecha_apertura', None)
+            caja_info.update(resumen)
+        
+        # Obtener órdenes abiertas
+        cur.execute('''
+            SELECT o.id, m.numero as mesa_numero, o.mozo_nombre, o.total 
+            FROM ordenes o 
+            JOIN mesas m ON o.mesa_id = m.id 
+            WHERE o.estado = 'abierta' 
+            ORDER BY o.fecha_apertura DESC
+        ''')
+        ordenes_abiertas_db = cur.fetchall()
+        
+        ordenes_abiertas = []
+        for o in ordenes_abiertas_db:
+            ordenes_abiertas.append({
+                'id': o[0],
+                'mesa_numero': o[1],
+                'mozo_nombre': o[2],
+                'total': float(o[3]) if o[3] else 0
+            })
+        
+        cur.close()
+        conn.close()
+        
+        # ✅ SIEMPRE mostrar la caja abierta
+        return render_template("caja.html", 
+                             usuario=usuario_actual, 
+                             ahora=datetime.now(),
+                             turno_abierto=caja_info,
+                             ordenes_abiertas=ordenes_abiertas)
+        
+    except Exception:
+        log.exception('Error crítico en panel de caja')
+        # En caso de error grave, redirigir a login
+        flash('Error del sistema. Por favor, reinicia sesión.', 'danger')
+        return redirect(url_for('logout'))
+
+# ==============================
+# PANELES PARA OTROS ROLES
+# ==============================
+@app.route("/chef")
+@login_required
+def chef():
+    usuario_actual = get_usuario_actual()
+    if usuario_actual['rol'] != 'chef':
+        flash('Acceso restringido para chefs', 'warning')
+        return redirect(url_for('login'))
+    return render_template("chef.html", usuario=usuario_actual, ahora=datetime.now())
+
+@app.route("/panel_chef")
+@login_required
+def panel_chef():
+    """Panel del chef - versión alternativa"""
+    usuario_actual = get_usuario_actual()
+    if usuario_actual['rol'] != 'chef':
+        flash('Acceso restringido para chefs', 'warning')
+        return redirect(url_for('login'))
+    return render_template("panel_chef.html", usuario=usuario_actual, ahora=datetime.now())
+
+@app.route("/ordenes")
+@login_required
+def ordenes():
+    usuario_actual = get_usuario_actual()
+    if usuario_actual['rol'] not in ['mozo', 'admin']:
+        flash('Acceso restringido para mozos', 'warning')
+        return redirect(url_for('login'))
+    return render_template("ordenes.html", usuario=usuario_actual, ahora=datetime.now())
+
+@app.route("/pedidos")
+@login_required
+def pedidos():
+    """Panel de pedidos - para mozos"""
+    usuario_actual = get_usuario_actual()
+    if usuario_actual['rol'] not in ['mozo', 'admin']:
+        flash('Acceso restringido para mozos', 'warning')
+        return redirect(url_for('login'))
+    return render_template("pedidos.html", usuario=usuario_actual, ahora=datetime.now())
+
+# ==============================
+# API DE ÓRDENES Y COCINA
+# ==============================
+def _respuesta_cocina(solo_comidas):
+    # El seq es el último evento aplicado a la cola: la pantalla sigue desde ahí sin pérdida
+    cuerpo, seq = cola_cocina.vista('cocina' if solo_comidas else None)
+    response = app.response_class(cuerpo, mimetype='application/json')
+    response.headers['X-Cocina-Seq'] = str(seq)
+    response.headers['X-Cocina-Epoca'] = eventos_cocina.epoca
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route("/api/pedidos_cocina")
+@login_required
+def api_pedidos_cocina():
+    """Foto completa de la cocina; luego la pantalla se actualiza con eventos_cocina"""
+    return _respuesta_cocina(solo_comidas=False)
+
+@app.route("/api/pedidos_cocina_comidas")
+@login_required
+def api_pedidos_cocina_comidas():
+    """Igual que /api/pedidos_cocina pero solo con items de tipo comida"""
+    return _respuesta_cocina(solo_comidas=True)
+
+def _orden_activa_dict(f):
+    return {
+        'id': f[0],
+        'mesa_numero': f[1],
+        'mozo_nombre': f[2],
+        'total': float(f[3]) if f[3] else 0,
+        'estado': f[4] or 'abierta',
+        'fecha_apertura': _iso(f[5]),
+        'items_count': f[6],
+        'items_pendientes': f[7]
+    }
+
+@app.route("/api/ordenes_activas")
+@login_required
+def api_ordenes_activas():
+    """Órdenes activas. Responde 304 si no cambió nada desde el ETag del cliente; con ?since=N
+    devuelve solo las órdenes creadas, modificadas o retiradas después del cursor N.
+
+    El cursor es el horizonte xmin del snapshot: toda transacción con id menor ya terminó, así que
+    un cambio que el cliente todavía no vio tiene modificado_xid >= cursor aunque haya confirmado
+    después de otro con número mayor. Puede repetir cambios ya vistos, nunca saltearlos.
+
+    Si el cursor es anterior a la última poda de bajas (cierre de caja) responde la lista
+    completa con completa=true en lugar de los cambios."""
+    since = request.args.get('since', type=int)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # Horizonte y ETag en la misma sentencia (mismo snapshot): las consultas de datos que siguen
+    # ven lo mismo o más, así que ni el cursor ni el ETag pueden quedar adelantados. Toda
+    # modificación toma un número mayor que el que tenía la fila, así que la suma también
+    # cambia cuando confirma tarde un cambio con número menor que el máximo
+    cur.execute('''
+        SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint,
+               COUNT(*), COALESCE(MAX(modificado_seq), 0), COALESCE(SUM(modificado_seq), 0)
+        FROM ordenes
+        WHERE estado NOT IN ('cerrada', 'cancelada')
+    ''')
+    cursor, cantidad, maximo, suma = cur.fetchone()
+
+    etag = f'ordenes-{cantidad}-{maximo}-{suma}'
+    if request.if_none_match.contains(etag):
+        cur.close()
+        conn.close()
+        response = app.response_class(status=304)
+    else:
+        columnas = '''
+            SELECT o.id, m.numero, o.mozo_nombre, o.total, o.estado, o.fecha_apertura,
+                   o.cantidad_items, o.items_pendientes
+            FROM ordenes o
+            JOIN mesas m ON m.id = o.mesa_id
+        '''
+        completa = False
+        if since is not None:
+            cur.execute('''
+                SELECT horizonte_ordenes FROM caja_turnos
+                WHERE horizonte_ordenes IS NOT NULL
+                ORDER BY id DESC LIMIT 1
+            ''')
+            poda = cur.fetchone()
+            completa = poda is not None and since < poda[0]
+        if since is None or completa:
+            cur.execute(columnas + " WHERE o.estado NOT IN ('cerrada', 'cancelada') ORDER BY o.fecha_apertura DESC")
+            activas = [_orden_activa_dict(f) for f in cur.fetchall()]
+            if completa:
+                response = jsonify({'cursor': cursor, 'completa': True, 'ordenes': activas, 'retiradas': []})
+            else:
+                response = jsonify(activas)
+        else:
+            cur.execute(columnas + " WHERE o.modificado_xid >= %s::text::xid8 ORDER BY o.fecha_apertura DESC", (since,))
+            activas, retiradas = [], []
+            for f in cur.fetchall():
+                if f[4] in ('cerrada', 'cancelada'):
+                    retiradas.append(f[0])
+                else:
+                    activas.append(_orden_activa_dict(f))
+            cur.execute('SELECT orden_id FROM ordenes_eliminadas WHERE modificado_xid >= %s::text::xid8', (since,))
+            retiradas.extend(f[0] for f in cur.fetchall())
+            response = jsonify({'cursor': cursor, 'ordenes': activas, 'retiradas': retiradas})
+        cur.close()
+        conn.close()
+
+    response.set_etag(etag)
+    response.headers['X-Ordenes-Cursor'] = str(cursor)
+    # no-cache: el navegador revalida siempre con If-None-Match y reutiliza su copia si recibe 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# ==============================
+# INVENTARIO: RESERVA Y DESCUENTO DE STOCK
+# ==============================
+# Solo llevan stock los productos con stock no nulo que no son de cocina. Cada movimiento es una
+# sola sentencia por orden: primero bloquea las filas de productos en orden de id (dos órdenes
+# con los mismos productos no se bloquean cruzadas) y después actualiza con la condición de
+# disponibilidad en el propio UPDATE, así dos terminales no pueden vender la misma unidad.
+# Los productos bajo su mínimo se avisan con los valores de RETURNING, sin releer la tabla.
+STOCK_MINIMO = int(os.environ.get("ROKA_STOCK_MINIMO", 5))
+PRODUCTO_CON_STOCK = "p.stock IS NOT NULL AND COALESCE(p.tipo, 'producto') <> 'comida'"
+
+def cantidades_por_producto(items):
+    """{producto_id: cantidad total} de una lista de items (validados por validar_items o de
+    cocina); los items cancelados no reservan"""
+    cantidades = {}
+    for item in items:
+        if item.get('producto_id') and item.get('estado_item') != 'cancelado':
+            producto_id = int(item['producto_id'])
+            cantidades[producto_id] = cantidades.get(producto_id, 0) + int(item['cantidad'])
+    return cantidades
+
+def reservar_stock(cur, cantidades):
+    """Reserva {producto_id: cantidad} dentro de la transacción de cur. Las cantidades negativas
+    liberan y solo las arma el servidor (diferencias al actualizar una orden): las del cliente
+    pasan antes por validar_items. Devuelve (movidos, faltantes): movidos = [(id, nombre,
+    disponible, minimo, cantidad)]; si faltantes no está vacío no alcanzó el stock y el llamador
+    tiene que hacer rollback."""
+    cantidades = {producto_id: cantidad for producto_id, cantidad in cantidades.items() if cantidad}
+    if not cantidades:
+        return [], []
+    filas = psycopg2.extras.execute_values(cur, f'''
+        WITH pedido (id, cantidad) AS (VALUES %s),
+        bloqueo AS MATERIALIZED (
+            SELECT p.id, p.nombre, p.stock - p.stock_reservado AS disponible
+            FROM productos p JOIN pedido ON pedido.id = p.id
+            WHERE {PRODUCTO_CON_STOCK}
+            ORDER BY p.id
+            FOR UPDATE OF p
+        ),
+        movido AS (
+            UPDATE productos p
+            SET stock_reservado = GREATEST(p.stock_reservado + pedido.cantidad, 0)
+            FROM pedido, bloqueo
+            WHERE p.id = pedido.id AND p.id = bloqueo.id
+              AND (pedido.cantidad < 0 OR p.stock - p.stock_reservado >= pedido.cantidad)
+            RETURNING p.id, p.stock - p.stock_reservado AS disponible, COALESCE(p.stock_minimo, {STOCK_MINIMO}) AS minimo
+        )
+        SELECT b.id, b.nombre, COALESCE(m.disponible, b.disponible), m.minimo, pedido.cantidad, m.id IS NOT NULL
+        FROM bloqueo b
+        JOIN pedido ON pedido.id = b.id
+        LEFT JOIN movido m ON m.id = b.id
+    ''', sorted(cantidades.items()), template='(%s::integer, %s::integer)', page_size=len(cantidades), fetch=True)
+    movidos = [f[:5] for f in filas if f[5]]
+    faltantes = [{'producto_id': f[0], 'nombre': f[1], 'disponible': f[2], 'pedido': f[4]} for f in filas if not f[5]]
+    return movidos, faltantes
+
+def cerrar_reserva(cur, orden_id, vendida):
+    """Cierra la reserva de una orden en una sentencia: vendida descuenta stock y reserva; si no,
+    solo libera la reserva. Los items cancelados no reservan ni se venden. Devuelve [(id, nombre, disponible, minimo, cantidad)]."""
+    cur.execute(f'''
+        WITH pedido AS (
+            SELECT producto_id AS id, SUM(cantidad) AS cantidad FROM orden_items
+            WHERE orden_id = %s AND estado_item IS DISTINCT FROM 'cancelado'
+            GROUP BY producto_id
+        ),
+        bloqueo AS MATERIALIZED (
+            SELECT p.id FROM productos p JOIN pedido ON pedido.id = p.id
+            WHERE {PRODUCTO_CON_STOCK}
+            ORDER BY p.id
+            FOR UPDATE OF p
+        )
+        UPDATE productos p
+        SET stock = p.stock - (CASE WHEN %s THEN pedido.cantidad ELSE 0 END),
+            stock_reservado = GREATEST(p.stock_reservado - pedido.cantidad, 0)
+        FROM pedido, bloqueo
+        WHERE p.id = pedido.id AND p.id = bloqueo.id
+        RETURNING p.id, p.nombre, p.stock - p.stock_reservado, COALESCE(p.stock_minimo, {STOCK_MINIMO}), -pedido.cantidad
+    ''', (orden_id, vendida))
+    return cur.fetchall()
+
+def mensaje_faltantes(faltantes):
+    detalle = ', '.join(f"{f['nombre']} (quedan {max(f['disponible'], 0)})" for f in faltantes)
+    return f"Stock insuficiente: {detalle}"
+
+def publicar_stock(movidos):
+    """Después del commit: nuevo disponible al catálogo de cada worker y aviso de stock bajo para
+    los productos que bajaron de su mínimo con este movimiento"""
+    if not movidos:
+        return
+    bus.publicar('stock', {
+        'disponibles': [[f[0], f[2]] for f in movidos],
+        'bajos': [{'producto_id': f[0], 'nombre': f[1], 'disponible': f[2], 'minimo': f[3]}
+                  for f in movidos if f[4] > 0 and f[2] <= f[3]]
+    })
+
+@bus.suscribir('stock')
+def _stock_desde_bus(datos, seq, propio):
+    catalogo.actualizar_stock(dict(datos['disponibles']))
+    if datos['bajos']:
+        socketio.emit('stock_bajo', {'productos': datos['bajos']})
+
+def _entero(valor):
+    """int de un valor JSON entero (o texto con solo dígitos); None si no lo es"""
+    if isinstance(valor, bool):
+        return None
+    if isinstance(valor, int):
+        return valor
+    if isinstance(valor, str) and valor.strip().isdigit():
+        return int(valor)
+    return None
+
+def validar_items(items):
+    """Valida los items que manda el cliente antes de tocar la base: producto_id entero y cantidad
+    entera >= 1 (una cantidad negativa liberaría reservas de otras órdenes); item_id, si viene,
+    entero. Devuelve (items normalizados, None) o (None, mensaje) para responder 400."""
+    if not isinstance(items, list):
+        return None, "Items inválidos"
+    validos = []
+    for posicion, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            return None, f"Item {posicion}: formato inválido"
+        producto_id = _entero(item.get('producto_id'))
+        cantidad = _entero(item.get('cantidad'))
+        item_id = _entero(item.get('item_id') or 0)
+        if producto_id is None or producto_id < 1:
+            return None, f"Item {posicion}: producto_id inválido"
+        if cantidad is None or cantidad < 1:
+            return None, f"Item {posicion}: la cantidad tiene que ser un entero mayor que 0"
+        if item_id is None:
+            return None, f"Item {posicion}: item_id inválido"
+        validos.append({'producto_id': producto_id, 'cantidad': cantidad, 'item_id': item_id,
+                        'observaciones': item.get('observaciones')})
+    return validos, None
+
+def _fila_item(orden_id, item):
+    """Del cliente solo se toman producto_id, cantidad y observaciones: nombre y precio los pone
+    insertar_items desde productos"""
+    return (orden_id, item['producto_id'], item['cantidad'], str(item.get('observaciones') or ''))
+
+def insertar_items(cur, filas):
+    """Inserta todos los items en un solo INSERT ... SELECT (una ida y vuelta a la base, un disparo
+    del trigger de totales), con nombre y precio leídos de productos en la misma sentencia.
+    Devuelve sus ids en el mismo orden que 'filas', o None si algún producto no existe (el
+    llamador tiene que hacer rollback)."""
+    if not filas:
+        return []
+    creados = psycopg2.extras.execute_values(cur, '''
+        INSERT INTO orden_items (orden_id, producto_id, producto_nombre, cantidad, precio_unitario, observaciones)
+        SELECT v.orden_id, p.id, p.nombre, v.cantidad, COALESCE(p.precio, 0), v.observaciones
+        FROM (VALUES %s) AS v (posicion, orden_id, producto_id, cantidad, observaciones)
+        JOIN productos p ON p.id = v.producto_id
+        ORDER BY v.posicion
+        RETURNING id
+    ''', [(posicion,) + fila for posicion, fila in enumerate(filas)],
+        template='(%s, %s::integer, %s::integer, %s::integer, %s::text)', page_size=len(filas), fetch=True)
+    if len(creados) != len(filas):
+        return None
+    # La secuencia da los ids en el orden en que se insertan, que es el del ORDER BY
+    return sorted(f[0] for f in creados)
+
+@app.route("/api/crear_orden", methods=["POST"])
+@login_required
+def api_crear_orden():
+    """Crea una orden con sus items y avisa a cocina"""
+    data = request.get_json(silent=True) or {}
+    mesa_id = _entero(data.get('mesa_id'))
+    if not data.get('mesa_id') or not data.get('items'):
+        return jsonify({"success": False, "message": "Mesa e items son requeridos"}), 400
+    if mesa_id is None:
+        return jsonify({"success": False, "message": "Mesa inválida"}), 400
+    items, error = validar_items(data['items'])
+    if error:
+        return jsonify({"success": False, "message": error}), 400
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+
+        # Cabecera y mesa en una sentencia (sin fila si la mesa no existe); total, cantidad_items e
+        # items_pendientes los suma el trigger de orden_items
+        cur.execute('''
+            WITH mesa AS (
+                UPDATE mesas SET estado = 'ocupada' WHERE id = %s RETURNING id
+            )
+            INSERT INTO ordenes (mesa_id, mozo_nombre, estado, observaciones, total, dispositivo_origen)
+            SELECT mesa.id, %s, 'abierta', %s, 0, %s FROM mesa
+            RETURNING id
+        ''', (mesa_id, data.get('mozo_nombre') or session.get('nombre', ''), data.get('observaciones', ''),
+              request.headers.get('User-Agent', '')[:100]))
+        fila = cur.fetchone()
+        if not fila:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            return jsonify({"success": False, "message": "Mesa no encontrada"}), 404
+        orden_id = fila[0]
+
+        item_ids = insertar_items(cur, [_fila_item(orden_id, item) for item in items])
+        if item_ids is None:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            return jsonify({"success": False, "message": "Producto inexistente en el pedido"}), 400
+        movidos, faltantes = reservar_stock(cur, cantidades_por_producto(items))
+        if faltantes:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            return jsonify({"success": False, "message": mensaje_faltantes(faltantes), "faltantes": faltantes}), 409
+
+        cur.execute(f'''
+            SELECT {COLUMNAS_ITEM_COCINA}
+            FROM ordenes o
+            JOIN mesas m ON m.id = o.mesa_id
+            JOIN orden_items i ON i.orden_id = o.id
+            WHERE o.id = %s
+            ORDER BY i.id
+        ''', (orden_id,))
+        filas = cur.fetchall()
+        conn.commit()
+        cur.close()
+        conn.close()
+
+        orden = _orden_item_cocina(filas[0])[0]
+        publicar_orden_nueva(orden, [_orden_item_cocina(f)[1] for f in filas])
+        publicar_stock(movidos)
+        return jsonify({"success": True, "orden_id": orden_id, "mesa_numero": orden['mesa_numero'],
+                        "item_ids": item_ids})
+
+    except Exception as e:
+        log.exception('Error creando orden')
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route("/api/actualizar_item_estado", methods=["POST"])
+@login_required
+def api_actualizar_item_estado():
+    """Cambia el estado de un item de cocina y publica el cambio"""
+    data = request.get_json(silent=True) or {}
+    item_id = data.get('item_id')
+    estado = data.get('estado')
+    if not item_id or estado not in ESTADOS_ITEM:
+        return jsonify({"success": False, "message": "Item o estado inválido"}), 400
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(f'''
+            UPDATE orden_items i
+            SET estado_item = %(estado)s,
+                tiempo_inicio = CASE WHEN %(estado)s = 'pendiente' THEN NULL
+                                     ELSE COALESCE(i.tiempo_inicio, NOW()) END,
+                tiempo_fin = CASE WHEN %(estado)s = 'listo' THEN NOW() ELSE NULL END
+            FROM ordenes o
+            JOIN mesas m ON m.id = o.mesa_id
+            WHERE i.id = %(item_id)s AND o.id = i.orden_id
+            RETURNING {COLUMNAS_ITEM_COCINA}
+        ''', {'estado': estado, 'item_id': item_id})
+        fila = cur.fetchone()
+        conn.commit()
+        cur.close()
+        conn.close()
+
+        if not fila:
+            return jsonify({"success": False, "message": "Item no encontrado"}), 404
+
+        orden, item = _orden_item_cocina(fila)
+        publicar_item_cocina('item_estado', orden, item)
+        return jsonify({"success": True, "item": item})
+
+    except Exception as e:
+        log.exception('Error actualizando item')
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route("/api/actualizar_orden", methods=["POST"])
+@login_required
+def api_actualizar_orden():
+    """Reemplaza los items de una orden: actualiza los que traen item_id, inserta los nuevos y borra el resto"""
+    data = request.get_json(silent=True) or {}
+    orden_id = _entero(data.get('orden_id'))
+    if not data.get('orden_id'):
+        return jsonify({"success": False, "message": "Orden requerida"}), 400
+    if orden_id is None:
+        return jsonify({"success": False, "message": "Orden inválida"}), 400
+    items, error = validar_items(data.get('items') or [])
+    if error:
+        return jsonify({"success": False, "message": error}), 400
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM ordenes WHERE id = %s AND estado NOT IN ('cerrada', 'cancelada') FOR UPDATE", (orden_id,))
+        if not cur.fetchone():
+            cur.close()
+            conn.close()
+            return jsonify({"success": False, "message": "Orden no encontrada o ya cerrada"}), 404
+
+        cur.execute(f'''
+            SELECT {COLUMNAS_ITEM_COCINA}
+            FROM ordenes o
+            JOIN mesas m ON m.id = o.mesa_id
+            JOIN orden_items i ON i.orden_id = o.id
+            WHERE o.id = %s
+        ''', (orden_id,))
+        anteriores = {f[5]: _orden_item_cocina(f)[1] for f in cur.fetchall()}
+
+        # Los que ya existen se actualizan todos juntos con un UPDATE ... FROM (VALUES ...) y los
+        # nuevos se insertan en un solo INSERT; item_ids queda alineado con el carrito recibido.
+        # Un item existente conserva su producto y el precio al que se pidió: solo cambian la
+        # cantidad y las observaciones
+        item_ids, cambios, nuevos, posiciones_nuevos, carrito = [], [], [], [], []
+        for item in items:
+            item_id = item['item_id']
+            if item_id in anteriores and item_id not in item_ids:
+                item_ids.append(item_id)
+                cambios.append((item_id, orden_id, item['cantidad'], str(item.get('observaciones') or '')))
+                item = dict(item, producto_id=anteriores[item_id]['producto_id'])
+            else:
+                posiciones_nuevos.append(len(item_ids))
+                item_ids.append(None)
+                nuevos.append(_fila_item(orden_id, item))
+            carrito.append(item)
+
+        if cambios:
+            psycopg2.extras.execute_values(cur, '''
+                UPDATE orden_items i
+                SET cantidad = v.cantidad, observaciones = v.observaciones
+                FROM (VALUES %s) AS v (id, orden_id, cantidad, observaciones)
+                WHERE i.id = v.id AND i.orden_id = v.orden_id
+            ''', cambios, page_size=len(cambios))
+        creados = insertar_items(cur, nuevos)
+        if creados is None:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            return jsonify({"success": False, "message": "Producto inexistente en el pedido"}), 400
+        for posicion, item_id in zip(posiciones_nuevos, creados):
+            item_ids[posicion] = item_id
+
+        eliminados = [i for i in anteriores if i not in item_ids]
+        if eliminados:
+            cur.execute('DELETE FROM orden_items WHERE orden_id = %s AND id = ANY(%s)', (orden_id, eliminados))
+
+        # Solo se reserva (o libera) la diferencia por producto respecto de la orden anterior
+        diferencia = cantidades_por_producto(carrito)
+        for producto_id, cantidad in cantidades_por_producto(anteriores.values()).items():
+            diferencia[producto_id] = diferencia.get(producto_id, 0) - cantidad
+        movidos, faltantes = reservar_stock(cur, diferencia)
+        if faltantes:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            return jsonify({"success": False, "message": mensaje_faltantes(faltantes), "faltantes": faltantes}), 409
+
+        cur.execute('UPDATE ordenes SET observaciones = %s WHERE id = %s', (data.get('observaciones', ''), orden_id))
+
+        cur.execute(f'''
+            SELECT {COLUMNAS_ITEM_COCINA}
+            FROM ordenes o
+            JOIN mesas m ON m.id = o.mesa_id
+            JOIN orden_items i ON i.orden_id = o.id
+            WHERE o.id = %s
+            ORDER BY i.id
+        ''', (orden_id,))
+        filas = cur.fetchall()
+        conn.commit()
+        cur.close()
+        conn.close()
+
+        for f in filas:
+            orden, item = _orden_item_cocina(f)
+            if item['id'] not in anteriores:
+                publicar_item_cocina('item_nuevo', orden, item)
+            elif item != anteriores[item['id']]:
+                publicar_item_cocina('item_actualizado', orden, item)
+        for item_id in eliminados:
+            publicar_item_cocina('item_eliminado', {'id': orden_id}, anteriores[item_id])
+        publicar_stock(movidos)
+        return jsonify({"success": True, "orden_id": orden_id, "item_ids": item_ids})
+
+    except Exception as e:
+        log.exception('Error actualizando orden')
+        return jsonify({"success": False, "message": str(e)}), 500
+
+def _liberar_mesa(cur, mesa_id):
+    """Deja la mesa disponible si no le quedan otras órdenes activas"""
+    cur.execute('''
+        UPDATE mesas SET estado = 'disponible'
+        WHERE id = %s AND NOT EXISTS (
+            SELECT 1 FROM ordenes WHERE mesa_id = %s AND estado NOT IN ('cerrada', 'cancelada')
+        )
+    ''', (mesa_id, mesa_id))
+
+def _retirar_orden(orden_id, eliminar):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    movidos = []
+    if eliminar:
+        # Si estaba activa, liberar su reserva mientras los items todavía existen
+        cur.execute('SELECT estado FROM ordenes WHERE id = %s FOR UPDATE', (orden_id,))
+        estado = cur.fetchone()
+        if estado and estado[0] not in ('cerrada', 'cancelada'):
+            movidos = cerrar_reserva(cur, orden_id, vendida=False)
+        cur.execute('DELETE FROM ordenes WHERE id = %s RETURNING mesa_id', (orden_id,))
+    else:
+        # La cancelación se suma al turno abierto en la misma sentencia. Se bloquea primero el
+        # turno y después la orden, en el mismo orden que cobrar_orden, para no cruzarse.
+        cur.execute('''
+            WITH turno AS (
+                SELECT id FROM caja_turnos WHERE estado = 'abierta' FOR UPDATE
+            ), orden AS (
+                UPDATE ordenes SET estado = 'cancelada', fecha_cierre = NOW(), turno_id = (SELECT id FROM turno)
+                WHERE id = %s AND estado NOT IN ('cerrada', 'cancelada')
+                RETURNING mesa_id, total, turno_id
+            ), acumulado AS (
+                UPDATE caja_turnos t
+                SET cantidad_cancelaciones = t.cantidad_cancelaciones + 1,
+                    monto_cancelado = t.monto_cancelado + COALESCE(orden.total, 0)
+                FROM orden
+                WHERE t.id = orden.turno_id
+            )
+            SELECT mesa_id FROM orden
+        ''', (orden_id,))
+    fila = cur.fetchone()
+    if fila:
+        if not eliminar:
+            movidos = cerrar_reserva(cur, orden_id, vendida=False)
+        _liberar_mesa(cur, fila[0])
+    conn.commit()
+    cur.close()
+    conn.close()
+    if fila:
+        publicar_orden_retirada(orden_id)
+        publicar_stock(movidos)
+    return fila is not None
+
+@app.route("/api/cancelar_orden/<int:orden_id>", methods=["POST"])
+@login_required
+def api_cancelar_orden(orden_id):
+    try:
+        if not _retirar_orden(orden_id, eliminar=False):
+            return jsonify({"success": False, "message": "Orden no encontrada o ya cerrada"}), 404
+        return jsonify({"success": True})
+    except Exception as e:
+        log.exception('Error cancelando orden')
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route("/api/eliminar_orden/<int:orden_id>", methods=["DELETE"])
+@login_required
+def api_eliminar_orden(orden_id):
+    """Borra la orden con sus items (solo cajeros y administradores); los demás roles la cancelan"""
+    if get_usuario_actual()['rol'] not in ['cajero', 'admin']:
+        return jsonify({"success": False, "puede_cancelar": True,
+                        "message": "Solo cajeros y administradores pueden eliminar órdenes; se puede cancelar"}), 403
+    try:
+        if not _retirar_orden(orden_id, eliminar=True):
+            return jsonify({"success": False, "message": "Orden no encontrada"}), 404
+        return jsonify({"success": True})
+    except Exception as e:
+        log.exception('Error eliminando orden')
+        return jsonify({"success": False, "message": str(e)}), 500
+
+# ==============================
+# COBRO DE ÓRDENES Y ACUMULADOS DEL TURNO
+# ==============================
+# Cada cobro suma al turno abierto (cantidad, total por medio de pago, propinas) en la misma
+# sentencia que cierra la orden, así el resumen del turno y el cierre de caja leen una sola fila
+# de caja_turnos en lugar de recorrer las órdenes del día.
+METODOS_PAGO = ('efectivo', 'tarjeta', 'transferencia', 'mercadopago')
+
+CAMPOS_TURNO = ('id', 'fecha_apertura', 'monto_inicial', 'cantidad_ventas', 'total_ventas',
+                'ventas_efectivo', 'ventas_tarjeta', 'ventas_transferencia', 'ventas_mercadopago',
+                'propinas', 'propinas_efectivo', 'cantidad_cancelaciones', 'monto_cancelado')
+
+def _columnas_turno(alias):
+    return ', '.join(f'{alias}.{campo}' for campo in CAMPOS_TURNO)
+
+def _resumen_turno(fila):
+    resumen = {campo: (float(valor) if isinstance(valor, Decimal) else valor)
+               for campo, valor in zip(CAMPOS_TURNO, fila)}
+    resumen['total_ventas'] = resumen['total_ventas'] or 0
+    resumen['fecha_apertura'] = _iso(resumen['fecha_apertura'])
+    # Lo que debería haber en el cajón: fondo inicial más lo cobrado en efectivo
+    resumen['efectivo_esperado'] = round(resumen['monto_inicial'] + resumen['ventas_efectivo'] + resumen['propinas_efectivo'], 2)
+    return resumen
+
+def resumen_turno(turno_id):
+    """Acumulados de un turno (lectura de una fila por clave primaria)"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f'SELECT {_columnas_turno("t")} FROM caja_turnos t WHERE t.id = %s', (turno_id,))
+    fila = cur.fetchone()
+    cur.close()
+    conn.close()
+    return _resumen_turno(fila) if fila else None
+
+def cobrar_orden(orden_id, metodo, propina=0):
+    """Cierra la orden como cobrada y suma el cobro al turno abierto, en una transacción.
+
+    Devuelve (total, resumen del turno) o (None, motivo) si no hay caja abierta o la orden no
+    está activa. El turno se bloquea antes que la orden: los cobros del mismo turno se
+    serializan sobre esa fila, que es justamente lo que mantiene exactos los acumulados."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(f'''
+            WITH turno AS (
+                SELECT id FROM caja_turnos WHERE estado = 'abierta' FOR UPDATE
+            ), orden AS (
+                UPDATE ordenes o
+                SET estado = 'cerrada', fecha_cierre = NOW(), metodo_pago = %(metodo)s,
+                    propina = %(propina)s, turno_id = turno.id
+                FROM turno
+                WHERE o.id = %(orden_id)s AND o.estado NOT IN ('cerrada', 'cancelada')
+                RETURNING o.mesa_id, COALESCE(o.total, 0) AS total
+            ), acumulado AS (
+                UPDATE caja_turnos t
+                SET cantidad_ventas = t.cantidad_ventas + 1,
+                    total_ventas = COALESCE(t.total_ventas, 0) + orden.total,
+                    ventas_{metodo} = t.ventas_{metodo} + orden.total,
+                    propinas = t.propinas + %(propina)s,
+                    propinas_efectivo = t.propinas_efectivo + %(propina_efectivo)s
+                FROM orden, turno
+                WHERE t.id = turno.id
+                RETURNING {_columnas_turno("t")}
+            )
+            SELECT orden.mesa_id, orden.total, {_columnas_turno("a")}
+            FROM orden, acumulado a
+        ''', {'metodo': metodo, 'propina': propina, 'orden_id': orden_id,
+              'propina_efectivo': propina if metodo == 'efectivo' else 0})
+        fila = cur.fetchone()
+        if not fila:
+            conn.rollback()
+            return None, ('No hay caja abierta' if estado_turno.obtener() is None
+                          else 'Orden no encontrada o ya cerrada')
+        _liberar_mesa(cur, fila[0])
+        # El disponible no cambia (bajan stock y reserva juntos): no hace falta avisar
+        cerrar_reserva(cur, orden_id, vendida=True)
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+    publicar_orden_retirada(orden_id)
+    return float(fila[1]), _resumen_turno(fila[2:])
+
+@app.route("/api/cobrar_orden/<int:orden_id>", methods=["POST"])
+@login_required
+def api_cobrar_orden(orden_id):
+    """Cobra una orden: {"metodo_pago": "efectivo", "propina": 0}"""
+    if get_usuario_actual()['rol'] not in ['cajero', 'admin']:
+        return jsonify({"success": False, "message": "Solo cajeros y administradores pueden cobrar"}), 403
+
+    data = request.get_json(silent=True) or {}
+    metodo = str(data.get('metodo_pago') or 'efectivo').strip().lower().replace(' ', '')
+    if metodo not in METODOS_PAGO:
+        return jsonify({"success": False, "message": f"Método de pago inválido: {metodo}"}), 400
+    try:
+        propina = round(float(data.get('propina') or 0), 2)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "Propina inválida"}), 400
+    if propina < 0:
+        return jsonify({"success": False, "message": "Propina inválida"}), 400
+
+    try:
+        total, resultado = cobrar_orden(orden_id, metodo, propina)
+        if total is None:
+            return jsonify({"success": False, "message": resultado}), 409
+        return jsonify({"success": True, "orden_id": orden_id, "total": total, "propina": propina,
+                        "metodo_pago": metodo, "turno": resultado})
+    except Exception as e:
+        log.exception('Error cobrando orden')
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route("/api/resumen_turno")
+@login_required
+def api_resumen_turno():
+    """Acumulados del turno abierto para el panel de caja"""
+    try:
+        turno = estado_turno.obtener()
+        if not turno:
+            return jsonify({"success": False, "message": "No hay caja abierta"}), 404
+        return jsonify({"success": True, "turno": resumen_turno(turno['id'])})
+    except Exception as e:
+        log.exception('Error leyendo resumen del turno')
+        return jsonify({"success": False, "message": str(e)}), 500
+
+# ==============================
+# RESÚMENES DE VENTAS (POR DÍA, HORA, PRODUCTO Y MOZO)
+# ==============================
+# ventas_diarias, ventas_por_hora, ventas_por_producto y ventas_por_mozo los mantiene el trigger
+# de ordenes al cobrar (migración 11); resumir_ventas() los reconstruye para un rango. Las
+# pantallas de ventas e historial leen estas tablas, que crecen por día y no por orden.
+RESUMENES_VENTAS = {
+    'dia': ('''
+        SELECT fecha, ordenes, total, propinas FROM ventas_diarias
+        WHERE fecha BETWEEN %s AND %s ORDER BY fecha LIMIT %s
+    ''', ('fecha', 'ordenes', 'total', 'propinas')),
+    'hora': ('''
+        SELECT hora, SUM(ordenes), SUM(total) FROM ventas_por_hora
+        WHERE fecha BETWEEN %s AND %s GROUP BY hora ORDER BY hora LIMIT %s
+    ''', ('hora', 'ordenes', 'total')),
+    'producto': ('''
+        SELECT producto_id, MAX(producto_nombre), SUM(cantidad), SUM(total) FROM ventas_por_producto
+        WHERE fecha BETWEEN %s AND %s GROUP BY producto_id ORDER BY SUM(total) DESC, producto_id LIMIT %s
+    ''', ('producto_id', 'nombre', 'cantidad', 'total')),
+    'mozo': ('''
+        SELECT mozo_nombre, SUM(ordenes), SUM(total), SUM(propinas) FROM ventas_por_mozo
+        WHERE fecha BETWEEN %s AND %s GROUP BY mozo_nombre ORDER BY SUM(total) DESC, mozo_nombre LIMIT %s
+    ''', ('mozo_nombre', 'ordenes', 'total', 'propinas')),
+}
+
+def _valor_json(valor):
+    if isinstance(valor, Decimal):
+        return float(valor)
+    if isinstance(valor, date):
+        return valor.isoformat()
+    return valor
+
+def resumen_ventas(desde, hasta, por='dia', limite=None):
+    """Filas del resumen 'por' (dia, hora, producto o mozo) entre dos fechas inclusive"""
+    sql, campos = RESUMENES_VENTAS[por]
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(sql, (desde, hasta, limite))
+    filas = [{campo: _valor_json(valor) for campo, valor in zip(campos, f)} for f in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return filas
+
+def totales_ventas(desde, hasta):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT COALESCE(SUM(ordenes), 0), COALESCE(SUM(total), 0), COALESCE(SUM(propinas), 0)
+        FROM ventas_diarias WHERE fecha BETWEEN %s AND %s
+    ''', (desde, hasta))
+    ordenes, total, propinas = cur.fetchone()
+    cur.close()
+    conn.close()
+    return {
+        'total_ordenes': ordenes,
+        'total_ventas': float(total),
+        'propinas': float(propinas),
+        'promedio_venta': round(float(total) / ordenes, 2) if ordenes else 0
+    }
+
+def _fecha_param(nombre, defecto=None):
+    """Fecha YYYY-MM-DD de la query string; ValueError si viene mal formada"""
+    valor = request.args.get(nombre)
+    if not valor:
+        return defecto
+    return datetime.strptime(valor, '%Y-%m-%d').date()
+
+@app.route("/api/ventas/resumen")
+@login_required
+def api_ventas_resumen():
+    """/api/ventas/resumen?desde=2026-01-01&hasta=2026-01-31&por=dia|hora|producto|mozo&limite=20"""
+    por = request.args.get('por', 'dia')
+    if por not in RESUMENES_VENTAS:
+        return jsonify({"success": False, "message": f"'por' debe ser uno de: {', '.join(RESUMENES_VENTAS)}"}), 400
+    try:
+        hasta = _fecha_param('hasta', date.today())
+        desde = _fecha_param('desde', hasta - timedelta(days=30))
+    except ValueError:
+        return jsonify({"success": False, "message": "Fechas en formato YYYY-MM-DD"}), 400
+    limite = request.args.get('limite', type=int)
+
+    try:
+        return jsonify({
+            "success": True,
+            "desde": desde.isoformat(),
+            "hasta": hasta.isoformat(),
+            "por": por,
+            "totales": totales_ventas(desde, hasta),
+            "filas": resumen_ventas(desde, hasta, por, limite)
+        })
+    except Exception as e:
+        log.exception('Error leyendo resumen de ventas')
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route("/ventas")
+@login_required
+def ventas():
+    """Reporte de ventas de un día (?fecha=YYYY-MM-DD, por defecto hoy) desde los resúmenes"""
+    usuario_actual = get_usuario_actual()
+    if usuario_actual['rol'] not in ['cajero', 'admin']:
+        flash('Acceso restringido. Solo cajeros y administradores pueden ver las ventas.', 'warning')
+        return redirect(url_for('productos'))
+    try:
+        dia = _fecha_param('fecha', date.today())
+    except ValueError:
+        flash('Fecha inválida', 'warning')
+        return redirect(url_for('ventas'))
+
+    try:
+        estadisticas = totales_ventas(dia, dia)
+        ventas_hora = [{'hora': f['hora'], 'ventas': f['total'], 'ordenes': f['ordenes']}
+                       for f in resumen_ventas(dia, dia, 'hora')]
+        productos_vendidos = resumen_ventas(dia, dia, 'producto', 10)
+
+        # Las últimas órdenes cobradas del día (índice parcial por fecha de cierre)
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT o.id, m.numero, o.mozo_nombre, o.total, o.fecha_apertura
+            FROM ordenes o JOIN mesas m ON m.id = o.mesa_id
+            WHERE o.estado = 'cerrada' AND o.fecha_cierre >= %s AND o.fecha_cierre < %s
+            ORDER BY o.fecha_cierre DESC
+            LIMIT 10
+        ''', (dia, dia + timedelta(days=1)))
+        pedidos = [{
+            'id': f[0],
+            'mesa_numero': f[1],
+            'mozo_nombre': f[2],
+            'total': float(f[3]) if f[3] else 0,
+            'fecha_apertura': f[4]
+        } for f in cur.fetchall()]
+        cur.close()
+        conn.close()
+    except Exception as e:
+        log.exception('Error cargando reporte de ventas')
+        flash(f'Error cargando ventas: {str(e)}', 'danger')
+        return redirect(url_for('caja'))
+
+    return render_template("ventas.html", usuario=usuario_actual, hoy=dia, ahora=datetime.now(),
+                           estadisticas=estadisticas, ventas_hora=ventas_hora, productos=productos_vendidos,
+                           pedidos=pedidos)
+
+TURNOS_POR_PAGINA = 50
+
+@app.route("/historial_caja")
+@login_required
+def historial_caja():
+    """Turnos de caja por rango de fechas, paginados hacia atrás por id (?antes_id=)"""
+    usuario_actual = get_usuario_actual()
+    if usuario_actual['rol'] not in ['cajero', 'admin']:
+        flash('Acceso restringido. Solo cajeros y administradores pueden ver el historial.', 'warning')
+        return redirect(url_for('productos'))
+    try:
+        fecha_inicio = _fecha_param('fecha_inicio')
+        fecha_fin = _fecha_param('fecha_fin')
+    except ValueError:
+        flash('Fecha inválida', 'warning')
+        return redirect(url_for('historial_caja'))
+    antes_id = request.args.get('antes_id', type=int)
+
+    condiciones, params = [], []
+    if fecha_inicio:
+        condiciones.append('fecha_apertura >= %s')
+        params.append(fecha_inicio)
+    if fecha_fin:
+        condiciones.append('fecha_apertura < %s')
+        params.append(fecha_fin + timedelta(days=1))
+    filtro = ' AND '.join(condiciones) or 'TRUE'
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(f'''
+            SELECT id, fecha_apertura, fecha_cierre, monto_inicial, total_ventas, estado
+            FROM caja_turnos
+            WHERE {filtro} {'AND id < %s' if antes_id else ''}
+            ORDER BY id DESC
+            LIMIT %s
+        ''', params + ([antes_id] if antes_id else []) + [TURNOS_POR_PAGINA + 1])
+        filas = cur.fetchall()
+        # Las ventas del rango son los acumulados de los mismos turnos listados (por fecha de
+        # apertura), mantenidos por trigger: no se suman órdenes
+        cur.execute(f'SELECT COUNT(*), MAX(total_ventas), COALESCE(SUM(total_ventas), 0) FROM caja_turnos WHERE {filtro}',
+                    params)
+        cantidad, maximo, ventas_totales = cur.fetchone()
+        cur.close()
+        conn.close()
+
+        turnos = [{
+            'id': f[0],
+            'fecha_apertura': f[1],
+            'fecha_cierre': f[2],
+            'monto_inicial': float(f[3]) if f[3] else 0,
+            'total_ventas': float(f[4]) if f[4] else 0,
+            'estado': f[5]
+        } for f in filas[:TURNOS_POR_PAGINA]]
+        siguiente = turnos[-1]['id'] if len(filas) > TURNOS_POR_PAGINA else None
+
+        estadisticas = {
+            'total_turnos': cantidad,
+            'ventas_totales': float(ventas_totales),
+            'max_ventas': float(maximo) if maximo else 0
+        }
+    except Exception as e:
+        log.exception('Error cargando historial de caja')
+        flash(f'Error cargando historial: {str(e)}', 'danger')
+        return redirect(url_for('caja'))
+
+    return render_template("historial_caja.html", usuario=usuario_actual, turnos=turnos, estadisticas=estadisticas,
+                           fecha_inicio=fecha_inicio.isoformat() if fecha_inicio else '',
+                           fecha_fin=fecha_fin.isoformat() if fecha_fin else '',
+                           siguiente=siguiente)
+
+# ==============================
+# EXPORTACIONES CONTABLES (CSV / JSON EN STREAMING)
 # ==============================
-@app.route("/caja")
+# Cada exportación se lee con un cursor del servidor (filas_cursor_servidor) y se escribe a la
+# respuesta a medida que llegan los lotes: un año de órdenes no pasa nunca entero por la memoria
+# del worker y la descarga empieza enseguida. Filtro por rango de fechas inclusive.
+EXPORTACIONES = {
+    'ordenes': (
+        ['id', 'mesa_numero', 'mozo_nombre', 'estado', 'observaciones', 'total', 'propina', 'metodo_pago',
+         'cantidad_items', 'turno_id', 'fecha_apertura', 'fecha_cierre'],
+        '''
+        SELECT o.id, m.numero, o.mozo_nombre, o.estado, o.observaciones, o.total, o.propina, o.metodo_pago,
+               o.cantidad_items, o.turno_id, o.fecha_apertura, o.fecha_cierre
+        FROM ordenes o
+        LEFT JOIN mesas m ON m.id = o.mesa_id
+        WHERE o.fecha_cierre >= %(desde)s AND o.fecha_cierre < %(hasta)s
+        ORDER BY o.fecha_cierre
+        '''),
+    'orden_items': (
+        ['id', 'orden_id', 'producto_id', 'producto_nombre', 'cantidad', 'precio_unitario', 'subtotal',
+         'estado_item', 'observaciones', 'fecha_cierre_orden'],
+        '''
+        SELECT i.id, i.orden_id, i.producto_id, i.producto_nombre, i.cantidad, i.precio_unitario,
+               i.cantidad * i.precio_unitario, i.estado_item, i.observaciones, o.fecha_cierre
+        FROM ordenes o
+        JOIN orden_items i ON i.orden_id = o.id
+        WHERE o.fecha_cierre >= %(desde)s AND o.fecha_cierre < %(hasta)s
+        ORDER BY o.fecha_cierre, i.id
+        '''),
+    'caja_turnos': (
+        ['id', 'fecha_apertura', 'fecha_cierre', 'estado', 'monto_inicial', 'cantidad_ventas', 'total_ventas',
+         'ventas_efectivo', 'ventas_tarjeta', 'ventas_transferencia', 'ventas_mercadopago', 'propinas',
+         'cantidad_cancelaciones', 'monto_cancelado', 'monto_esperado', 'monto_final_real', 'diferencia',
+         'observaciones'],
+        '''
+        SELECT id, fecha_apertura, fecha_cierre, estado, monto_inicial, cantidad_ventas, total_ventas,
+               ventas_efectivo, ventas_tarjeta, ventas_transferencia, ventas_mercadopago, propinas,
+               cantidad_cancelaciones, monto_cancelado, monto_esperado, monto_final_real, diferencia,
+               observaciones
+        FROM caja_turnos
+        WHERE fecha_apertura >= %(desde)s AND fecha_apertura < %(hasta)s
+        ORDER BY fecha_apertura
+        '''),
+    'cierres_caja': (
+        ['id', 'turno_id', 'fecha_cierre', 'monto_total', 'monto_efectivo', 'monto_tarjeta', 'monto_transferencia',
+         'monto_mercadopago', 'propinas', 'cantidad_ventas', 'usuario_cierre', 'observaciones'],
+        '''
+        SELECT id, turno_id, fecha_cierre, monto_total, monto_efectivo, monto_tarjeta, monto_transferencia,
+               monto_mercadopago, propinas, cantidad_ventas, usuario_cierre, observaciones
+        FROM cierres_caja
+        WHERE fecha_cierre >= %(desde)s AND fecha_cierre < %(hasta)s
+        ORDER BY fecha_cierre
+        '''),
+}
+
+def json_en_streaming(campos, filas, tam_bloque=64 * 1024):
+    """Genera un arreglo JSON de objetos en bloques de ~64 KB a medida que llegan las filas"""
+    partes, tamano, primero = ['['], 1, True
+    for fila in filas:
+        texto = json.dumps(dict(zip(campos, fila)), default=_valor_json, ensure_ascii=False)
+        partes.append(texto if primero else ',' + texto)
+        tamano += len(texto) + 1
+        primero = False
+        if tamano >= tam_bloque:
+            yield ''.join(partes)
+            partes, tamano = [], 0
+    partes.append(']')
+    yield ''.join(partes)
+
+def gzip_en_streaming(bloques, nivel=6):
+    """Comprime en formato gzip bloque por bloque, sin juntar la salida completa"""
+    compresor = zlib.compressobj(nivel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for bloque in bloques:
+        datos = compresor.compress(bloque.encode('utf-8'))
+        if datos:
+            yield datos
+    yield compresor.flush()
+
+@app.route("/exportar/<tabla>")
 @login_required
-def caja():
-    """Panel de caja - Versión definitiva con apertura automática silenciosa"""
-    usuario_actual = get_usuario_actual()
-    
-    # Si el usuario no es cajero o admin, redirigir
-    if usuario_actual['rol'] not in ['cajero', 'admin']:
-        flash('Acceso restringido. Solo cajeros y administradores pueden acceder a la caja.', 'warning')
-        return redirect(url_for('productos'))
-    
+def exportar_tabla(tabla):
+    """/exportar/ordenes?desde=2026-01-01&hasta=2026-01-31&formato=csv|json&gzip=1
+
+    Tablas: ordenes, orden_items (por fecha de cierre de la orden), caja_turnos (por apertura) y
+    cierres_caja. Sin fechas exporta el mes en curso."""
+    if get_usuario_actual()['rol'] not in ['cajero', 'admin']:
+        return jsonify({"success": False, "message": "Solo cajeros y administradores pueden exportar"}), 403
+    if tabla not in EXPORTACIONES:
+        return jsonify({"success": False, "message": f"Tablas exportables: {', '.join(EXPORTACIONES)}"}), 404
+    formato = request.args.get('formato', 'csv')
+    if formato not in ('csv', 'json'):
+        return jsonify({"success": False, "message": "formato debe ser csv o json"}), 400
     try:
+        hasta = _fecha_param('hasta', date.today())
+        desde = _fecha_param('desde', hasta.replace(day=1))
+    except ValueError:
+        return jsonify({"success": False, "message": "Fechas en formato YYYY-MM-DD"}), 400
+    if desde > hasta:
+        return jsonify({"success": False, "message": "'desde' es posterior a 'hasta'"}), 400
+
+    campos, sql = EXPORTACIONES[tabla]
+    filas = filas_cursor_servidor(sql, {'desde': desde, 'hasta': hasta + timedelta(days=1)})
+    if formato == 'csv':
+        bloques, mimetype = csv_en_streaming(campos, filas), 'text/csv'
+    else:
+        bloques, mimetype = json_en_streaming(campos, filas), 'application/json'
+    nombre = f"{tabla}_{desde.isoformat()}_{hasta.isoformat()}.{formato}"
+    if request.args.get('gzip') in ('1', 'true', 'si'):
+        bloques, mimetype, nombre = gzip_en_streaming(bloques), 'application/gzip', nombre + '.gz'
+
+    log.info('Exportación', extra={'campos': {'tabla': tabla, 'desde': desde.isoformat(), 'hasta': hasta.isoformat(),
+                                                'formato': formato}})
+    return app.response_class(
+        stream_with_context(bloques),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename={nombre}',
+            # Que el proxy no junte la respuesta entera antes de mandarla
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+# ==============================
+# RUTAS DE GESTIÓN (MANTENIDAS IGUAL)
+# ==============================
+# ==============================
+# CATÁLOGO DE PRODUCTOS EN MEMORIA
+# ==============================
+class CatalogoProductos:
+    """Foto en memoria de productos (con su categoría) y categorías, compartida por la vista
+    /productos y las APIs JSON. Se reconstruye solo cuando se invalida al escribir productos o
+    categorías (también en los demás workers, vía el bus); el TTL es el respaldo si no hay bus.
+    El 'stock' de la foto es el disponible (stock menos reservas) y las ventas lo actualizan en
+    el lugar con actualizar_stock."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._construccion = threading.Lock()
+        self._version = 0
+        self._foto = None
+        self._vence = 0.0
+
+    def invalidar(self):
+        with self._lock:
+            self._version += 1
+            self._foto = None
+
+    def _vigente(self):
+        with self._lock:
+            if self._foto is not None and time.monotonic() < self._vence:
+                return self._foto, self._version
+            return None, self._version
+
+    def foto(self):
+        foto, version = self._vigente()
+        if foto is not None:
+            return foto
+        # Una sola reconstrucción a la vez; el resto espera y usa el resultado
+        with self._construccion:
+            foto, version = self._vigente()
+            if foto is not None:
+                return foto
+            foto = self._construir(version)
+            with self._lock:
+                if self._version == version:
+                    self._foto = foto
+                    self._vence = time.monotonic() + self.ttl
+            return foto
+
+    @staticmethod
+    def _construir(version):
         conn = get_db_connection()
         cur = conn.cursor()
-        
-        # Verificar si hay caja abierta
-        cur.execute("SELECT id, fecha_apertura, monto_inicial FROM caja_turnos WHERE estado = 'abierta' ORDER BY id DESC LIMIT 1")
-        caja_abierta = cur.fetchone()
-        
-        # ✅ NUNCA MOSTRAR MENSAJE DE CAJA CERRADA - SIEMPRE ABRIRLA
-        if not caja_abierta:
-            print(f"🔓 Abriendo caja automáticamente para {usuario_actual['nombre']}...")
-            
-            # Abrir caja automáticamente
-            cur.execute('''
-                INSERT INTO caja_turnos (fecha_apertura, monto_inicial, observaciones, estado)
-                VALUES (NOW(), 0, 'Caja abierta automáticamente', 'abierta')
-                RETURNING id
-            ''')
-            caja_id = cur.fetchone()[0]
-            conn.commit()
-            print(f"✅ Caja #{caja_id} abierta automáticamente")
-            
-            # Obtener la caja recién abierta
-            cur.execute("SELECT id, fecha_apertura, monto_inicial FROM caja_turnos WHERE id = %s", (caja_id,))
-            caja_abierta = cur.fetchone()
-        
-        # Crear diccionario con información de la caja
-        caja_info = {
-            'id': caja_abierta[0],
-            'fecha_apertura': caja_abierta[1],
-            'monto_inicial': float(caja_abierta[2]) if caja_abierta[2] else 0
-        }
-        
-        # Obtener órdenes abiertas
         cur.execute('''
-            SELECT o.id, m.numero as mesa_numero, o.mozo_nombre, o.total 
-            FROM ordenes o 
-            JOIN mesas m ON o.mesa_id = m.id 
-            WHERE o.estado = 'abierta' 
-            ORDER BY o.fecha_apertura DESC
+            SELECT p.id, p.nombre, p.precio, p.stock - p.stock_reservado, p.tipo, p.codigo_barra,
+                   c.nombre as categoria_nombre, p.categoria_id
+            FROM productos p 
+            LEFT JOIN categorias c ON p.categoria_id = c.id
+            ORDER BY p.nombre
         ''')
-        ordenes_abiertas_db = cur.fetchall()
-        
-        ordenes_abiertas = []
-        for o in ordenes_abiertas_db:
-            ordenes_abiertas.append({
-                'id': o[0],
-                'mesa_numero': o[1],
-                'mozo_nombre': o[2],
-                'total': float(o[3]) if o[3] else 0
-            })
-        
+        productos_db = cur.fetchall()
+        cur.execute('SELECT id, nombre FROM categorias ORDER BY nombre')
+        categorias_db = cur.fetchall()
         cur.close()
         conn.close()
-        
-        # ✅ SIEMPRE mostrar la caja abierta
-        return render_template("caja.html", 
-                             usuario=usuario_actual, 
-                             ahora=datetime.now(),
-                             turno_abierto=caja_info,
-                             ordenes_abiertas=ordenes_abiertas)
-        
-    except Exception as e:
-        print(f"❌ Error crítico en panel de caja: {e}")
-        # En caso de error grave, redirigir a login
-        flash('Error del sistema. Por favor, reinicia sesión.', 'danger')
-        return redirect(url_for('logout'))
 
-# ==============================
-# PANELES PARA OTROS ROLES
-# ==============================
-@app.route("/chef")
+        productos_list = [producto_dict(p) for p in productos_db]
+        categorias = [{'id': c[0], 'nombre': c[1]} for c in categorias_db]
+        return CatalogoProductos._armar(version, productos_list, categorias)
+
+    def actualizar_stock(self, disponibles):
+        """Aplica {producto_id: disponible} a la foto vigente sin volver a la base"""
+        with self._lock:
+            foto = self._foto
+        if foto is None or not any(producto_id in foto['por_id'] for producto_id in disponibles):
+            return
+        productos_list = [dict(p, stock=disponibles[p['id']]) if p['id'] in disponibles else p
+                          for p in foto['productos']]
+        with self._lock:
+            if self._foto is not foto:
+                # Cambió mientras tanto: que la próxima lectura la reconstruya
+                self._version += 1
+                self._foto = None
+                return
+            self._version += 1
+            self._foto = self._armar(self._version, productos_list, foto['categorias'])
+
+    @staticmethod
+    def _armar(version, productos_list, categorias):
+        productos_json = json.dumps(productos_list).encode()
+        categorias_json = json.dumps(categorias).encode()
+        return {
+            'version': version,
+            'productos': productos_list,
+            # Índices para el escáner de la caja: búsqueda O(1) por código de barras o id
+            'por_codigo': {p['codigo_barra']: p for p in productos_list if p['codigo_barra']},
+            'por_id': {p['id']: p for p in productos_list},
+            'categorias': categorias,
+            'productos_json': productos_json,
+            'categorias_json': categorias_json,
+            'productos_etag': hashlib.sha1(productos_json).hexdigest(),
+            'categorias_etag': hashlib.sha1(categorias_json).hexdigest()
+        }
+
+catalogo = CatalogoProductos(float(os.environ.get("CATALOGO_CACHE_TTL", 300)))
+
+def producto_dict(p):
+    """Fila (id, nombre, precio, stock, tipo, codigo_barra, categoria_nombre, categoria_id) como dict"""
+    return {
+        'id': p[0],
+        'nombre': p[1],
+        'precio': float(p[2]) if p[2] else 0.0,
+        'stock': p[3] if p[3] is not None else 0,
+        'tipo': p[4] if p[4] else 'producto',
+        'codigo_barra': p[5] if p[5] else '',
+        'categoria_nombre': p[6] if p[6] else 'Sin categoría',
+        'categoria_id': p[7]
+    }
+
+def _respuesta_json_cacheada(cuerpo, etag):
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(cuerpo, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route("/api/productos")
 @login_required
-def chef():
-    usuario_actual = get_usuario_actual()
-    if usuario_actual['rol'] != 'chef':
-        flash('Acceso restringido para chefs', 'warning')
-        return redirect(url_for('login'))
-    return render_template("chef.html", usuario=usuario_actual, ahora=datetime.now())
+def api_productos():
+    foto = catalogo.foto()
+    return _respuesta_json_cacheada(foto['productos_json'], foto['productos_etag'])
 
-@app.route("/panel_chef")
+@app.route("/api/productos/codigo/<path:codigo>")
 @login_required
-def panel_chef():
-    """Panel del chef - versión alternativa"""
-    usuario_actual = get_usuario_actual()
-    if usuario_actual['rol'] != 'chef':
-        flash('Acceso restringido para chefs', 'warning')
-        return redirect(url_for('login'))
-    return render_template("panel_chef.html", usuario=usuario_actual, ahora=datetime.now())
+def api_producto_por_codigo(codigo):
+    """Escáner de la caja: producto por código de barras (o id) desde el catálogo en memoria"""
+    foto = catalogo.foto()
+    producto = foto['por_codigo'].get(codigo)
+    if producto is None and codigo.isdigit():
+        producto = foto['por_id'].get(int(codigo))
+    if producto is None:
+        return jsonify({'error': 'Producto no encontrado', 'codigo': codigo}), 404
+    return jsonify(producto)
 
-@app.route("/ordenes")
+@app.route("/api/categorias")
 @login_required
-def ordenes():
-    usuario_actual = get_usuario_actual()
-    if usuario_actual['rol'] not in ['mozo', 'admin']:
-        flash('Acceso restringido para mozos', 'warning')
-        return redirect(url_for('login'))
-    return render_template("ordenes.html", usuario=usuario_actual, ahora=datetime.now())
+def api_categorias():
+    foto = catalogo.foto()
+    return _respuesta_json_cacheada(foto['categorias_json'], foto['categorias_etag'])
 
-@app.route("/pedidos")
+# ==============================
+# BÚSQUEDA DE PRODUCTOS
+# ==============================
+# Índice GIN sobre productos.busqueda (tsvector 'spanish' del nombre sin acentos): "empanada"
+# encuentra "EMPANADAS" y "empan" encuentra ambos. Los resultados se cachean por versión del catálogo.
+BUSQUEDA_LIMITE_MAXIMO = 50
+_busquedas_cache = OrderedDict()
+_busquedas_cache_lock = threading.Lock()
+
+def normalizar_texto(texto):
+    sin_acentos = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode()
+    return sin_acentos.lower().strip()
+
+def consulta_prefijos(texto):
+    """'Empanadas de Carne' -> 'empanadas:* & de:* & carne:*' (None si no hay palabras)"""
+    palabras = re.findall(r'[a-z0-9]+', normalizar_texto(texto))
+    if not palabras:
+        return None
+    return ' & '.join(f'{p}:*' for p in palabras)
+
+def buscar_productos(texto, limite=20, categoria_id=None):
+    """Productos cuyo nombre contiene palabras que empiezan con las del texto, ordenados por relevancia.
+    La categoría se filtra en la consulta, antes del LIMIT."""
+    consulta = consulta_prefijos(texto)
+    if consulta is None:
+        return []
+    limite = max(1, min(int(limite), BUSQUEDA_LIMITE_MAXIMO))
+    version = catalogo.foto()['version']
+    clave = (version, consulta, limite, categoria_id)
+    with _busquedas_cache_lock:
+        if clave in _busquedas_cache:
+            _busquedas_cache.move_to_end(clave)
+            return _busquedas_cache[clave]
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT p.id, p.nombre, p.precio, p.stock - p.stock_reservado, p.tipo, p.codigo_barra,
+               c.nombre as categoria_nombre, p.categoria_id
+        FROM productos p
+        LEFT JOIN categorias c ON p.categoria_id = c.id,
+             to_tsquery('spanish', %s) q
+        WHERE p.busqueda @@ q {'AND p.categoria_id = %s' if categoria_id is not None else ''}
+        ORDER BY ({SQL_NORMALIZAR_NOMBRE.replace('nombre', 'p.nombre')} LIKE %s) DESC,
+                 ts_rank(p.busqueda, q) DESC, p.nombre
+        LIMIT %s
+    ''', [consulta] + ([categoria_id] if categoria_id is not None else [])
+         + [normalizar_texto(texto).replace('%', '').replace('_', '') + '%', limite])
+    resultado = [producto_dict(p) for p in cur.fetchall()]
+    cur.close()
+    conn.close()
+
+    with _busquedas_cache_lock:
+        _busquedas_cache[clave] = resultado
+        while len(_busquedas_cache) > 500:
+            _busquedas_cache.popitem(last=False)
+    return resultado
+
+@app.route("/api/productos/buscar")
 @login_required
-def pedidos():
-    """Panel de pedidos - para mozos"""
-    usuario_actual = get_usuario_actual()
-    if usuario_actual['rol'] not in ['mozo', 'admin']:
-        flash('Acceso restringido para mozos', 'warning')
-        return redirect(url_for('login'))
-    return render_template("pedidos.html", usuario=usuario_actual, ahora=datetime.now())
+def api_buscar_productos():
+    """Typeahead para caja y mozos: /api/productos/buscar?q=empa&limite=10"""
+    texto = request.args.get('q', '')
+    if len(texto.strip()) < 2:
+        return jsonify([])
+    return jsonify(buscar_productos(texto, request.args.get('limite', 10, type=int)))
 
 # ==============================
-# RUTAS DE GESTIÓN (MANTENIDAS IGUAL)
+# LISTADO PAGINADO Y EXPORTACIÓN DE PRODUCTOS
 # ==============================
+PRODUCTOS_POR_PAGINA = int(os.environ.get("PRODUCTOS_POR_PAGINA", 50))
+
+def filas_cursor_servidor(sql, params=None, lote=1000):
+    """Itera las filas de una consulta con un cursor con nombre (del lado del servidor):
+    en memoria nunca hay más de un lote, sin importar cuántas filas devuelva"""
+    conn = get_db_connection()
+    cur = conn.cursor(name=f'roka_cursor_{threading.get_ident()}_{time.monotonic_ns()}')
+    cur.itersize = lote
+    try:
+        cur.execute(sql, params)
+        for fila in cur:
+            yield fila
+    finally:
+        cur.close()
+        conn.close()
+
+def csv_en_streaming(encabezados, filas, tam_bloque=64 * 1024):
+    """Genera el CSV en bloques de ~64 KB a medida que llegan las filas"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(encabezados)
+    for fila in filas:
+        escritor.writerow(fila)
+        if buffer.tell() >= tam_bloque:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+def pagina_productos(categoria_id=None, despues_nombre=None, despues_id=None, por_pagina=PRODUCTOS_POR_PAGINA):
+    """Una página ordenada por (nombre, id) a partir de la última fila vista (paginación keyset).
+    Devuelve (productos, cursor_siguiente) con cursor_siguiente = (nombre, id) o None."""
+    condiciones, params = [], []
+    if categoria_id is not None:
+        condiciones.append('p.categoria_id = %s')
+        params.append(categoria_id)
+    if despues_id is not None and despues_nombre is not None:
+        condiciones.append('(p.nombre, p.id) > (%s, %s)')
+        params.extend([despues_nombre, despues_id])
+    where = ('WHERE ' + ' AND '.join(condiciones)) if condiciones else ''
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT p.id, p.nombre, p.precio, p.stock - p.stock_reservado, p.tipo, p.codigo_barra,
+               c.nombre as categoria_nombre, p.categoria_id
+        FROM productos p 
+        LEFT JOIN categorias c ON p.categoria_id = c.id
+        {where}
+        ORDER BY p.nombre, p.id
+        LIMIT %s
+    ''', params + [por_pagina + 1])
+    filas = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    productos_list = [producto_dict(p) for p in filas[:por_pagina]]
+    siguiente = None
+    if len(filas) > por_pagina:
+        ultimo = productos_list[-1]
+        siguiente = (ultimo['nombre'], ultimo['id'])
+    return productos_list, siguiente
+
 @app.route("/productos")
 @login_required
 def productos():
     usuario_actual = get_usuario_actual()
     search = request.args.get('search', '')
+    categoria_id = request.args.get('categoria_id', type=int)
+    despues_id = request.args.get('despues_id', type=int)
+    despues_nombre = request.args.get('despues_nombre')
+    foto = catalogo.foto()
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
+    siguiente = None
     if search:
-        cur.execute('''
-            SELECT p.id, p.nombre, p.precio, p.stock, p.tipo, p.codigo_barra,
-                   c.nombre as categoria_nombre
-            FROM productos p 
-            LEFT JOIN categorias c ON p.categoria_id = c.id
-            WHERE p.nombre ILIKE %s
-            ORDER BY p.nombre
-        ''', (f'%{search}%',))
+        productos_list = buscar_productos(search, BUSQUEDA_LIMITE_MAXIMO, categoria_id)
     else:
-        cur.execute('''
-            SELECT p.id, p.nombre, p.precio, p.stock, p.tipo, p.codigo_barra,
-                   c.nombre as categoria_nombre
-            FROM productos p 
-            LEFT JOIN categorias c ON p.categoria_id = c.id
-            ORDER BY p.nombre
-        ''')
-    
-    productos_db = cur.fetchall()
-    
-    cur.execute('SELECT id, nombre FROM categorias ORDER BY nombre')
-    categorias_db = cur.fetchall()
-    
-    productos_list = []
-    for p in productos_db:
-        productos_list.append({
-            'id': p[0],
-            'nombre': p[1],
-            'precio': float(p[2]) if p[2] else 0.0,
-            'stock': p[3] if p[3] is not None else 0,
-            'tipo': p[4] if p[4] else 'producto',
-            'codigo_barra': p[5] if p[5] else '',
-            'categoria_nombre': p[6] if p[6] else 'Sin categoría'
-        })
-    
-    cur.close()
-    conn.close()
+        productos_list, siguiente = pagina_productos(categoria_id, despues_nombre, despues_id)
     
     return render_template("productos.html", 
                          usuario=usuario_actual,
                          productos=productos_list,
-                         categorias=[{'id': c[0], 'nombre': c[1]} for c in categorias_db],
+                         categorias=foto['categorias'],
+                         categoria_id=categoria_id,
+                         siguiente=siguiente,
+                         es_primera_pagina=despues_id is None,
                          search=search,
                          ahora=datetime.now())
 
+@app.route("/productos/exportar")
+@login_required
+def exportar_productos():
+    """CSV de todo el catálogo, en streaming desde un cursor del servidor. Como en el catálogo
+    en memoria, 'stock' es el disponible (stock menos reservas de órdenes activas)."""
+    filas = filas_cursor_servidor('''
+        SELECT p.id, p.codigo_barra, p.nombre, p.tipo, p.precio, p.stock - p.stock_reservado, c.nombre
+        FROM productos p
+        LEFT JOIN categorias c ON p.categoria_id = c.id
+        ORDER BY p.nombre, p.id
+    ''')
+    encabezados = ['id', 'codigo_barra', 'nombre', 'tipo', 'precio', 'stock', 'categoria']
+    return app.response_class(
+        stream_with_context(csv_en_streaming(encabezados, filas)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=productos.csv'}
+    )
+
 # ==============================
 # RUTAS DE CREACIÓN/EDICIÓN (MANTENIDAS IGUAL)
 # ==============================
@@ -791,6 +4114,8 @@ def crear_producto():
             ''', (nombre, precio_float, stock_int, categoria_id, proveedor_id, tipo, codigo_barra))
             
             conn.commit()
+            catalogo.invalidar()
+            avisar_invalidacion('catalogo')
             flash(f'Producto "{nombre}" creado exitosamente', 'success')
             return redirect(url_for('productos'))
             
@@ -830,33 +4155,22 @@ def abrir_caja():
         observaciones = request.form.get("observaciones", "")
         
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            
             # Verificar si ya hay caja abierta
-            cur.execute("SELECT id FROM caja_turnos WHERE estado = 'abierta'")
-            if cur.fetchone():
+            if estado_turno.obtener():
                 flash('Ya hay una caja abierta. No puedes abrir otra.', 'warning')
                 return redirect(url_for('caja'))
             
-            # Abrir nueva caja
-            cur.execute('''
-                INSERT INTO caja_turnos (fecha_apertura, monto_inicial, observaciones, estado)
-                VALUES (NOW(), %s, %s, 'abierta')
-            ''', (monto_inicial, observaciones))
+            # Abrir nueva caja (si otro usuario se adelantó, no se crea una segunda)
+            turno, creado = estado_turno.abrir(monto_inicial, observaciones)
+            if not creado:
+                flash('Ya hay una caja abierta. No puedes abrir otra.', 'warning')
+                return redirect(url_for('caja'))
             
-            conn.commit()
             flash(f'Caja abierta exitosamente con monto inicial ${float(monto_inicial):,.2f}', 'success')
             return redirect(url_for('caja'))
             
         except Exception as e:
             flash(f'Error al abrir caja: {str(e)}', 'danger')
-        finally:
-            try:
-                cur.close()
-                conn.close()
-            except:
-                pass
     
     return render_template("abrir_caja.html", usuario=usuario_actual, ahora=datetime.now())
 
@@ -870,19 +4184,15 @@ def api_verificar_caja():
     try:
         usuario_actual = get_usuario_actual()
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
         # Verificar si hay caja abierta
-        cur.execute("SELECT id, fecha_apertura, monto_inicial FROM caja_turnos WHERE estado = 'abierta' ORDER BY id DESC LIMIT 1")
-        caja_abierta = cur.fetchone()
+        caja_abierta = estado_turno.obtener()
         
         if caja_abierta:
             response = {
                 'abierta': True,
-                'id': caja_abierta[0],
-                'fecha_apertura': caja_abierta[1].strftime('%Y-%m-%d %H:%M:%S') if caja_abierta[1] else '',
-                'monto_inicial': float(caja_abierta[2]) if caja_abierta[2] else 0,
+                'id': caja_abierta['id'],
+                'fecha_apertura': caja_abierta['fecha_apertura'].strftime('%Y-%m-%d %H:%M:%S') if caja_abierta['fecha_apertura'] else '',
+                'monto_inicial': caja_abierta['monto_inicial'],
                 'mensaje': 'Caja abierta correctamente'
             }
         else:
@@ -892,13 +4202,10 @@ def api_verificar_caja():
                 'puede_abrir': usuario_actual['rol'] in ['cajero', 'admin']
             }
         
-        cur.close()
-        conn.close()
-        
         return jsonify(response)
         
     except Exception as e:
-        print(f"Error verificando caja: {e}")
+        log.exception('Error verificando caja')
         return jsonify({'abierta': False, 'error': str(e)})
 
 # ==============================
@@ -933,14 +4240,135 @@ def api_abrir_caja_emergencia():
                 "redirect": "/abrir_caja"
             }), 500
             
-    except Exception as e:
-        print(f"Error en api_abrir_caja_emergencia: {e}")
+    except Exception:
+        log.exception('Error abriendo caja de emergencia')
         return jsonify({
             "success": False, 
             "message": "Error del servidor",
             "redirect": "/caja"
         }), 500
 
+# ==============================
+# CIERRE DE CAJA
+# ==============================
+@app.route("/cerrar_caja", methods=["GET", "POST"])
+@login_required
+def cerrar_caja():
+    """GET muestra el formulario de cierre con el efectivo esperado. POST cierra el turno abierto
+    con sus acumulados y registra el cierre en cierres_caja.
+
+    monto_final_real (obligatorio) es lo contado en el cajón; la diferencia contra el efectivo
+    esperado queda registrada en el turno."""
+    usuario_actual = get_usuario_actual()
+    if usuario_actual['rol'] not in ['cajero', 'admin']:
+        flash('Solo cajeros y administradores pueden cerrar caja', 'warning')
+        return redirect(url_for('caja'))
+
+    if request.method == 'GET':
+        turno = estado_turno.obtener()
+        resumen = resumen_turno(turno['id']) if turno else None
+        if resumen is None:
+            flash('No hay caja abierta para cerrar', 'warning')
+            return redirect(url_for('caja'))
+        return render_template('cerrar_caja_form.html', usuario=usuario_actual, resumen=resumen, ahora=datetime.now())
+
+    try:
+        monto_real = float((request.form.get('monto_final_real') or '').replace(',', '.'))
+    except ValueError:
+        monto_real = None
+    if monto_real is None or monto_real < 0:
+        flash('Ingrese el monto contado en el cajón', 'danger')
+        return redirect(url_for('cerrar_caja'))
+    observaciones = request.form.get('observaciones') or None
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        # Turno y cierre en una sentencia; un cobro en curso tiene bloqueada la fila del turno,
+        # así que el cierre espera y toma los acumulados ya incluyéndolo
+        cur.execute('''
+            WITH turno AS (
+                UPDATE caja_turnos
+                SET estado = 'cerrada',
+                    fecha_cierre = NOW(),
+                    monto_esperado = monto_inicial + ventas_efectivo + propinas_efectivo,
+                    monto_final_real = %(real)s,
+                    diferencia = %(real)s - (monto_inicial + ventas_efectivo + propinas_efectivo),
+                    observaciones = COALESCE(%(observaciones)s, observaciones)
+                WHERE estado = 'abierta'
+                RETURNING *
+            ), cierre AS (
+                INSERT INTO cierres_caja (turno_id, fecha_cierre, monto_total, monto_efectivo, monto_tarjeta,
+                                          monto_transferencia, monto_mercadopago, propinas, cantidad_ventas,
+                                          observaciones, usuario_cierre)
+                SELECT id, fecha_cierre, COALESCE(total_ventas, 0), ventas_efectivo, ventas_tarjeta,
+                       ventas_transferencia, ventas_mercadopago, propinas, cantidad_ventas,
+                       observaciones, %(usuario)s
+                FROM turno
+            )
+            SELECT id, monto_inicial, COALESCE(total_ventas, 0), monto_esperado, monto_final_real, diferencia,
+                   observaciones, ventas_efectivo, ventas_tarjeta, ventas_transferencia, ventas_mercadopago,
+                   propinas, cantidad_ventas, cantidad_cancelaciones, monto_cancelado
+            FROM turno
+        ''', {'real': monto_real, 'observaciones': observaciones, 'usuario': usuario_actual['nombre']})
+        fila = cur.fetchone()
+        if not fila:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            estado_turno.invalidar()
+            flash('No hay caja abierta para cerrar', 'warning')
+            return redirect(url_for('caja'))
+
+        # Poda de bajas de órdenes: todo cursor que un cliente pueda tener después de este
+        # commit es >= horizonte o recibe la lista completa, así que las anteriores ya no se piden
+        cur.execute('''
+            WITH horizonte AS (
+                SELECT pg_snapshot_xmin(pg_current_snapshot()) AS xid
+            ), poda AS (
+                DELETE FROM ordenes_eliminadas WHERE modificado_xid < (SELECT xid FROM horizonte)
+            )
+            UPDATE caja_turnos SET horizonte_ordenes = (SELECT xid FROM horizonte)::text::bigint
+            WHERE id = %s
+        ''', (fila[0],))
+
+        # Detalle para el informe (solo lectura, por índice de turno)
+        cur.execute('''
+            SELECT o.id, m.numero, o.total, o.fecha_cierre, o.cantidad_items
+            FROM ordenes o JOIN mesas m ON m.id = o.mesa_id
+            WHERE o.turno_id = %s AND o.estado = 'cerrada'
+            ORDER BY o.fecha_cierre
+        ''', (fila[0],))
+        ventas = [{
+            'id': v[0],
+            'mesa_numero': v[1],
+            'total': float(v[2]) if v[2] else 0,
+            'fecha': v[3].strftime('%H:%M') if v[3] else '',
+            'items_count': v[4]
+        } for v in cur.fetchall()]
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        log.exception('Error cerrando caja')
+        flash(f'Error al cerrar caja: {str(e)}', 'danger')
+        return redirect(url_for('caja'))
+
+    estado_turno.invalidar()
+    avisar_invalidacion('turno')
+    log.info('Caja cerrada', extra={'campos': {'turno_id': fila[0], 'usuario': usuario_actual['nombre']}})
+
+    registro = dict(zip(('turno_id', 'monto_inicial', 'total_ventas', 'monto_esperado', 'monto_final_real',
+                         'diferencia', 'observaciones', 'ventas_efectivo', 'ventas_tarjeta', 'ventas_transferencia',
+                         'ventas_mercadopago', 'propinas', 'cantidad_ventas', 'cantidad_cancelaciones',
+                         'monto_cancelado'), fila))
+    for clave, valor in registro.items():
+        if isinstance(valor, Decimal):
+            registro[clave] = float(valor)
+    registro['usuario'] = usuario_actual['nombre']
+    registro['ventas'] = ventas
+    return render_template("cierre_caja_completo.html", registro=registro, usuario=usuario_actual)
+
 # ==============================
 # LOGOUT (MEJORADO)
 # ==============================
@@ -948,6 +4376,7 @@ def api_abrir_caja_emergencia():
 def logout():
     """Cerrar sesión con mensaje informativo"""
     nombre = session.get('nombre', 'Usuario')
+    invalidar_usuario(session.get('user_id'))
     session.clear()
     flash(f'Sesión cerrada correctamente. ¡Hasta pronto {nombre}!', 'info')
     return redirect(url_for('login'))
@@ -965,12 +4394,7 @@ def bienvenida():
     tiene_caja_abierta = False
     if usuario_actual['rol'] in ['cajero', 'admin']:
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT id FROM caja_turnos WHERE estado = 'abierta'")
-            tiene_caja_abierta = cur.fetchone() is not None
-            cur.close()
-            conn.close()
+            tiene_caja_abierta = estado_turno.obtener() is not None
         except:
             pass
     
@@ -979,6 +4403,82 @@ def bienvenida():
                          tiene_caja_abierta=tiene_caja_abierta,
                          ahora=datetime.now())
 
+# ==============================
+# ESTADO DEL POOL DE CONEXIONES
+# ==============================
+@app.route("/api/estado_pool")
+@admin_required
+def api_estado_pool():
+    """Estadísticas del pool de conexiones (en uso, esperas, tiempo de espera)"""
+    return jsonify(get_pool().estadisticas())
+
+# ==============================
+# MÉTRICAS (PROMETHEUS)
+# ==============================
+@app.route("/metrics")
+def metrics():
+    """Métricas del proceso en formato de texto de Prometheus. Con ROKA_METRICS_TOKEN definido
+    se exige 'Authorization: Bearer <token>'; sin token, solo un admin logueado o un pedido
+    directo desde la misma máquina (sin X-Forwarded-For, que indica un proxy delante)."""
+    token = os.environ.get("ROKA_METRICS_TOKEN")
+    if token:
+        autorizado = hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    else:
+        usuario_actual = get_usuario_actual()
+        autorizado = (usuario_actual is not None and usuario_actual['rol'] == 'admin') or \
+            (request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers)
+    if not autorizado:
+        return 'No autorizado\n', 401
+
+    medidores = []
+    if _pool is not None:
+        pool = _pool.estadisticas()
+        medidores.append(('roka_pool_conexiones', 'gauge', 'Conexiones del pool por estado',
+                          [({'estado': e}, pool[e]) for e in ('abiertas', 'en_uso', 'libres')]))
+        medidores.append(('roka_pool_conexiones_max', 'gauge', 'Tamaño máximo del pool', [({}, pool['maximo'])]))
+        medidores.append(('roka_pool_esperas_total', 'counter', 'Veces que un request esperó una conexión',
+                          [({}, pool['esperas'])]))
+        medidores.append(('roka_pool_espera_segundos_total', 'counter', 'Tiempo total esperando una conexión',
+                          [({}, pool['tiempo_espera_total'])]))
+    if ESTADO_ARRANQUE['segundos'] is not None:
+        medidores.append(('roka_arranque_segundos', 'gauge', 'Duración del arranque del proceso',
+                          [({}, round(ESTADO_ARRANQUE['segundos'], 4))]))
+    if ESTADO_ARRANQUE['version_esquema'] is not None:
+        medidores.append(('roka_esquema_version', 'gauge', 'Versión del esquema aplicada',
+                          [({}, ESTADO_ARRANQUE['version_esquema'])]))
+    medidores.append(('roka_cocina_seq', 'gauge', 'Último seq de eventos de cocina', [({}, eventos_cocina.seq)]))
+    medidores.append(('roka_cocina_cola_items', 'gauge', 'Items en la cola de cocina en memoria', [({}, cola_cocina.tamano)]))
+    medidores.append(('roka_log_descartados_total', 'counter', 'Registros de log descartados con la cola llena',
+                      [({}, _cola_log.descartados)]))
+
+    return app.response_class(metricas.exportar(medidores), mimetype='text/plain; version=0.0.4')
+
+# ==============================
+# RESUMEN DEL PERFIL DE CONSULTAS
+# ==============================
+@app.route("/admin/consultas")
+@admin_required
+def admin_consultas():
+    """Formas de consulta más caras (por tiempo total, promedio, máximo o llamadas) y las últimas lentas"""
+    orden = request.args.get('orden', 'ms_total')
+    if orden not in ('ms_total', 'ms_promedio', 'ms_max', 'llamadas', 'lentas', 'filas_promedio'):
+        orden = 'ms_total'
+    resumen = perfil_consultas.resumen(orden)
+    lentas = perfil_consultas.lentas()
+    if request.args.get('formato') == 'json':
+        return jsonify({'activo': PERFILAR_SQL, 'umbral_ms': perfil_consultas.umbral_segundos * 1000,
+                        'consultas': resumen, 'lentas': lentas})
+    return render_template("consultas.html", usuario=get_usuario_actual(), activo=PERFILAR_SQL,
+                           umbral_ms=perfil_consultas.umbral_segundos * 1000, orden=orden,
+                           consultas=resumen, lentas=lentas[:50], ahora=datetime.now())
+
+@app.route("/admin/consultas/reiniciar", methods=["POST"])
+@admin_required
+def admin_consultas_reiniciar():
+    perfil_consultas.reiniciar()
+    flash('Perfil de consultas reiniciado', 'success')
+    return redirect(url_for('admin_consultas'))
+
 # ==============================
 # TEMPLATES DE ERROR (MEJORADOS)
 # ==============================
@@ -1148,18 +4648,20 @@ def verificar_caja_para_usuarios_relevantes():
             rutas_importantes = ['/caja', '/ventas', '/historial_caja']
             if request.path in rutas_importantes:
                 try:
-                    conn = get_db_connection()
-                    cur = conn.cursor()
-                    cur.execute("SELECT id FROM caja_turnos WHERE estado = 'abierta'")
-                    if not cur.fetchone():
+                    if not estado_turno.obtener():
                         # Si llegamos aquí desde una ruta importante y no hay caja, redirigir
                         flash('Se requiere caja abierta para esta sección. Abriendo automáticamente...', 'info')
                         if abrir_caja_automaticamente():
                             return redirect(request.path)
-                    cur.close()
-                    conn.close()
-                except Exception as e:
-                    print(f"Error verificando caja en middleware: {e}")
+                except Exception:
+                    log.exception('Error verificando caja en middleware')
+
+# ==============================
+# TIEMPO DE ARRANQUE
+# ==============================
+# Solo el import; la conexión a la base, el catálogo y el bus esperan a arrancar_worker()
+ESTADO_ARRANQUE['segundos'] = time.perf_counter() - _inicio_arranque
+log.info('Arranque completo', extra={'campos': {'ms': round(ESTADO_ARRANQUE['segundos'] * 1000, 1)}})
 
 # ==============================
 # EJECUCIÓN PRINCIPAL
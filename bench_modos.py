@@ -0,0 +1,134 @@
+# ==============================
+# BENCHMARK: THREADING VS EVENTLET
+# ==============================
+# Abre N conexiones Socket.IO inactivas (como tablets y pantallas de cocina esperando eventos)
+# contra un worker en marcha y, mientras están abiertas, mide la latencia de /api/pedidos_cocina.
+# Solo usa la biblioteca estándar.
+#
+#   python bench_modos.py --url http://localhost:5000 --conexiones 300 --segundos 60
+#
+# Imprime un JSON con las conexiones que el worker aceptó y sostuvo y los percentiles de latencia.
+import argparse
+import http.cookiejar
+import json
+import statistics
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+SEPARADOR = '\x1e'  # separador de paquetes de Engine.IO v4 en long-polling
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados))) - 1))
+    return ordenados[indice]
+
+class ConexionInactiva(threading.Thread):
+    """Cliente Socket.IO mínimo por long-polling conectado al namespace /chef que solo
+    contesta los ping del servidor"""
+
+    def __init__(self, url, fin):
+        super().__init__(daemon=True)
+        self.url = url
+        self.fin = fin
+        self.sid = None
+        self.conectada = False
+        self.viva = False
+        self.error = None
+
+    def _pedir(self, metodo='GET', cuerpo=None, timeout=60):
+        consulta = {'EIO': '4', 'transport': 'polling', 't': str(time.time())}
+        if self.sid:
+            consulta['sid'] = self.sid
+        peticion = urllib.request.Request(
+            f"{self.url}/socket.io/?{urllib.parse.urlencode(consulta)}",
+            data=cuerpo.encode() if cuerpo is not None else None,
+            method=metodo,
+            headers={'Content-Type': 'text/plain;charset=UTF-8'}
+        )
+        with urllib.request.urlopen(peticion, timeout=timeout) as respuesta:
+            return respuesta.read().decode()
+
+    def run(self):
+        try:
+            apertura = self._pedir()
+            self.sid = json.loads(apertura[apertura.index('{'):])['sid']
+            self._pedir('POST', '40/chef,')
+            self.viva = True
+            while not self.fin.is_set():
+                for paquete in self._pedir().split(SEPARADOR):
+                    if paquete.startswith('40/chef'):
+                        self.conectada = True
+                    elif paquete == '2':
+                        self._pedir('POST', '3')
+                    elif paquete == '1':
+                        raise ConnectionError('el servidor cerró la sesión')
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.viva = False if self.error else self.viva
+
+def medir_latencias(url, opener, fin, latencias, errores):
+    while not fin.is_set():
+        inicio = time.perf_counter()
+        try:
+            with opener.open(f"{url}/api/pedidos_cocina", timeout=30) as respuesta:
+                respuesta.read()
+            latencias.append((time.perf_counter() - inicio) * 1000)
+        except Exception:
+            errores.append(time.perf_counter())
+        time.sleep(0.05)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compara los modos de servidor de ROKA')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--conexiones', type=int, default=200)
+    parser.add_argument('--segundos', type=int, default=60)
+    parser.add_argument('--sondas', type=int, default=4, help='clientes HTTP concurrentes midiendo latencia')
+    parser.add_argument('--usuario', default='admin')
+    parser.add_argument('--clave', default='admin123')
+    args = parser.parse_args()
+
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    datos = urllib.parse.urlencode({'username': args.usuario, 'password': args.clave}).encode()
+    opener.open(f"{args.url}/login", data=datos, timeout=30).read()
+
+    fin = threading.Event()
+    conexiones = [ConexionInactiva(args.url, fin) for _ in range(args.conexiones)]
+    for conexion in conexiones:
+        conexion.start()
+        time.sleep(0.005)
+
+    latencias, errores = [], []
+    sondas = [threading.Thread(target=medir_latencias, args=(args.url, opener, fin, latencias, errores), daemon=True)
+              for _ in range(args.sondas)]
+    for sonda in sondas:
+        sonda.start()
+
+    time.sleep(args.segundos)
+    vivas = sum(1 for c in conexiones if c.viva)
+    conectadas = sum(1 for c in conexiones if c.conectada)
+    fin.set()
+
+    resultado = {
+        'url': args.url,
+        'conexiones_pedidas': args.conexiones,
+        'conexiones_conectadas': conectadas,
+        'conexiones_vivas_al_final': vivas,
+        'requests_medidos': len(latencias),
+        'requests_con_error': len(errores),
+        'latencia_ms': {
+            'p50': round(statistics.median(latencias), 2) if latencias else None,
+            'p95': round(percentil(latencias, 95), 2) if latencias else None,
+            'p99': round(percentil(latencias, 99), 2) if latencias else None,
+            'max': round(max(latencias), 2) if latencias else None
+        },
+        'errores_conexion': sorted({c.error for c in conexiones if c.error})[:5]
+    }
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
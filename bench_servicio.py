@@ -0,0 +1,246 @@
+# ==============================
+# BENCHMARK: SERVICIO COMPLETO (MOZOS, COCINA, CAJA)
+# ==============================
+# Simula un turno contra un worker local: mozos que crean órdenes con /api/crear_orden,
+# pantallas de cocina que consultan /api/pedidos_cocina y avanzan items con
+# /api/actualizar_item_estado, y cajeros que cargan /caja. Para contar consultas a la base,
+# levantar el worker con ROKA_CONTAR_CONSULTAS=1.
+#
+#   ROKA_CONTAR_CONSULTAS=1 python app2.py
+#   python bench_servicio.py --mozos 8 --cocinas 2 --cajeros 1 --segundos 60 --salida base.json
+#   python bench_servicio.py ... --comparar base.json
+#
+# Con la misma --semilla cada usuario virtual repite la misma secuencia de decisiones.
+import argparse
+import http.cookiejar
+import json
+import random
+import statistics
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from bench_modos import percentil
+
+SIGUIENTE_ESTADO = {'pendiente': 'proceso', 'proceso': 'listo'}
+
+class Metricas:
+    """Latencias, errores y consultas a la base por ruta (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rutas = {}
+
+    def registrar(self, ruta, ms, ok, consultas):
+        with self._lock:
+            datos = self._rutas.setdefault(ruta, {'latencias': [], 'errores': 0, 'consultas': []})
+            datos['latencias'].append(ms)
+            if not ok:
+                datos['errores'] += 1
+            if consultas is not None:
+                datos['consultas'].append(consultas)
+
+    def resumen(self, segundos):
+        with self._lock:
+            resultado = {}
+            for ruta, datos in sorted(self._rutas.items()):
+                latencias = datos['latencias']
+                consultas = datos['consultas']
+                resultado[ruta] = {
+                    'requests': len(latencias),
+                    'errores': datos['errores'],
+                    'throughput_rps': round(len(latencias) / segundos, 2),
+                    'latencia_ms': {
+                        'p50': round(statistics.median(latencias), 2),
+                        'p95': round(percentil(latencias, 95), 2),
+                        'p99': round(percentil(latencias, 99), 2),
+                        'max': round(max(latencias), 2)
+                    },
+                    'consultas_db': {
+                        'promedio': round(statistics.mean(consultas), 2) if consultas else None,
+                        'max': max(consultas) if consultas else None
+                    }
+                }
+            return resultado
+
+class UsuarioVirtual(threading.Thread):
+    """Sesión propia (cookie) contra el servidor, con su generador aleatorio"""
+
+    def __init__(self, nombre, args, metricas, fin, semilla):
+        super().__init__(daemon=True, name=nombre)
+        self.args = args
+        self.metricas = metricas
+        self.fin = fin
+        self.azar = random.Random(semilla)
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def pedir(self, ruta, etiqueta=None, datos=None, metodo=None):
+        cuerpo = json.dumps(datos).encode() if datos is not None else None
+        peticion = urllib.request.Request(f"{self.args.url}{ruta}", data=cuerpo, method=metodo,
+                                          headers={'Content-Type': 'application/json'} if cuerpo else {})
+        inicio = time.perf_counter()
+        ok, consultas, contenido = True, None, None
+        try:
+            with self.opener.open(peticion, timeout=30) as respuesta:
+                contenido = respuesta.read()
+                consultas = respuesta.headers.get('X-DB-Consultas')
+        except urllib.error.HTTPError as e:
+            ok = False
+            consultas = e.headers.get('X-DB-Consultas')
+        except Exception:
+            ok = False
+        ms = (time.perf_counter() - inicio) * 1000
+        self.metricas.registrar(etiqueta or ruta, ms, ok, int(consultas) if consultas else None)
+        return contenido if ok else None
+
+    def login(self):
+        datos = urllib.parse.urlencode({'username': self.args.usuario, 'password': self.args.clave}).encode()
+        self.opener.open(f"{self.args.url}/login", data=datos, timeout=30).read()
+
+    def esperar(self, base):
+        # Pausa con ±50% de variación para que los usuarios no vayan sincronizados
+        self.fin.wait(base * self.azar.uniform(0.5, 1.5))
+
+    def run(self):
+        self.login()
+        while not self.fin.is_set():
+            self.paso()
+
+class Mozo(UsuarioVirtual):
+    def __init__(self, *args, productos, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.productos = productos
+        self.abiertas = []
+
+    def paso(self):
+        items = []
+        for producto in self.azar.sample(self.productos, min(len(self.productos), self.azar.randint(1, 4))):
+            items.append({
+                'producto_id': producto['id'],
+                'cantidad': self.azar.randint(1, 3)
+            })
+        contenido = self.pedir('/api/crear_orden', datos={
+            'mesa_id': self.azar.randint(1, self.args.mesas),
+            'mozo_nombre': self.name,
+            'items': items
+        })
+        if contenido:
+            self.abiertas.append(json.loads(contenido)['orden_id'])
+        # Mantiene acotadas las órdenes abiertas para que la corrida llegue a un régimen estable
+        while len(self.abiertas) > self.args.ordenes_por_mozo:
+            orden_id = self.abiertas.pop(0)
+            self.pedir(f'/api/cancelar_orden/{orden_id}', etiqueta='/api/cancelar_orden', datos={}, metodo='POST')
+        self.esperar(self.args.pausa_mozo)
+
+class Cocina(UsuarioVirtual):
+    def paso(self):
+        contenido = self.pedir('/api/pedidos_cocina')
+        if contenido:
+            items = [i for pedido in json.loads(contenido) for i in pedido['items']
+                     if i['estado_item'] in SIGUIENTE_ESTADO]
+            for item in self.azar.sample(items, min(len(items), self.args.items_por_vuelta)):
+                self.pedir('/api/actualizar_item_estado', datos={
+                    'item_id': item['id'],
+                    'estado': SIGUIENTE_ESTADO[item['estado_item']]
+                })
+        self.esperar(self.args.pausa_cocina)
+
+class Cajero(UsuarioVirtual):
+    def paso(self):
+        self.pedir('/caja')
+        self.esperar(self.args.pausa_cajero)
+
+def cargar_productos(args):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    datos = urllib.parse.urlencode({'username': args.usuario, 'password': args.clave}).encode()
+    opener.open(f"{args.url}/login", data=datos, timeout=30).read()
+    with opener.open(f"{args.url}/api/productos", timeout=30) as respuesta:
+        productos = json.loads(respuesta.read())
+    return [p for p in productos if p.get('precio')]
+
+def version_codigo():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except Exception:
+        return None
+
+def comparar(actual, anterior):
+    """Variación de p95 y throughput por ruta respecto de una corrida guardada"""
+    cambios = {}
+    for ruta, datos in actual['rutas'].items():
+        base = anterior['rutas'].get(ruta)
+        if not base:
+            continue
+        cambios[ruta] = {
+            'p95_ms': [base['latencia_ms']['p95'], datos['latencia_ms']['p95']],
+            'throughput_rps': [base['throughput_rps'], datos['throughput_rps']],
+            'consultas_db_promedio': [base['consultas_db']['promedio'], datos['consultas_db']['promedio']]
+        }
+    return cambios
+
+def main():
+    parser = argparse.ArgumentParser(description='Simula un servicio completo contra ROKA')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--mozos', type=int, default=8)
+    parser.add_argument('--cocinas', type=int, default=2)
+    parser.add_argument('--cajeros', type=int, default=1)
+    parser.add_argument('--segundos', type=int, default=60)
+    parser.add_argument('--mesas', type=int, default=10, help='ids de mesa 1..N')
+    parser.add_argument('--pausa-mozo', type=float, default=2.0)
+    parser.add_argument('--pausa-cocina', type=float, default=1.0)
+    parser.add_argument('--pausa-cajero', type=float, default=3.0)
+    parser.add_argument('--items-por-vuelta', type=int, default=3)
+    parser.add_argument('--ordenes-por-mozo', type=int, default=5)
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--usuario', default='admin')
+    parser.add_argument('--clave', default='admin123')
+    parser.add_argument('--salida', help='archivo JSON donde guardar el resultado')
+    parser.add_argument('--comparar', help='resultado JSON anterior contra el cual comparar')
+    args = parser.parse_args()
+
+    productos = cargar_productos(args)
+    if not productos:
+        raise SystemExit('No hay productos con precio para armar órdenes')
+
+    metricas = Metricas()
+    fin = threading.Event()
+    usuarios = []
+    for i in range(args.mozos):
+        usuarios.append(Mozo(f'mozo-{i + 1}', args, metricas, fin, args.semilla * 1000 + i, productos=productos))
+    for i in range(args.cocinas):
+        usuarios.append(Cocina(f'cocina-{i + 1}', args, metricas, fin, args.semilla * 1000 + 100 + i))
+    for i in range(args.cajeros):
+        usuarios.append(Cajero(f'cajero-{i + 1}', args, metricas, fin, args.semilla * 1000 + 200 + i))
+
+    inicio = time.perf_counter()
+    for usuario in usuarios:
+        usuario.start()
+    fin.wait(args.segundos)
+    fin.set()
+    for usuario in usuarios:
+        usuario.join(timeout=35)
+    segundos = time.perf_counter() - inicio
+
+    resultado = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'commit': version_codigo(),
+        'configuracion': {k: v for k, v in vars(args).items() if k not in ('clave', 'salida', 'comparar')},
+        'segundos': round(segundos, 2),
+        'rutas': metricas.resumen(segundos)
+    }
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            resultado['comparacion'] = comparar(resultado, json.load(f))
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            f.write(texto + '\n')
+    print(texto)
+
+if __name__ == "__main__":
+    main()
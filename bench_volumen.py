@@ -0,0 +1,289 @@
+# ==============================
+# BENCHMARK: ESCALADO CON EL VOLUMEN DE DATOS
+# ==============================
+# Llena una base local con historia sintética (turnos de caja, órdenes cerradas con sus items,
+# cierres con mezcla de medios de pago) y mide cómo escalan los listados con la cantidad de
+# órdenes. Usar SOLO contra una base de pruebas: la carga desactiva triggers y FKs durante el
+# COPY (session_replication_role = replica, requiere superusuario).
+#
+#   python bench_volumen.py generar --ordenes 100000 --ordenes-por-dia 300
+#   python bench_volumen.py medir --repeticiones 20
+#   python bench_volumen.py escalar --niveles 10000,100000,1000000 --salida volumen.json
+#
+# La historia se agrega hacia atrás en el tiempo a partir de la orden más antigua, así cada
+# nivel de 'escalar' equivale a tener más meses de datos.
+import argparse
+import csv
+import io
+import json
+import random
+import statistics
+import time
+from datetime import date, datetime, timedelta
+
+import app2
+from bench_modos import percentil
+from bench_servicio import version_codigo
+
+MOZOS = ['Ana', 'Bruno', 'Carla', 'Diego', 'Elena', 'Facundo', 'Gabriela', 'Hernán', 'Irene', 'Julián']
+
+# (hora de inicio, hora de fin, peso): almuerzo y cena concentran casi todo el servicio
+FRANJAS = [(12, 15, 0.40), (20, 24, 0.50), (16, 20, 0.10)]
+
+# Rutas que se miden en cada nivel; se resuelven con el test client de Flask (sin red)
+RUTAS = [
+    '/caja',
+    '/api/ordenes_activas',
+    '/api/pedidos_cocina',
+    '/api/pedidos_cocina_comidas',
+    '/ventas',
+    '/historial_caja',
+    '/api/ventas/resumen?por=producto&limite=20',
+]
+
+def conectar():
+    conn = app2.abrir_conexion_nueva()
+    conn.autocommit = False
+    return conn
+
+def leer_catalogo(cur):
+    cur.execute('SELECT id, nombre, precio FROM productos WHERE precio > 0 ORDER BY id')
+    productos = [(f[0], f[1], float(f[2])) for f in cur.fetchall()]
+    cur.execute('SELECT id FROM mesas ORDER BY id')
+    mesas = [f[0] for f in cur.fetchall()]
+    if not productos or not mesas:
+        raise SystemExit('Se necesitan productos con precio y mesas (flask --app app2 roka init-db)')
+    return productos, mesas
+
+def reservar_ids(cur, tabla, cantidad):
+    """Reserva un bloque de ids de la secuencia de la tabla y devuelve el primero"""
+    cur.execute(f"SELECT setval(pg_get_serial_sequence('{tabla}', 'id'), nextval(pg_get_serial_sequence('{tabla}', 'id')) + %s - 1)",
+                (cantidad,))
+    return cur.fetchone()[0] - cantidad + 1
+
+def copiar(cur, tabla, columnas, filas):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(filas)
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def parsear_mezcla(texto):
+    """'efectivo:0.5,tarjeta:0.35,transferencia:0.15' -> {'efectivo': 0.5, ...} normalizado"""
+    mezcla = {}
+    for parte in texto.split(','):
+        medio, peso = parte.split(':')
+        medio = medio.strip()
+        if medio not in app2.METODOS_PAGO:
+            raise SystemExit(f"Medio de pago desconocido: {medio} (válidos: {', '.join(app2.METODOS_PAGO)})")
+        mezcla[medio] = float(peso)
+    total = sum(mezcla.values())
+    return {medio: peso / total for medio, peso in mezcla.items()}
+
+def dia_mas_antiguo(cur):
+    cur.execute("SELECT MIN(fecha_apertura)::date FROM ordenes WHERE estado = 'cerrada'")
+    minimo = cur.fetchone()[0]
+    return minimo if minimo else date.today()
+
+def generar(ordenes, ordenes_por_dia=300, items_max=6, mezcla=None, semilla=1, lote=20000):
+    """Agrega 'ordenes' órdenes cerradas, día por día hacia atrás. Devuelve los días generados."""
+    azar = random.Random(semilla)
+    mezcla = mezcla or parsear_mezcla('efectivo:0.5,tarjeta:0.35,transferencia:0.15')
+    conn = conectar()
+    cur = conn.cursor()
+    productos, mesas = leer_catalogo(cur)
+    dia = primer_dia = dia_mas_antiguo(cur)
+    cur.execute('SET session_replication_role = replica')
+
+    pendientes_ordenes, pendientes_items = [], []
+    restantes, dias, inicio = ordenes, 0, time.perf_counter()
+
+    def volcar():
+        if not pendientes_ordenes:
+            return
+        primero = reservar_ids(cur, 'ordenes', len(pendientes_ordenes))
+        filas_ordenes, filas_items = [], []
+        for desplazamiento, (orden, items) in enumerate(zip(pendientes_ordenes, pendientes_items)):
+            orden_id = primero + desplazamiento
+            # Con los triggers desactivados, cantidad_items se carga a mano (items_pendientes queda en 0)
+            filas_ordenes.append((orden_id,) + orden + (len(items),))
+            filas_items.extend((orden_id,) + item for item in items)
+        copiar(cur, 'ordenes', ['id', 'mesa_id', 'mozo_nombre', 'estado', 'observaciones', 'total',
+                                'fecha_apertura', 'fecha_cierre', 'dispositivo_origen', 'turno_id', 'metodo_pago',
+                                'cantidad_items'], filas_ordenes)
+        copiar(cur, 'orden_items', ['orden_id', 'producto_id', 'producto_nombre', 'cantidad', 'precio_unitario',
+                                    'observaciones', 'estado_item', 'tiempo_inicio', 'tiempo_fin',
+                                    'tiempo_estimado'], filas_items)
+        conn.commit()
+        pendientes_ordenes.clear()
+        pendientes_items.clear()
+
+    while restantes > 0:
+        dia -= timedelta(days=1)
+        dias += 1
+        cantidad = min(restantes, max(1, int(azar.gauss(ordenes_por_dia, ordenes_por_dia * 0.2))))
+        restantes -= cantidad
+
+        apertura = datetime.combine(dia, datetime.min.time()) + timedelta(hours=11)
+        cierre = apertura + timedelta(hours=14)
+        cur.execute('''
+            INSERT INTO caja_turnos (fecha_apertura, fecha_cierre, monto_inicial, observaciones, estado)
+            VALUES (%s, %s, 5000, 'generado', 'cerrada')
+            RETURNING id
+        ''', (apertura, cierre))
+        turno_id = cur.fetchone()[0]
+
+        # Cada orden se cobra con un medio de pago según la mezcla; el turno guarda los acumulados
+        montos = dict.fromkeys(app2.METODOS_PAGO, 0.0)
+        for _ in range(cantidad):
+            desde, hasta, _peso = azar.choices(FRANJAS, weights=[f[2] for f in FRANJAS])[0]
+            abierta = apertura.replace(hour=desde) + timedelta(minutes=azar.uniform(0, (hasta - desde) * 60))
+            cerrada = abierta + timedelta(minutes=azar.uniform(30, 120))
+            items, total = [], 0.0
+            for producto_id, nombre, precio in azar.sample(productos, min(len(productos), azar.randint(1, items_max))):
+                cantidad_item = azar.choices([1, 2, 3], weights=[70, 22, 8])[0]
+                inicio_item = abierta + timedelta(minutes=azar.uniform(1, 10))
+                items.append((producto_id, nombre, cantidad_item, precio, '', 'listo',
+                              inicio_item, inicio_item + timedelta(minutes=azar.uniform(5, 25)), 15))
+                total += precio * cantidad_item
+            metodo = azar.choices(list(mezcla), weights=list(mezcla.values()))[0]
+            montos[metodo] += total
+            pendientes_ordenes.append((azar.choice(mesas), azar.choice(MOZOS), 'cerrada', '', round(total, 2),
+                                       abierta, cerrada, 'generador', turno_id, metodo))
+            pendientes_items.append(items)
+
+        montos = {medio: round(monto, 2) for medio, monto in montos.items()}
+        total_dia = round(sum(montos.values()), 2)
+        esperado = 5000 + montos['efectivo']
+        real = round(esperado + azar.choice([0, 0, 0, -100, 50, 200]), 2)
+        cur.execute('''
+            UPDATE caja_turnos
+            SET monto_final_real = %s, total_ventas = %s, monto_esperado = %s, diferencia = %s,
+                cantidad_ventas = %s, ventas_efectivo = %s, ventas_tarjeta = %s, ventas_transferencia = %s,
+                ventas_mercadopago = %s
+            WHERE id = %s
+        ''', (real, total_dia, esperado, round(real - esperado, 2), cantidad, montos['efectivo'], montos['tarjeta'],
+              montos['transferencia'], montos['mercadopago'], turno_id))
+        cur.execute('''
+            INSERT INTO cierres_caja (turno_id, fecha_cierre, monto_total, monto_efectivo, monto_tarjeta,
+                                      monto_transferencia, monto_mercadopago, propinas, cantidad_ventas,
+                                      observaciones, usuario_cierre)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, 0, %s, 'generado', 'generador')
+        ''', (turno_id, cierre, total_dia, montos['efectivo'], montos['tarjeta'], montos['transferencia'],
+              montos['mercadopago'], cantidad))
+
+        if len(pendientes_ordenes) >= lote:
+            volcar()
+            print(f"📝 {ordenes - restantes} órdenes generadas ({time.perf_counter() - inicio:.1f}s)")
+    volcar()
+    cur.execute('SET session_replication_role = DEFAULT')
+    # Con los triggers desactivados los resúmenes de ventas no se enteraron: rearmar los días nuevos
+    cur.execute('SELECT resumir_ventas(%s, %s)', (dia, primer_dia - timedelta(days=1)))
+    conn.commit()
+
+    # Estadísticas frescas para que el planner vea el volumen nuevo
+    conn.autocommit = True
+    cur.execute('VACUUM ANALYZE ordenes')
+    cur.execute('VACUUM ANALYZE orden_items')
+    cur.execute('ANALYZE caja_turnos')
+    cur.execute('ANALYZE cierres_caja')
+    for tabla in ('ventas_diarias', 'ventas_por_hora', 'ventas_por_producto', 'ventas_por_mozo'):
+        cur.execute(f'ANALYZE {tabla}')
+    cur.close()
+    conn.close()
+    print(f"✅ {ordenes} órdenes en {dias} días generadas en {time.perf_counter() - inicio:.1f}s")
+    return dias
+
+def contar_ordenes():
+    conn = conectar()
+    cur = conn.cursor()
+    cur.execute('SELECT COUNT(*) FROM ordenes')
+    total = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return total
+
+def medir(repeticiones=20, usuario='admin', clave='admin123'):
+    """Tiempo de cada ruta de RUTAS a través del test client (sin red)"""
+    cliente = app2.app.test_client()
+    cliente.post('/login', data={'username': usuario, 'password': clave})
+    resultado = {}
+    for ruta in RUTAS:
+        for _ in range(2):
+            cliente.get(ruta)  # calentamiento (cachés y plan de la consulta)
+        tiempos, estado = [], None
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            respuesta = cliente.get(ruta)
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+            estado = respuesta.status_code
+        resultado[ruta] = {
+            'estado_http': estado,
+            'p50_ms': round(statistics.median(tiempos), 2),
+            'p95_ms': round(percentil(tiempos, 95), 2),
+            'max_ms': round(max(tiempos), 2)
+        }
+    return resultado
+
+def escalar(niveles, repeticiones, **opciones_generador):
+    filas = []
+    for nivel in niveles:
+        actuales = contar_ordenes()
+        if actuales < nivel:
+            generar(nivel - actuales, **opciones_generador)
+        print(f"⏱️  Midiendo con {max(nivel, actuales)} órdenes...")
+        filas.append({'ordenes': contar_ordenes(), 'rutas': medir(repeticiones)})
+    return filas
+
+def main():
+    parser = argparse.ArgumentParser(description='Historia sintética y escalado de listados de ROKA')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    opciones_generador = argparse.ArgumentParser(add_help=False)
+    opciones_generador.add_argument('--ordenes-por-dia', type=int, default=300)
+    opciones_generador.add_argument('--items-max', type=int, default=6, help='items distintos por orden (1..N)')
+    opciones_generador.add_argument('--mezcla-pagos', default='efectivo:0.5,tarjeta:0.35,transferencia:0.15')
+    opciones_generador.add_argument('--semilla', type=int, default=1)
+
+    p_generar = subparsers.add_parser('generar', parents=[opciones_generador], help='agrega historia sintética')
+    cantidad = p_generar.add_mutually_exclusive_group(required=True)
+    cantidad.add_argument('--ordenes', type=int)
+    cantidad.add_argument('--meses', type=int, help='meses de historia (a --ordenes-por-dia)')
+
+    p_medir = subparsers.add_parser('medir', help='mide las rutas con el volumen actual')
+    p_medir.add_argument('--repeticiones', type=int, default=20)
+
+    p_escalar = subparsers.add_parser('escalar', parents=[opciones_generador],
+                                      help='genera hasta cada nivel y mide las rutas en cada uno')
+    p_escalar.add_argument('--niveles', default='10000,100000,1000000')
+    p_escalar.add_argument('--repeticiones', type=int, default=20)
+    p_escalar.add_argument('--salida', help='archivo JSON donde guardar el resultado')
+    args = parser.parse_args()
+
+    if args.comando in ('generar', 'escalar'):
+        generador = {
+            'ordenes_por_dia': args.ordenes_por_dia,
+            'items_max': args.items_max,
+            'mezcla': parsear_mezcla(args.mezcla_pagos),
+            'semilla': args.semilla
+        }
+
+    if args.comando == 'generar':
+        generar(args.ordenes or args.meses * 30 * args.ordenes_por_dia, **generador)
+    elif args.comando == 'medir':
+        print(json.dumps({'ordenes': contar_ordenes(), 'rutas': medir(args.repeticiones)}, indent=2, ensure_ascii=False))
+    else:
+        niveles = [int(n) for n in args.niveles.split(',')]
+        resultado = {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'commit': version_codigo(),
+            'configuracion': {k: v for k, v in vars(args).items() if k not in ('comando', 'salida')},
+            'niveles': escalar(niveles, args.repeticiones, **generador)
+        }
+        texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+        if args.salida:
+            with open(args.salida, 'w', encoding='utf-8') as f:
+                f.write(texto + '\n')
+        print(texto)
+
+if __name__ == "__main__":
+    main()